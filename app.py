@@ -4,25 +4,77 @@
 Dash for interactive plot, hosted by Render using gunicorn
 '''
 
+import gzip
+import os
+import sys
+import time
+from functools import lru_cache, wraps
+import flask
 import dash
 from dash import dcc, html
-from dash.dependencies import Input, Output
+from dash.dependencies import Input, Output, State, ClientsideFunction
+from dash.exceptions import PreventUpdate, MissingCallbackContextException
+import numpy as np
 import pandas as pd
-pd.options.mode.chained_assignment = None
 import geopandas as gpd
-from shapely import wkt
+pd.options.mode.chained_assignment = None
 import plotly.express as px
+import plotly.graph_objects as go
 import pyproj
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lib'))
+import geostore
+import shared_geometry
+import lod_pyramid
+import vector_tiles
+import buffer_sets
+import point_query
+import score_grid
+import overlay
+import union_tree
+import partitions
+import job_queue
+import viewport
+import metrics
+import topojson_wire
+try:
+    import brotli  # optional, for RESPONSE_COMPRESSION=br
+except ImportError:
+    brotli = None
 
 
 # Stylesheet for Dash
 external_stylesheet = ['https://codepen.io/chriddyp/pen/bWLwgP.css'] # stylesheet for CSS code from codepen
 
 
-# Bring in the buffers datasets (buffer, trail_type, building_type)
-trail = pd.read_csv('data/buffers_800t_1000p_1000b/combined_bikeway_buffers.csv', header=0)
-park = pd.read_csv('data/buffers_800t_1000p_1000b/combined_park_buffers.csv', header=0)
-building = pd.read_csv('data/buffers_800t_1000p_1000b/combined_building_buffers.csv', header=0)
+# Figure cache : number of finished figures kept (LRU), and how many common selections to build at boot
+FIGURE_CACHE_SIZE = int(os.environ.get('FIGURE_CACHE_SIZE', 64))
+WARM_FIGURE_CACHE = int(os.environ.get('WARM_FIGURE_CACHE', 0))
+# Map rendering : 'geojson' (one choropleth trace per selection), 'tiles' (vector tiles from /tiles/...)
+#    or 'client' (every group sent once per zoom level, checklists toggle trace visibility in the browser)
+MAP_MODE = os.environ.get('MAP_MODE', 'geojson')
+TILE_CACHE_DIR = os.environ.get('TILE_CACHE_DIR', 'data/tile_cache')
+# Geometry on the wire : 'geojson' (plotly's full precision GeoJSON, one copy per trace) or 'topojson' (quantized to
+#    TOPOJSON_PRECISION meters, shared arcs stored once, decoded in the browser by assets/topojson.js)
+WIRE_FORMAT = os.environ.get('WIRE_FORMAT', 'geojson')
+TOPOJSON_PRECISION = float(os.environ.get('TOPOJSON_PRECISION', topojson_wire.PRECISION))
+# Response compression : 'off', 'gzip' or 'br' (brotli package, gzip for clients without it)
+RESPONSE_COMPRESSION = os.environ.get('RESPONSE_COMPRESSION', 'off')
+# Buffer radius sets : how many are kept loaded at once (LRU, loaded on first use)
+BUFFER_SET_CACHE_SIZE = int(os.environ.get('BUFFER_SET_CACHE_SIZE', 2))
+# Partitioned radius sets (see lib/partitions.py) : memory cap of the partitions kept loaded (MB, least recently used evicted)
+PARTITION_CACHE_MB = float(os.environ.get('PARTITION_CACHE_MB', 256))
+# Score view : grid cell size (meters) & shape (see lib/score_grid.py)
+SCORE_GRID_RES = float(os.environ.get('SCORE_GRID_RES', 250))
+SCORE_GRID_KIND = os.environ.get('SCORE_GRID_KIND', 'square')
+
+
+# Metrics served at /metrics (see lib/metrics.py), aggregated across gunicorn workers through METRICS_DIR
+metrics.describe('walkable_phase_seconds', 'histogram', 'Time spent per phase (read_layer, reproject, partition, combine_df, union, clip, figure, update_output, serialize).', metrics.SECONDS_BUCKETS)
+metrics.describe('walkable_request_seconds', 'histogram', 'Time to answer a request, per route.', metrics.SECONDS_BUCKETS)
+metrics.describe('walkable_response_bytes', 'histogram', 'Size of the response body, per route.', metrics.BYTES_BUCKETS)
+metrics.describe('walkable_selection_total', 'counter', 'Elements selected in the map updates, per element.')
+metrics.describe('walkable_figure_cache_total', 'counter', 'Figure cache lookups of the map updates, per view & result (hit or miss).')
+metrics.describe('walkable_partition_cache_total', 'counter', 'Partition cache events of partitioned radius sets, per result (hit, miss or evict).')
 
 
 # Colors & Legend names for plotting
@@ -30,34 +82,599 @@ my_colors = ['blue','orange','green']
 my_names = ['Trails','Buildings','Parks']
 
 
-# Helper function : Combining datasets & setting geometry
-def combine_df(df_list, t_list, b_list, include_parks=True):
-    # Reduce trails dataset - keep true values for the categories
-    df_list[0] = df_list[0].loc[df_list[0][t_list].any(axis='columns')] # reduce trails
-    # Reduce building dataset
-    df_list[1] = df_list[1].loc[df_list[1].NONRES_TYP.isin(b_list)]
-    # Add color columns, reduce to these common columns
-    main_cols = ['id','name','col_grp','grp_name','geometry']
-    for i in range(len(df_list)):
-        df_list[i]['col_grp'] = my_colors[i]
-        df_list[i]['grp_name'] = my_names[i]
-    # Combine same columns
-    if include_parks:
-        out = pd.concat(df_list, ignore_index=True)
+# Helper function : Read a layer's level-of-detail pyramid (see lib/lod_pyramid.py) & reproject once at load time
+#    note: geometries are kept as flat arrays in memory-mapped files shared by the workers (see lib/shared_geometry.py),
+#    read & reprojected only when the files are missing (first start, or new source files)
+def read_layer(buffer_dir, name, col_grp, grp_name):
+    def build():
+        with metrics.span('read_layer'):
+            levels = lod_pyramid.load_pyramid(buffer_dir, name) # NAD 83 geometries, one copy per zoom band
+        for level, gdf in levels.items():
+            with metrics.span('reproject'):
+                levels[level] = gdf.to_crs(epsg=4326) # plotly expects WGS 84 lon/lat
+        return levels
+    levels = shared_geometry.load_levels(buffer_dir, name, build)
+    for df in levels.values():
+        df['col_grp'] = col_grp
+        df['grp_name'] = grp_name
+    return levels
+
+
+# Bring in the buffers datasets (buffer, trail_type, building_type) of one radius set, {zoom level: dataset} each
+#    note: sets are loaded on first use & kept in a bounded LRU cache
+@lru_cache(maxsize=BUFFER_SET_CACHE_SIZE)
+def load_buffer_set(set_dir):
+    buffer_dir = os.path.join(data_dir, set_dir)
+    trail_lod = read_layer(buffer_dir, 'combined_bikeway_buffers', my_colors[0], my_names[0])
+    building_lod = read_layer(buffer_dir, 'combined_building_buffers', my_colors[1], my_names[1])
+    park_lod = read_layer(buffer_dir, 'combined_park_buffers', my_colors[2], my_names[2])
+    return trail_lod, building_lod, park_lod
+
+
+# Radius sets available (see lib/buffer_sets.py), the original 800m / 1000m set is drawn by default
+#    note: DATA_DIR points the app at another data directory (e.g. synthetic data, see lib/benchmark.py)
+#    note: the manifest is read again when it changes, background jobs add sets (see lib/job_queue.py)
+data_dir = os.environ.get('DATA_DIR', 'data')
+
+
+@lru_cache(maxsize=1)
+def read_sets(mtime):
+    return buffer_sets.read_manifest(data_dir) or [{'dir': 'buffers_800t_1000p_1000b', 'trail': 800, 'park': 1000, 'building': 1000}]
+
+
+def current_sets():
+    path = os.path.join(data_dir, buffer_sets.MANIFEST)
+    return read_sets(os.stat(path).st_mtime_ns if os.path.exists(path) else 0)
+
+
+# Partition index of a radius set (see lib/partitions.py), None when the set is read whole
+@lru_cache(maxsize=None)
+def partition_index(set_dir):
+    return partitions.load_index(os.path.join(data_dir, set_dir))
+
+
+partition_cache = partitions.PartitionCache(PARTITION_CACHE_MB * 2**20)
+
+
+# Helper function : Datasets (trails, buildings, parks) of a radius set at a zoom level - for a partitioned set only the
+#    partitions meeting the area (None : all of them), read on first use & kept under PARTITION_CACHE_MB; else the whole set
+def layer_frames(set_dir, level, area=None):
+    index = partition_index(set_dir)
+    if index is None:
+        return [lod[level] for lod in load_buffer_set(set_dir)]
+    before = partition_cache.info()
+    with metrics.span('partition'):
+        frames = partitions.read_area(os.path.join(data_dir, set_dir), index, level, area, partition_cache)
+    after = partition_cache.info()
+    for key, result in [('hits', 'hit'), ('misses', 'miss'), ('evictions', 'evict')]:
+        if after[key] > before[key]:
+            metrics.inc('walkable_partition_cache_total', after[key] - before[key], result=result)
+    out = []
+    for name, col_grp, grp_name in zip(['combined_bikeway_buffers', 'combined_building_buffers', 'combined_park_buffers'], my_colors, my_names):
+        df = frames[name]
+        df['col_grp'] = col_grp
+        df['grp_name'] = grp_name
+        out.append(df)
+    return out
+
+
+# Helper function : Rows of the datasets (trails, buildings, parks) of a radius set, from the partition index (no geometry read) if any
+def layer_rows(set_dir):
+    index = partition_index(set_dir)
+    if index is None:
+        return [lod[lod_pyramid.MAX_LEVEL] for lod in load_buffer_set(set_dir)]
+    return [pd.DataFrame(index['rows'][name]) for name in ['combined_bikeway_buffers', 'combined_building_buffers', 'combined_park_buffers']]
+
+
+radius_sets = current_sets()
+default_set = next((s['dir'] for s in radius_sets if s['dir'] == 'buffers_800t_1000p_1000b'), radius_sets[0]['dir'])
+trail, building, park = layer_rows(default_set)
+
+
+# Helper function : Caption describing the radii of a set
+def radius_caption(set_dir):
+    s = next(s for s in current_sets() if s['dir'] == set_dir)
+    if s['park'] == s['building']:
+        radii = 'Trails are within %d meters, parks and buildings within %d meters.' % (s['trail'], s['park'])
     else:
-        out = pd.concat([df_list[0], df_list[1]], ignore_index=True)
-    # Geometry format
-    out['geometry'] = out['geometry'].apply(str) # ensure str before conversion
-    out['geometry'] = out['geometry'].apply(wkt.loads) # reading from "Well Known Text" format
-    out = gpd.GeoDataFrame(out, crs="epsg:26915").set_geometry('geometry') # setting coordinate reference to NAD 83
+        radii = 'Trails are within %d meters, parks within %d meters and buildings within %d meters.' % (s['trail'], s['park'], s['building'])
+    if s.get('network'):
+        radii = radii[:-1] + ', measured along the trail network.'
+    return 'Find "walkable cities" within the Twin Cities! Overlapping areas of blue (trails), green (parks), and orange (structures) are locations walking distance from all these resources. ' + radii
+
+
+# Regions of the map's region selector (partition index of the default set), the first one is the initial map view
+DEFAULT_REGION = {'name': 'Twin Cities', 'bounds': None, 'center': {"lon": -93.2, "lat": 44.95}, 'zoom': 8}
+regions = (partition_index(default_set) or {}).get('regions') or [DEFAULT_REGION]
+
+
+# Helper function : Region of the selector by name (the first one for None)
+def region_of(name):
+    return next((r for r in regions if r['name'] == name), regions[0])
+
+
+# Helper function : Map style & view of a region, for the figures' mapbox layout
+def region_mapbox(name):
+    r = region_of(name)
+    return {"style": "carto-positron", "center": r['center'], "zoom": r['zoom']}
+
+
+# Initial map view
+default_zoom = regions[0]['zoom']
+default_level = lod_pyramid.level_for_zoom(default_zoom)
+
+
+# Helper function : Combining (already parsed & reprojected) datasets
+def combine_df(df_list, t_list, b_list, include_parks=True):
+    with metrics.span('combine_df'):
+        # Reduce trails dataset - keep true values for the categories
+        df_list[0] = df_list[0].loc[df_list[0][list(t_list)].any(axis='columns')] # reduce trails
+        # Reduce building dataset
+        df_list[1] = df_list[1].loc[df_list[1].NONRES_TYP.isin(b_list)]
+        # Combine same columns
+        if include_parks:
+            out = pd.concat(df_list, ignore_index=True)
+        else:
+            out = pd.concat([df_list[0], df_list[1]], ignore_index=True)
+        return out
+
+
+# Helper function : Normalize a checklist selection so equivalent selections share a cache entry
+def selection_key(trail_l, park_d, building_l):
+    return (tuple(sorted(trail_l or [])), bool(park_d), tuple(sorted(building_l or [])))
+
+
+# Helper function : Zoom level of the pyramid to draw, from the graph's relayoutData (keep current level otherwise)
+def zoom_level(relayout, current_level):
+    if relayout and 'mapbox.zoom' in relayout:
+        return lod_pyramid.level_for_zoom(relayout['mapbox.zoom'])
+    return default_level if current_level is None else current_level
+
+
+# Helper function : Count the elements of a selection (one series per element, not per combination)
+def count_selection(trail_l, park_d, building_l):
+    for element in list(trail_l or []) + (['parks'] if park_d else []) + list(building_l or []):
+        metrics.inc('walkable_selection_total', element=element)
+
+
+# Helper function : Call a cached figure builder, counting cache hits & misses per view
+def cached_figure(builder, view, *args):
+    misses = builder.cache_info().misses
+    plty = builder(*args)
+    metrics.inc('walkable_figure_cache_total', view=view, result='miss' if builder.cache_info().misses > misses else 'hit')
+    return plty
+
+
+# Helper function : Time a callback into the update_output phase (its time is kept on the request, see record_request)
+def timed_callback(func):
+    @wraps(func)
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            metrics.observe('walkable_phase_seconds', elapsed, phase='update_output')
+            if flask.has_request_context():
+                flask.g.callback_seconds = elapsed
+    return timed
+
+
+# Helper function : Whether the running callback was triggered by one of these components (False outside of callbacks)
+def triggered_by(*component_ids):
+    try:
+        return dash.callback_context.triggered_id in component_ids
+    except MissingCallbackContextException:
+        return False
+
+
+# Bounds of a radius set's data (lon/lat), areas covering them are sent unclipped
+@lru_cache(maxsize=BUFFER_SET_CACHE_SIZE)
+def data_extent(set_dir):
+    index = partition_index(set_dir)
+    if index is not None:
+        return tuple(index['bounds'])
+    return viewport.frame_bounds(pd.concat([lod[lod_pyramid.MAX_LEVEL] for lod in load_buffer_set(set_dir)]))
+
+
+# Union tree of a layer's uncombined buffers (see lib/union_tree.py) : precomputed files if present (python3 lib/union_tree.py),
+#    else built from the layer's *_buffers file, None without one (no attribute filters for that layer)
+@lru_cache(maxsize=2 * BUFFER_SET_CACHE_SIZE)
+def union_tree_for(set_dir, name):
+    buffer_dir = os.path.join(data_dir, set_dir)
+    try:
+        return union_tree.load_tree(buffer_dir, name)
+    except FileNotFoundError:
+        pass
+    try:
+        gdf = geostore.read_layer(geostore.find_layer(buffer_dir, name + '_buffers'))
+    except FileNotFoundError:
+        return None
+    return union_tree.build_tree(gdf, union_tree.GROUP_COLUMNS[name])
+
+
+# Union of a layer's buffers matching attribute filters ((column, values) pairs), full resolution in the layer's CRS
+@lru_cache(maxsize=FIGURE_CACHE_SIZE)
+def filtered_union(set_dir, name, filters):
+    tree = union_tree_for(set_dir, name)
+    selected = np.ones(len(tree['leaves']), dtype=bool)
+    for column, values in filters:
+        selected &= tree['leaves'][column].isin(values).values
+    return union_tree.subset_union(tree, selected)
+
+
+# Helper function : One frame row (as in load_buffer_set) with the union of a layer's filtered buffers at a zoom level,
+#    None when the set has no union tree for the layer
+def filtered_frame(set_dir, name, filters, level, col_grp, grp_name):
+    tree = union_tree_for(set_dir, name)
+    if tree is None:
+        return None
+    with metrics.span('union'):
+        gdf = gpd.GeoDataFrame({'col_grp': [col_grp], 'grp_name': [grp_name]}, geometry=[filtered_union(set_dir, name, filters)], crs=tree['leaves'].crs)
+    gdf = lod_pyramid.simplify_layer(gdf, dict(lod_pyramid.ZOOM_BANDS)[level]).to_crs(epsg=4326)
+    out = pd.DataFrame(gdf.drop(columns='geometry'))
+    out['shapes'] = [shared_geometry.PackedGeometry.from_geoms(gdf.geometry.values)]
+    out['shape_i'] = [0]
     return out
 
 
+# Helper function : Normalize attribute filters ((column, selected values) pairs) so equivalent filters share a cache entry
+def filter_key(*pairs):
+    return tuple((column, tuple(sorted(values))) for column, values in pairs if values)
+
+
+# Helper function : Figure as sent to the browser - as is, or (WIRE_FORMAT=topojson) without the traces' geometry,
+#    which travels once as a topology of the rows (geometry ids : ids), decoded & attached by assets/client_layers.js
+def wire_figure(plty, rows, ids):
+    if WIRE_FORMAT != 'topojson':
+        return plty
+    figure = plty.to_plotly_json()
+    for trace in figure['data']:
+        trace.pop('geojson', None)
+    topology = topojson_wire.encode(list(zip(rows['shapes'], rows['shape_i'])), ids, TOPOJSON_PRECISION)
+    return {'figure': figure, 'topology': topology}
+
+
+# Helper function : Build the map figure for a (normalized) selection & zoom level, memoized in a bounded LRU cache
+#    note: hit/miss counters available through build_figure.cache_info()
+#    note: area is the part of the map to send (see lib/viewport.py), None for everything
+#    note: building_f & park_f are attribute filters (see filter_key), the layer is then drawn from its union tree
+@lru_cache(maxsize=FIGURE_CACHE_SIZE)
+def build_figure(trail_k, park_k, building_k, level=default_level, set_dir=default_set, area=None, building_f=(), park_f=(), region=None):
+    # dataframe to be plotted - intersections of the contents we have added via dropdown/checklists
+    combined = combine_df(layer_frames(set_dir, level, area), trail_k, building_k, park_k)
+
+    # attribute filters : the layer becomes one row, the union of its matching buffers (trails, buildings, parks order kept)
+    if building_f or park_f:
+        frames = {grp: combined.loc[combined.grp_name == grp] for grp in my_names}
+        if building_f and building_k:
+            frames[my_names[1]] = filtered_frame(set_dir, 'buildings', (('NONRES_TYP', building_k),) + building_f, level, my_colors[1], my_names[1])
+        if park_f and park_k:
+            frames[my_names[2]] = filtered_frame(set_dir, 'parks', park_f, level, my_colors[2], my_names[2])
+        combined = pd.concat([frames[grp] if frames[grp] is not None else combined.loc[combined.grp_name == grp] for grp in my_names], ignore_index=True)
+    with metrics.span('clip'):
+        combined = viewport.clip_frame(combined, area)
+
+    # plotly choropleth graph
+    with metrics.span('figure'):
+        plty = px.choropleth_mapbox(
+            geojson = shared_geometry.feature_collection(combined if WIRE_FORMAT == 'geojson' else combined.iloc[:0]),
+            locations = combined.index,
+            color = combined['grp_name'],
+            color_discrete_sequence = my_colors,
+            opacity = 0.2
+        ).update_layout(
+            mapbox = region_mapbox(region),
+            uirevision = region_of(region)['name'], # keep the user's pan/zoom when the figure is swapped for another level (not another region)
+            hovermode = False
+        ).update_traces(marker_line_width=0)
+        plty = wire_figure(plty, combined, combined.index.tolist())
+    return plty
+
+
+# Helper function : Build the vector tile map figure for a (normalized) selection - one mapbox layer per selected group
+@lru_cache(maxsize=FIGURE_CACHE_SIZE)
+def build_tile_figure(trail_k, park_k, building_k, host_url='/', set_dir=default_set, region=None):
+    groups = [('bikeway', name, my_colors[0]) for name in trail.loc[trail[list(trail_k)].any(axis='columns'), 'name']]
+    groups += [('building', name, my_colors[1]) for name in building.loc[building.NONRES_TYP.isin(building_k), 'name']]
+    groups += [('park', name, my_colors[2]) for name in park['name']] if park_k else []
+    layers = [{'sourcetype': 'vector', 'source': [host_url + 'tiles/%s/{z}/{x}/{y}.mvt?set=%s' % (layer, set_dir)], 'sourcelayer': str(name),
+               'type': 'fill', 'color': color, 'opacity': 0.2} for layer, name, color in groups]
+
+    # empty trace for the map itself, geometry comes from the tile layers
+    plty = go.Figure(go.Scattermapbox(lat=[], lon=[])).update_layout(
+        mapbox = {**region_mapbox(region), "layers": layers},
+        uirevision = region_of(region)['name'],
+        hovermode = False
+    )
+    return plty
+
+
+# Helper function : Build the client-side map figure for a zoom level - every group as its own trace, all selections at once
+#    note: traces carry meta = {group, classes | type}, read by assets/client_layers.js to toggle their visibility
+@lru_cache(maxsize=FIGURE_CACHE_SIZE)
+def build_client_figure(level=default_level, set_dir=default_set, area=None, building_f=(), park_f=(), region=None):
+    trails, buildings, parks = layer_frames(set_dir, level, area)
+    trail_cols = ['SEP_BIKE_TRL', 'NONSEP_BIKE_TRL', 'WALK_TRL']
+    groups = [(row, {'group': 'trail', 'classes': [c for c in trail_cols if row[c]]}) for _, row in trails.iterrows()]
+    building_rows = [(row, row['NONRES_TYP']) for _, row in buildings.iterrows()]
+    park_rows = [row for _, row in parks.iterrows()]
+
+    # attribute filters : each building type's row becomes the union of its matching buffers, the parks one row
+    if building_f:
+        filtered = [(filtered_frame(set_dir, 'buildings', (('NONRES_TYP', (typ,)),) + building_f, level, row['col_grp'], row['grp_name']), typ)
+                    for row, typ in building_rows]
+        if all(df is not None for df, _ in filtered):
+            building_rows = [(df.iloc[0], typ) for df, typ in filtered]
+    if park_f:
+        filtered = filtered_frame(set_dir, 'parks', park_f, level, my_colors[2], my_names[2])
+        if filtered is not None:
+            park_rows = [filtered.iloc[0]]
+    groups += [(row, {'group': 'building', 'type': typ}) for row, typ in building_rows]
+    groups += [(row, {'group': 'park'}) for row in park_rows]
+    with metrics.span('clip'):
+        clipped = viewport.clip_frame(pd.DataFrame([row for row, _ in groups]).reset_index(drop=True), area)
+    groups = [(row, meta) for (_, row), (_, meta) in zip(clipped.iterrows(), groups)]
+    groups = [(row, meta) for row, meta in groups if row['shapes'].num_coordinates(row['shape_i'])]
+
+    with metrics.span('figure'):
+        traces = [go.Choroplethmapbox(
+            geojson = {'type': 'FeatureCollection', 'features': [{'type': 'Feature', 'id': str(k), 'properties': {}, 'geometry': row['shapes'].geojson(row['shape_i'])}]}
+                      if WIRE_FORMAT == 'geojson' else None,
+            locations = [str(k)], z = [1],
+            colorscale = [[0, row['col_grp']], [1, row['col_grp']]], showscale = False,
+            marker_opacity = 0.2, marker_line_width = 0,
+            name = row['grp_name'], legendgroup = row['grp_name'], meta = meta, hoverinfo = 'skip'
+        ) for k, (row, meta) in enumerate(groups)]
+        plty = go.Figure(traces).update_layout(
+            mapbox = region_mapbox(region),
+            uirevision = region_of(region)['name'],
+            hovermode = False
+        )
+        plty = wire_figure(plty, pd.DataFrame([row for row, _ in groups]), [str(k) for k in range(len(groups))])
+    return plty
+
+
+# Vector tile layers of a radius set (parsed on first tile request)
+@lru_cache(maxsize=BUFFER_SET_CACHE_SIZE)
+def tile_layers(set_dir):
+    return vector_tiles.load_tile_layers(os.path.join(data_dir, set_dir))
+
+
+# Point query index of a radius set ("what is walkable from here?"), default set built at startup unless partitioned
+@lru_cache(maxsize=BUFFER_SET_CACHE_SIZE)
+def point_index(set_dir):
+    trail_lod, building_lod, park_lod = load_buffer_set(set_dir)
+    layers = [shared_geometry.to_geodataframe(lod[lod_pyramid.MAX_LEVEL]) for lod in [trail_lod, park_lod, building_lod]]
+    return point_query.build_index(*layers)
+if partition_index(default_set) is None:
+    point_index(default_set)
+
+
+# Helper function : Python API for point queries, points as [[lon, lat], ...] in EPSG:4326
+def walkable_from(points, set_dir=default_set):
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    return point_query.query_points(point_index(set_dir), points[:, 0], points[:, 1])
+
+
+# Score grid of a radius set : precomputed file if present (python3 lib/score_grid.py), else built from the point index
+@lru_cache(maxsize=BUFFER_SET_CACHE_SIZE)
+def score_grid_for(set_dir):
+    path = score_grid.grid_path(os.path.join(data_dir, set_dir), SCORE_GRID_RES, SCORE_GRID_KIND)
+    if os.path.exists(path):
+        return score_grid.load_grid(path)
+    trail_lod, building_lod, park_lod = load_buffer_set(set_dir)
+    layers = [shared_geometry.to_geodataframe(lod[lod_pyramid.MAX_LEVEL]) for lod in [trail_lod, park_lod, building_lod]]
+    return score_grid.build_grid(point_index(set_dir), layers, SCORE_GRID_RES, SCORE_GRID_KIND)
+
+
+# Planar overlay of a radius set (faces & layer bitmasks) : precomputed file if present (python3 lib/overlay.py), else built
+#    from the full resolution combined buffers in their projected CRS
+@lru_cache(maxsize=BUFFER_SET_CACHE_SIZE)
+def overlay_for(set_dir):
+    buffer_dir = os.path.join(data_dir, set_dir)
+    path = overlay.overlay_path(buffer_dir)
+    if os.path.exists(path):
+        return overlay.load_overlay(path)
+    layers = [geostore.read_layer(geostore.find_layer(buffer_dir, name)) for name in ['combined_bikeway_buffers', 'combined_park_buffers', 'combined_building_buffers']]
+    return overlay.build_overlay(*layers)
+
+
+# Helper function : Build the "within reach of all" figure for a (normalized) selection & zoom level - the faces of the overlay
+#    covered by every selected category, dissolved into one region (no polygon boolean operations, see lib/overlay.py)
+@lru_cache(maxsize=FIGURE_CACHE_SIZE)
+def build_reach_figure(trail_k, park_k, building_k, level=default_level, set_dir=default_set, area=None, region=None):
+    planar = overlay_for(set_dir)
+    with metrics.span('figure'):
+        faces = overlay.select_faces(planar, score_grid.selection_masks(planar, trail_k, park_k, building_k), area)
+        reach = pd.DataFrame({'shapes': [viewport.pack_polygons([overlay.dissolve(planar, faces, level)])], 'shape_i': [0]})
+        plty = go.Figure(go.Choroplethmapbox(
+            geojson = shared_geometry.feature_collection(reach) if WIRE_FORMAT == 'geojson' else None,
+            locations = [0], z = [1],
+            colorscale = [[0, 'purple'], [1, 'purple']], showscale = False,
+            marker_opacity = 0.4, marker_line_width = 0,
+            name = 'Within reach of all selected', hoverinfo = 'skip'
+        )).update_layout(
+            mapbox = region_mapbox(region),
+            uirevision = region_of(region)['name'],
+            hovermode = False
+        )
+        plty = wire_figure(plty, reach, [0])
+    return plty
+
+
+# Helper function : Build the score map figure for a (normalized) selection - number of selected categories within reach per cell
+@lru_cache(maxsize=FIGURE_CACHE_SIZE)
+def build_score_figure(trail_k, park_k, building_k, set_dir=default_set, region=None):
+    grid = score_grid_for(set_dir)
+    score = score_grid.selection_score(grid, trail_k, park_k, building_k)
+    max_score = len(score_grid.selection_masks(grid, trail_k, park_k, building_k))
+    mapbox = region_mapbox(region)
+
+    if grid['kind'] == 'square':
+        # one image layer for the whole grid, empty trace for the map itself
+        source, corners = score_grid.score_image(grid, score, max_score)
+        mapbox['layers'] = [{'sourcetype': 'image', 'source': source, 'coordinates': corners, 'below': 'traces'}]
+        trace = go.Scattermapbox(lat=[], lon=[])
+    else:
+        # one marker per covered hex cell
+        keep = score > 0
+        trace = go.Scattermapbox(lon=grid['lon'][keep], lat=grid['lat'][keep], mode='markers', hoverinfo='skip',
+                                 marker={'color': score[keep], 'cmin': 0, 'cmax': max(max_score, 1), 'colorscale': 'YlOrRd', 'opacity': 0.6})
+
+    plty = go.Figure(trace).update_layout(
+        mapbox = mapbox,
+        uirevision = region_of(region)['name'],
+        hovermode = False
+    )
+    return plty
+
+
+# Most common selections (app default first), used to warm the figure cache at boot
+common_selections = [
+    (['SEP_BIKE_TRL','WALK_TRL'], True, ['Grocery','Eating and Drinking Establishments']),
+    (['SEP_BIKE_TRL','NONSEP_BIKE_TRL','WALK_TRL'], True, ['Grocery','Eating and Drinking Establishments']),
+    (['SEP_BIKE_TRL','WALK_TRL'], False, ['Grocery','Eating and Drinking Establishments']),
+    (['SEP_BIKE_TRL','WALK_TRL'], True, ['Grocery']),
+    (['SEP_BIKE_TRL','WALK_TRL'], True, ['Grocery','Eating and Drinking Establishments','Schools']),
+    (['SEP_BIKE_TRL','WALK_TRL'], True, ['Grocery','Eating and Drinking Establishments','Medical Facilities']),
+    (['SEP_BIKE_TRL','WALK_TRL'], True, ['Grocery','Eating and Drinking Establishments','Transit']),
+    (['SEP_BIKE_TRL','WALK_TRL'], True, []),
+    (['SEP_BIKE_TRL','NONSEP_BIKE_TRL','WALK_TRL'], True, list(building.NONRES_TYP.unique())),
+]
+for sel in common_selections[:min(WARM_FIGURE_CACHE, FIGURE_CACHE_SIZE)]:
+    build_figure(*selection_key(*sel))
+
+
 # Initiate the Dash app & server
 app = dash.Dash(__name__, external_stylesheets=external_stylesheet)
 server = app.server
 
 
+# Request timing & sizes per route (route patterns, not paths, to keep the label set small)
+@server.before_request
+def start_request():
+    flask.g.request_start = time.perf_counter()
+    metrics.start_profiler()  # no-op unless PROFILE_SAMPLE_HZ is set, started once per worker
+    metrics.request_started()
+
+
+@server.after_request
+def record_request(response):
+    route = flask.request.url_rule.rule if flask.request.url_rule else 'other'
+    elapsed = time.perf_counter() - flask.g.request_start
+    metrics.observe('walkable_request_seconds', elapsed, route=route)
+    if not response.direct_passthrough:
+        metrics.observe('walkable_response_bytes', response.calculate_content_length() or 0, route=route)
+    if 'callback_seconds' in flask.g:
+        # rest of a callback request : decoding the inputs, encoding the figure as JSON
+        metrics.observe('walkable_phase_seconds', elapsed - flask.g.callback_seconds, phase='serialize')
+    return response
+
+
+# Compressed responses (RESPONSE_COMPRESSION), registered after record_request so the sizes recorded are the ones sent
+COMPRESSED_TYPES = {'application/json', 'text/html', 'text/plain', 'text/css', 'application/javascript', 'application/vnd.mapbox-vector-tile'}
+
+
+@server.after_request
+def compress_response(response):
+    if (RESPONSE_COMPRESSION == 'off' or response.direct_passthrough or response.status_code != 200
+            or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESSED_TYPES):
+        return response
+    data = response.get_data()
+    if len(data) < 1000:
+        return response
+    accepted = flask.request.accept_encodings
+    if RESPONSE_COMPRESSION == 'br' and brotli is not None and 'br' in accepted:
+        response.set_data(brotli.compress(data, quality=5))
+        response.headers['Content-Encoding'] = 'br'
+    elif 'gzip' in accepted:
+        response.set_data(gzip.compress(data, compresslevel=6))
+        response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+@server.teardown_request
+def end_request(exc):
+    metrics.request_finished()
+
+
+# Metrics of every worker, Prometheus text format
+@server.route('/metrics')
+def serve_metrics():
+    return flask.Response(metrics.exposition(), mimetype='text/plain; version=0.0.4')
+
+
+# Sampled stacks of every worker (collapsed, flame graph input), when started with PROFILE_SAMPLE_HZ
+@server.route('/metrics/profile')
+def serve_profile():
+    if metrics.PROFILE_SAMPLE_HZ <= 0:
+        flask.abort(404)
+    return flask.Response(metrics.profile_text(), mimetype='text/plain')
+
+
+# Vector tiles for the buffer layers, cached on disk by content address & cacheable by browsers / CDNs
+@server.route('/tiles/<layer>/<int:z>/<int:x>/<int:y>.mvt')
+def serve_tile(layer, z, x, y):
+    set_dir = flask.request.args.get('set', default_set)
+    if layer not in vector_tiles.TILE_LAYERS or set_dir not in [s['dir'] for s in current_sets()]:
+        flask.abort(404)
+    data, key = vector_tiles.get_tile(tile_layers(set_dir), TILE_CACHE_DIR, layer, z, x, y)
+    if flask.request.if_none_match.contains(key):
+        return flask.Response(status=304)
+    response = flask.Response(data, mimetype='application/vnd.mapbox-vector-tile')
+    response.set_etag(key)
+    response.headers['Cache-Control'] = 'public, max-age=86400'
+    return response
+
+
+# Point queries as JSON : GET ?lon=&lat= for one point, POST {"points": [[lon, lat], ...]} for a batch (optional "set")
+@server.route('/api/walkable', methods=['GET', 'POST'])
+def serve_walkable():
+    if flask.request.method == 'POST':
+        body = flask.request.get_json(silent=True) or {}
+        points, set_dir = body.get('points'), body.get('set', default_set)
+    else:
+        points, set_dir = [[flask.request.args.get('lon'), flask.request.args.get('lat')]], flask.request.args.get('set', default_set)
+    if set_dir not in [s['dir'] for s in current_sets()]:
+        return flask.jsonify({'error': 'unknown set %r' % set_dir}), 400
+    try:
+        points = np.asarray(points, dtype=float)
+        assert points.ndim == 2 and points.shape[1] == 2 and np.isfinite(points).all()
+    except (ValueError, TypeError, AssertionError):
+        return flask.jsonify({'error': 'points must be [[lon, lat], ...] (or ?lon=&lat=)'}), 400
+    return flask.jsonify({'set': set_dir, 'results': walkable_from(points, set_dir)})
+
+
+# Helper function : Dropdown options of an attribute filter, values of a column of the default set's union tree (none without one)
+def filter_options(name, column):
+    index = partition_index(default_set)
+    if index is not None:
+        return [{'label': v, 'value': v} for v in index['filters'].get(name, {}).get(column, [])]
+    tree = union_tree_for(default_set, name)
+    if tree is None or column not in tree['leaves']:
+        return []
+    return [{'label': v, 'value': v} for v in sorted(tree['leaves'][column].dropna().unique())]
+
+
+# Attribute filters of the layers view (changing them redraws nothing in the other views)
+#    note: disabled with MAP_MODE=tiles, the tiles are cut from the unfiltered rows
+filter_ids = ('building_names', 'building_descs', 'park_names')
+filter_options_of = {'building_names': filter_options('buildings', 'name'), 'building_descs': filter_options('buildings', 'BLDG_DESC'),
+                     'park_names': filter_options('parks', 'name')} if MAP_MODE != 'tiles' else {f: [] for f in filter_ids}
+
+
+# Helper function : Walking distance slider labels, one per radius set
+def radius_marks(sets):
+    return {i: (('%d m' % s['trail']) if s['trail'] == s['park'] == s['building'] else '%d / %d m' % (s['trail'], s['park']))
+               + (' network' if s.get('network') else '') for i, s in enumerate(sets)}
+
+
+# Figures drawn from the client_figure store rather than sent to the graph
+figure_in_store = MAP_MODE == 'client' or WIRE_FORMAT == 'topojson'
+
+
 # Organize the Dash app
 app.layout = html.Div([
     html.H2('My Walkable / Bikeable City'),
@@ -83,6 +700,10 @@ app.layout = html.Div([
                 {'label': 'No', 'value': False}], # make the label and value identical to the column names
                 value=True # default value
             ),
+            dcc.Dropdown(   # park_names
+                id='park_names', options=filter_options_of['park_names'], disabled=not filter_options_of['park_names'],
+                multi=True, placeholder='Only these parks (Layers view)'
+            ),
             html.Br(), 
             
             html.Label('Buildings:'),   # building_list
@@ -91,12 +712,57 @@ app.layout = html.Div([
                 options=[{'label': x, 'value': x} for x in building.NONRES_TYP.unique()],
                 value=['Grocery','Eating and Drinking Establishments']
             ),
+            dcc.Dropdown(   # building_names
+                id='building_names', options=filter_options_of['building_names'], disabled=not filter_options_of['building_names'],
+                multi=True, placeholder='Only these names (Layers view)'
+            ),
+            dcc.Dropdown(   # building_descs
+                id='building_descs', options=filter_options_of['building_descs'], disabled=not filter_options_of['building_descs'],
+                multi=True, placeholder='Only these descriptions (Layers view)'
+            ),
+            html.Br(),
+
+            html.Label('Walking distance:'),   # radius_slider
+            dcc.Slider(
+                id='radius_slider',
+                min=0, max=len(radius_sets) - 1, step=None,
+                marks=radius_marks(radius_sets),
+                value=[s['dir'] for s in radius_sets].index(default_set)
+            ),
+            dcc.Store(id='radius_dirs', data=[s['dir'] for s in radius_sets]),   # set of each slider position
+            html.Br(),
+
+            html.Label('New walking distance (trails / parks / buildings, meters):'),   # job panel
+            html.Div([
+                dcc.Input(id='job_trail', type='number', min=50, max=5000, step=50, value=400, style={'width': '25%'}),
+                dcc.Input(id='job_park', type='number', min=50, max=5000, step=50, value=800, style={'width': '25%'}),
+                dcc.Input(id='job_building', type='number', min=50, max=5000, step=50, value=800, style={'width': '25%'}),
+                html.Button('Build', id='job_submit'),
+            ]),
+            html.Div(id='job_status'),
+            dcc.Interval(id='job_poll', interval=2000, disabled=True),
+            dcc.Store(id='job_states'),   # {job id: status} of the jobs submitted from this page
         ], className="six columns"),
         
         html.Div([
             html.H3('Minneapolis / St. Paul Walkable Areas'),
+            dcc.Dropdown(   # region
+                id='region', options=[{'label': r['name'], 'value': r['name']} for r in regions], value=regions[0]['name'],
+                clearable=False, style={} if len(regions) > 1 else {'display': 'none'}
+            ),
+            dcc.RadioItems(   # map_view
+                id='map_view',
+                options=[{'label': 'Layers', 'value': 'layers'},
+                {'label': 'Score (number of selected elements within reach)', 'value': 'score'},
+                {'label': 'Within reach of all selected', 'value': 'reach'}],
+                value='layers',
+                inline=True
+            ),
             dcc.Graph(id='map_graph'),
-            html.P('Find "walkable cities" within the Twin Cities! Overlapping areas of blue (trails), green (parks), and orange (structures) are locations walking distance from all these resources. Trails are within 800 meters, parks and buildings within 1000 meters.')
+            dcc.Store(id='lod_level', data=default_level),
+            dcc.Store(id='view_bbox'),   # area of the map sent with the current figure, None for everything
+            dcc.Store(id='client_figure'),   # figure drawn in the browser (MAP_MODE=client, WIRE_FORMAT=topojson)
+            html.P(radius_caption(default_set), id='caption')
         ], className="six columns", style={"border":"2px black solid",'padding': '10px'})
     
     ], className="row")
@@ -104,32 +770,82 @@ app.layout = html.Div([
 
 
 # Create our figure given provided information
+#    note: with MAP_MODE=client or WIRE_FORMAT=topojson the figure goes to the client_figure store, drawn by the clientside callback below
 @app.callback(
-    Output('map_graph', 'figure'),
+    Output('client_figure', 'data') if figure_in_store else Output('map_graph', 'figure'),
+    Output('lod_level', 'data'),
+    Output('caption', 'children'),
+    Output('view_bbox', 'data'),
     Input('trail_list', 'value'),
     Input('park_drop', 'value'),
-    Input('building_list', 'value'))
+    Input('building_list', 'value'),
+    Input('map_graph', 'relayoutData'),
+    Input('radius_slider', 'value'),
+    Input('map_view', 'value'),
+    Input('building_names', 'value'),
+    Input('building_descs', 'value'),
+    Input('park_names', 'value'),
+    Input('region', 'value'),
+    State('lod_level', 'data'),
+    State('view_bbox', 'data'),
+    State('radius_dirs', 'data'))
 
 # Plotting and combining datasets
-def update_output(trail_l, park_d, building_l):
-    # dataframe to be plotted - intersections of the contents we have added via dropdown/checklists
-    combined = combine_df([trail, building, park], trail_l, building_l, park_d)
-    combined = combined.reset_index()
-    combined.to_crs(epsg=4326, inplace=True)
+@timed_callback
+def update_output(trail_l, park_d, building_l, relayout=None, radius_i=None, view='layers', building_names=None, building_descs=None, park_names=None,
+                  region=None, current_level=None, current_area=None, radius_dirs=None):
+    # radius set chosen on the slider
+    set_dir = default_set if radius_i is None else (radius_dirs or [s['dir'] for s in current_sets()])[radius_i]
 
+    # score view : one precomputed grid, a selection is a few bitwise operations - nothing to redo on pan/zoom
+    if view == 'score':
+        if triggered_by('map_graph', *filter_ids):
+            raise PreventUpdate
+        count_selection(trail_l, park_d, building_l)
+        return cached_figure(build_score_figure, 'score', *selection_key(trail_l, park_d, building_l), set_dir, region), current_level, radius_caption(set_dir), current_area
+
+    # vector tiles : the browser fetches tiles for the viewport itself, only a new selection needs a new figure
+    if MAP_MODE == 'tiles' and view == 'layers':
+        if triggered_by('map_graph', *filter_ids):
+            raise PreventUpdate
+        host_url = flask.request.host_url if flask.has_request_context() else '/'
+        count_selection(trail_l, park_d, building_l)
+        return cached_figure(build_tile_figure, 'tiles', *selection_key(trail_l, park_d, building_l), host_url, set_dir, region), current_level, radius_caption(set_dir), current_area
+
+    # level of detail for the current zoom - panning or zooming within a band & the area already sent keeps the figure
+    #    note: the first figure & a region just chosen are drawn for the region's view (only its partitions are read)
+    if triggered_by('region') or relayout is None:
+        level, view_box = lod_pyramid.level_for_zoom(region_of(region)['zoom']), region_of(region)['bounds']
+    else:
+        level, view_box = zoom_level(relayout, current_level), viewport.view_bounds(relayout)
+    if triggered_by('map_graph') and level == current_level and (view_box is None or viewport.covers(current_area, view_box)):
+        raise PreventUpdate
+
+    # area to send : the view plus a margin, snapped to the level's tile grid (None : everything)
+    area = current_area if view_box is None else viewport.fetch_bounds(view_box, level, data_extent(set_dir))
+    area = tuple(area) if area else None
+
+    # within reach of all : overlay faces of the selection near the area, dissolved (one figure per selection, level & area)
+    if view == 'reach':
+        if triggered_by(*filter_ids):
+            raise PreventUpdate
+        count_selection(trail_l, park_d, building_l)
+        return cached_figure(build_reach_figure, 'reach', *selection_key(trail_l, park_d, building_l), level, set_dir, area, region), level, radius_caption(set_dir), area
+
+    # client-side layers : one figure per level & radius set, a new selection is only a visibility toggle in the browser
+    if MAP_MODE == 'client':
+        if triggered_by('trail_list', 'park_drop', 'building_list'):
+            raise PreventUpdate
+        building_f = filter_key(('name', building_names), ('BLDG_DESC', building_descs))
+        park_f = filter_key(('name', park_names))
+        return cached_figure(build_client_figure, 'client', level, set_dir, area, building_f, park_f, region), level, radius_caption(set_dir), area
+
+    # figure for this selection & level - built once, then served from the LRU cache
+    count_selection(trail_l, park_d, building_l)
+    building_f = filter_key(('name', building_names), ('BLDG_DESC', building_descs))
+    park_f = filter_key(('name', park_names))
+    plty = cached_figure(build_figure, 'layers', *selection_key(trail_l, park_d, building_l), level, set_dir, area, building_f, park_f, region)
 
-    # plotly choropleth graph
-    plty = px.choropleth_mapbox(
-        geojson = combined['geometry'],
-        locations = combined.index,
-        color = combined['grp_name'],
-        color_discrete_sequence = my_colors,
-        opacity = 0.2
-    ).update_layout(
-        mapbox = {"style": "carto-positron", "center": {"lon": -93.2, "lat": 44.95}, "zoom": 8},
-        hovermode = False
-    ).update_traces(marker_line_width=0)
-    
     # OLD : generate figure with matplotlib (slow on Dash)
     # my_legend = [Line2D([0], [0], color=my_colors[i], lw=4) for i in range(len(my_colors))]
     # fig, ax = plt.subplots()
@@ -138,10 +854,76 @@ def update_output(trail_l, park_d, building_l):
     # cx.add_basemap(ax, crs=combined.crs, source=cx.providers.CartoDB.Positron)
     # plt.title('Twin Cities Areas Meeting Criteria')
 
-    # return the figure
-    return plty
+    # return the figure (and the level & area now drawn)
+    return plty, level, radius_caption(set_dir), area
+
+
+# Figure of the store : decode its geometry & apply the selection to the layer traces (assets/client_layers.js)
+if figure_in_store:
+    app.clientside_callback(
+        ClientsideFunction(namespace='walkable', function_name='toggle_layers'),
+        Output('map_graph', 'figure'),
+        Input('client_figure', 'data'),
+        Input('trail_list', 'value'),
+        Input('park_drop', 'value'),
+        Input('building_list', 'value'))
+
+
+# Background jobs (lib/job_queue.py) : a new walking distance is queued for the job runner, the panel polls the jobs
+#    submitted from the page while any is pending, & a set just built is added to the slider and selected
+@app.callback(
+    Output('job_status', 'children'),
+    Output('job_poll', 'disabled'),
+    Output('job_states', 'data'),
+    Output('radius_slider', 'marks'),
+    Output('radius_slider', 'max'),
+    Output('radius_slider', 'value'),
+    Output('radius_dirs', 'data'),
+    Input('job_submit', 'n_clicks'),
+    Input('job_poll', 'n_intervals'),
+    State('job_trail', 'value'),
+    State('job_park', 'value'),
+    State('job_building', 'value'),
+    State('job_states', 'data'),
+    State('radius_slider', 'value'),
+    State('radius_dirs', 'data'),
+    prevent_initial_call=True)
+def update_jobs(n_clicks, n_intervals, trail_r, park_r, building_r, job_states, radius_i, radius_dirs):
+    job_states = dict(job_states or {})
+    notes = []
+    if triggered_by('job_submit'):
+        radii = [trail_r, park_r, building_r]
+        if all(isinstance(r, (int, float)) and 0 < r <= 5000 for r in radii):
+            job_id = job_queue.submit(data_dir, 'radius_set', dict(zip(['trail', 'park', 'building'], [int(r) for r in radii])))
+            job_states.setdefault(str(job_id), 'submitted')
+        else:
+            notes.append(html.Li('Walking distances must be between 1 and 5000 meters.'))
+
+    # progress of this page's jobs, sets built since the last look
+    jobs = job_queue.list_jobs(data_dir, [int(i) for i in job_states])
+    built = [j['result']['set'] for j in jobs if j['status'] == 'done' and job_states.get(str(j['id'])) != 'done']
+    for j in jobs:
+        p = j['params']
+        state = {'queued': 'waiting', 'running': 'running %d%% %s' % (j['progress'] * 100, j['message']), 'done': 'ready',
+                 'failed': 'failed (%s)' % j['message']}[j['status']]
+        notes.append(html.Li('%d / %d / %d m : %s' % (p['trail'], p['park'], p['building'], state)))
+        job_states[str(j['id'])] = j['status']
+    pending = any(j['status'] in ('queued', 'running') for j in jobs)
+
+    # slider : the selected set kept (positions move as sets are added), or the set just built
+    dirs = [s['dir'] for s in current_sets()]
+    selected = built[-1] if built and built[-1] in dirs else (radius_dirs or dirs)[radius_i or 0]
+    if dirs == radius_dirs and not built:
+        slider = [dash.no_update] * 4
+    else:
+        slider = [radius_marks(current_sets()), len(dirs) - 1, dirs.index(selected) if selected in dirs else 0, dirs]
+    return html.Ul(notes), not pending, job_states, *slider
 
 
-# Run the server
+# Run the server (& a job runner next to it)
 if __name__ == '__main__':
-    app.run_server(debug=False)
+    runner = job_queue.start_runner(data_dir)
+    try:
+        app.run_server(debug=False)
+    finally:
+        runner.terminate()
@@ -0,0 +1,55 @@
+/*
+ * Map figure drawn in the browser from the figure store : geometry sent as a topology (WIRE_FORMAT=topojson) is decoded
+ * once per figure (assets/topojson.js), then with MAP_MODE=client the selection is applied by flipping the visibility of
+ * the layer traces, tagged with meta = {group, classes | type} - no request to the server.
+ */
+var decodedFigures = new WeakMap();
+
+// figure of the store, choropleth traces without geometry get the decoded topology (shared by all of them)
+function storedFigure(stored) {
+    if (!stored.topology) {
+        return stored;
+    }
+    if (!decodedFigures.has(stored)) {
+        var geojson = window.walkableTopojson.decode(stored.topology);
+        var data = stored.figure.data.map(function(trace) {
+            return trace.type === 'choroplethmapbox' && !trace.geojson ? Object.assign({}, trace, {geojson: geojson}) : trace;
+        });
+        decodedFigures.set(stored, Object.assign({}, stored.figure, {data: data}));
+    }
+    return decodedFigures.get(stored);
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    walkable: {
+        toggle_layers: function(stored, trails, parks, buildings) {
+            if (!stored) {
+                return window.dash_clientside.no_update;
+            }
+            var figure = storedFigure(stored);
+            trails = trails || [];
+            buildings = buildings || [];
+            var legend = {};  // one legend entry per group (its first visible trace)
+            var data = figure.data.map(function(trace) {
+                var meta = trace.meta;
+                if (!meta || !meta.group) {
+                    return trace;  // not a layer trace (e.g. score view)
+                }
+                var visible;
+                if (meta.group === 'trail') {
+                    visible = meta.classes.some(function(c) { return trails.indexOf(c) >= 0; });
+                } else if (meta.group === 'park') {
+                    visible = Boolean(parks);
+                } else {
+                    visible = buildings.indexOf(meta.type) >= 0;
+                }
+                var first = visible && !legend[trace.legendgroup];
+                if (first) {
+                    legend[trace.legendgroup] = true;
+                }
+                return Object.assign({}, trace, {visible: visible, showlegend: first});
+            });
+            return Object.assign({}, figure, {data: data});
+        }
+    }
+});
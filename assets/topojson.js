@@ -0,0 +1,43 @@
+/*
+ * Decoder of the compact map geometry (lib/topojson_wire.py) : quantized, delta-encoded arcs shared by the geometries
+ * of a TopoJSON topology, back to a GeoJSON FeatureCollection for plotly.
+ */
+window.walkableTopojson = {
+    // absolute lon/lat points of every arc
+    decodeArcs: function(topology) {
+        var scale = topology.transform.scale, translate = topology.transform.translate;
+        return topology.arcs.map(function(arc) {
+            var x = 0, y = 0;
+            return arc.map(function(step) {
+                x += step[0];
+                y += step[1];
+                return [x * scale[0] + translate[0], y * scale[1] + translate[1]];
+            });
+        });
+    },
+
+    // closed ring from arc indices (~i : arc i reversed), arcs share their end points
+    ring: function(arcs, ids) {
+        var points = [];
+        ids.forEach(function(id, k) {
+            var arc = id < 0 ? arcs[~id].slice().reverse() : arcs[id];
+            points.push.apply(points, k === 0 ? arc : arc.slice(1));
+        });
+        return points;
+    },
+
+    decode: function(topology) {
+        var self = this, arcs = this.decodeArcs(topology);
+        return {
+            type: 'FeatureCollection',
+            features: topology.objects.shapes.geometries.map(function(geometry) {
+                return {type: 'Feature', id: geometry.id, properties: {}, geometry: {
+                    type: 'MultiPolygon',
+                    coordinates: geometry.arcs.map(function(rings) {
+                        return rings.map(function(ids) { return self.ring(arcs, ids); });
+                    })
+                }};
+            })
+        };
+    }
+};
@@ -0,0 +1,52 @@
+#!/usr/bin/env/python3
+
+'''
+gunicorn settings, read by default from the working directory : gunicorn app:server
+
+The app (geometry, point index, score grid of the default radius set) is loaded once in the master before the workers
+fork, so the workers share its pages instead of each loading a copy (see lib/shared_geometry.py). The master also
+starts the background job runner (see lib/job_queue.py) unless JOB_RUNNER=0.
+'''
+
+import gc
+import os
+
+
+# Workers : WEB_CONCURRENCY (set by Render), 1 otherwise
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+# Load the app in the master, workers get it copy-on-write
+preload_app = True
+# Run background jobs (new radius sets) next to the workers
+job_runner = os.environ.get('JOB_RUNNER', '1') != '0'
+runner = None
+
+
+def when_ready(server):
+    '''
+    Before the workers fork : move the loaded objects out of the garbage collector's reach, so collections in the
+    workers do not write to (& copy) the pages they share with the master
+    '''
+    gc.collect()
+    gc.freeze()
+    if job_runner:
+        global runner
+        import job_queue   # on the path once the app is loaded
+        import app
+        runner = job_queue.start_runner(app.data_dir)
+
+
+def on_exit(server):
+    '''
+    Stop the job runner with the master, its running jobs are queued again
+    '''
+    if runner is not None:
+        runner.terminate()
+        runner.wait()
+
+
+def child_exit(server, worker):
+    '''
+    Fold an exited worker's metrics file into the retired totals (see lib/metrics.py)
+    '''
+    import metrics
+    metrics.retire(worker.pid)
@@ -0,0 +1,297 @@
+#!/usr/bin/env/python3
+
+'''
+Batch renderer of static walkability maps (PNG) : one map per trail / park / building selection & radius set, spread
+over a process pool. Each worker reads & reprojects the combined buffers of the sets once and renders the basemap, every
+combined row alone & the title / legend once (matplotlib, headless); a map is these layers alpha-composited (the
+selected rows over the basemap, in the app's order), with no drawing per map. Basemap tiles come from a local tile cache
+(no network when rendering, identical maps from run to run), filled beforehand by the seed command.
+
+Usage: python3 batch_render.py seed -d [data_directory]   (download the basemap tiles the maps need, once)
+       python3 batch_render.py render -d [data_directory] -o [output_directory]
+    optional arguments: -s [set directories ...] -w [workers] --size [pixels] --limit [maps] -t [tile cache]
+'''
+
+import argparse
+import csv
+import itertools
+import math
+import os
+import time
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')  # headless
+import matplotlib.pyplot as plt
+from matplotlib.lines import Line2D
+from PIL import Image
+import contextily as cx
+import geostore
+import buffer_sets
+import combine_buffers
+import lod_pyramid
+
+
+TILE_CACHE = 'basemap_tiles'  # in the data directory
+PROVIDER = cx.providers.CartoDB.Positron
+# Web Mercator : half the world's width (meters), tile size (pixels)
+ORIGIN = 20037508.342789244
+TILE_SIZE = 256
+TRAIL_CLASSES = ['SEP_BIKE_TRL', 'NONSEP_BIKE_TRL', 'WALK_TRL']
+# Colors & Legend names as in app.py
+my_colors = ['blue', 'orange', 'green']
+my_names = ['Trails', 'Buildings', 'Parks']
+
+
+def main():
+    # Initialize the parser
+    parser = argparse.ArgumentParser(description='Render static PNG maps of every selection & radius set, or seed their basemap tile cache.')
+    parser.add_argument('command', choices=['seed', 'render'],
+        help='seed : download the basemap tiles of the maps, render : draw the maps from the cached tiles.')
+    parser.add_argument('-d','--data', required=False, default='../data', type=str,
+        help='Data directory with the radius sets. [default: ../data]')
+    parser.add_argument('-s','--sets', required=False, default=None, nargs='+',
+        help='Radius set directories to draw. [default: every set of the manifest]')
+    parser.add_argument('-o','--output', required=False, default='../maps', type=str,
+        help='Directory the maps (one directory per set) & maps.csv are written to. [default: ../maps]')
+    parser.add_argument('-w','--workers', required=False, default=os.cpu_count(), type=int,
+        help='Number of rendering processes. [default: number of CPUs]')
+    parser.add_argument('--size', required=False, default=1000, type=int,
+        help='Width & height of the maps (pixels). [default: 1000]')
+    parser.add_argument('--limit', required=False, default=None, type=int,
+        help='Draw only the first maps of each set (a sample). [default: all of them]')
+    parser.add_argument('-t','--tiles', required=False, default=None, type=str,
+        help='Basemap tile cache directory. [default: %s in the data directory]' % TILE_CACHE)
+    args = parser.parse_args()
+
+    set_dirs = args.sets or [s['dir'] for s in buffer_sets.read_manifest(args.data)]
+    tiles = args.tiles or os.path.join(args.data, TILE_CACHE)
+    if args.command == 'seed':
+        for set_dir in set_dirs:
+            bounds = load_set(os.path.join(args.data, set_dir), args.size)['bounds']
+            fetched, cached = seed_tiles(tiles, bounds, basemap_zoom(bounds, args.size))
+            print('%s : %d tiles fetched, %d already cached -> %s' % (set_dir, fetched, cached, tiles))
+        return
+
+    start = time.perf_counter()
+    count = render_all(args.data, set_dirs, args.output, args.workers, tiles, args.size, args.limit)
+    seconds = time.perf_counter() - start
+    print('%d maps with %d workers in %.1fs : %.0f maps per minute' % (count, args.workers, seconds, count / seconds * 60))
+
+
+def basemap_zoom(bounds, width_px):
+    '''
+    Tile zoom with about one tile pixel per map pixel across bounds (Web Mercator meters)
+    '''
+    return min(max(math.ceil(math.log2(width_px * 2 * ORIGIN / (TILE_SIZE * (bounds[2] - bounds[0])))), 0), int(PROVIDER.get('max_zoom', 18)))
+
+
+def tile_range(bounds, zoom):
+    '''
+    Tiles x0..x1, y0..y1 (inclusive) covering bounds (Web Mercator meters) at a zoom
+    '''
+    size = 2 * ORIGIN / 2**zoom
+    return (int((bounds[0] + ORIGIN) // size), int((bounds[2] + ORIGIN) // size),
+            int((ORIGIN - bounds[3]) // size), int((ORIGIN - bounds[1]) // size))
+
+
+def tile_path(cache_dir, z, x, y):
+    '''
+    File of a cached tile, e.g. basemap_tiles/CartoDB.Positron/10/246/367.png
+    '''
+    return os.path.join(cache_dir, PROVIDER.name, str(z), str(x), '%d.png' % y)
+
+
+def seed_tiles(cache_dir, bounds, zoom):
+    '''
+    Download the tiles covering bounds at a zoom that are not cached yet, return (fetched, already cached)
+    '''
+    x0, x1, y0, y1 = tile_range(bounds, zoom)
+    fetched = cached = 0
+    for x, y in itertools.product(range(x0, x1 + 1), range(y0, y1 + 1)):
+        path = tile_path(cache_dir, zoom, x, y)
+        if os.path.exists(path):
+            cached += 1
+            continue
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        request = urllib.request.Request(PROVIDER.build_url(x=x, y=y, z=zoom), headers={'User-Agent': 'myWalkableCity batch_render'})
+        with urllib.request.urlopen(request, timeout=30) as response:
+            data = response.read()
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
+        fetched += 1
+    return fetched, cached
+
+
+def basemap(cache_dir, bounds, zoom):
+    '''
+    Cached tiles covering bounds stitched into one image, with its extent (left, right, bottom, top in Web Mercator meters)
+    '''
+    x0, x1, y0, y1 = tile_range(bounds, zoom)
+    missing = [(x, y) for x, y in itertools.product(range(x0, x1 + 1), range(y0, y1 + 1)) if not os.path.exists(tile_path(cache_dir, zoom, x, y))]
+    if missing:
+        raise FileNotFoundError('%d basemap tiles of zoom %d missing from %s, run python3 batch_render.py seed first' % (len(missing), zoom, cache_dir))
+    image = None
+    for x, y in itertools.product(range(x0, x1 + 1), range(y0, y1 + 1)):
+        tile = Image.open(tile_path(cache_dir, zoom, x, y)).convert('RGB')
+        if image is None:
+            px = tile.size[0]  # 256, or 512 for retina tiles
+            image = Image.new('RGB', ((x1 - x0 + 1) * px, (y1 - y0 + 1) * px))
+        image.paste(tile.resize((px, px)), ((x - x0) * px, (y - y0) * px))
+    size = 2 * ORIGIN / 2**zoom
+    return np.asarray(image), (x0 * size - ORIGIN, (x1 + 1) * size - ORIGIN, ORIGIN - (y1 + 1) * size, ORIGIN - y0 * size)
+
+
+def load_set(set_path, width_px):
+    '''
+    Combined layers of a radius set in Web Mercator, simplified to half a pixel of a map width_px wide, with their bounds
+    '''
+    layers = {}
+    for name in lod_pyramid.LAYERS:
+        layers[name] = geostore.read_layer(geostore.find_layer(set_path, name)).to_crs(epsg=3857)
+    bounds = np.array([gdf.total_bounds for gdf in layers.values()])
+    bounds = bounds[:, :2].min(axis=0).tolist() + bounds[:, 2:].max(axis=0).tolist()
+    tolerance = (bounds[2] - bounds[0]) / width_px / 2
+    return {'layers': {name: lod_pyramid.simplify_layer(gdf, tolerance) for name, gdf in layers.items()}, 'bounds': bounds}
+
+
+def selections(building_types=combine_buffers.btypes):
+    '''
+    Every trail classes / parks / building types selection (at least one element), in a fixed order
+    '''
+    subsets = lambda items: [list(c) for k in range(len(items) + 1) for c in itertools.combinations(items, k)]
+    for trail_k, park_k, building_k in itertools.product(subsets(TRAIL_CLASSES), [True, False], subsets(building_types)):
+        if trail_k or park_k or building_k:
+            yield trail_k, park_k, building_k
+
+
+def map_name(trail_k, park_k, building_k, building_types=combine_buffers.btypes):
+    '''
+    File name of a selection : trail class initials, p for parks, bitmask of the building types (in btypes order)
+    e.g. trails_SW_p_b005.png
+    '''
+    trails = ''.join(c[0] for c in TRAIL_CLASSES if c in trail_k) or '-'
+    bits = sum(1 << i for i, b in enumerate(building_types) if b in building_k)
+    return 'trails_%s_%s_b%03x.png' % (trails, 'p' if park_k else '-', bits)
+
+
+# Per worker : {set directory: basemap image, coverage of every combined row, title & legend}, rendered once by init_worker
+_canvases = {}
+
+
+def draw(fig):
+    '''
+    RGBA pixels of a figure (uint8, straight alpha)
+    '''
+    fig.canvas.draw()
+    return np.asarray(fig.canvas.buffer_rgba()).copy()
+
+
+def init_worker(data_dir, set_dirs, cache_dir, width_px):
+    '''
+    Render every set's basemap, each combined row alone (its coverage, as alpha) & the title / legend once (runs once in
+    each worker); a map is then these layers composited, nothing drawn again
+    '''
+    radii = {s['dir']: s for s in buffer_sets.read_manifest(data_dir)}
+    for set_dir in set_dirs:
+        data = load_set(os.path.join(data_dir, set_dir), width_px)
+        b = data['bounds']
+        fig, ax = plt.subplots(figsize=(width_px / 100, width_px / 100), dpi=100)
+        fig.subplots_adjust(left=0.02, right=0.98, bottom=0.02, top=0.92)
+        def frame():
+            ax.set_xlim(b[0], b[2])
+            ax.set_ylim(b[1], b[3])
+            ax.set_aspect('equal')
+        ax.set_axis_off()
+
+        # basemap
+        image, extent = basemap(cache_dir, b, basemap_zoom(b, width_px))
+        tiles = ax.imshow(image, extent=extent, interpolation='bilinear')
+        frame()
+        base = draw(fig)[..., :3]
+        tiles.remove()
+        fig.patch.set_alpha(0)
+
+        # rows in the app's drawing order (trails, buildings, parks), each alone on a transparent figure
+        rows = []
+        for name, color in [('combined_bikeway_buffers', my_colors[0]), ('combined_building_buffers', my_colors[1]), ('combined_park_buffers', my_colors[2])]:
+            gdf = data['layers'][name]
+            for i in range(len(gdf)):
+                drawn = len(ax.collections)
+                gdf.iloc[[i]].plot(ax=ax, color=color, alpha=0.2)
+                frame()
+                rows.append({'key': (name, i), **coverage(draw(fig), np.array(matplotlib.colors.to_rgb(color), dtype=np.float32) * 255)})
+                for artist in ax.collections[drawn:]:
+                    artist.remove()
+
+        # title, legend & attribution, drawn over the rows
+        s = radii.get(set_dir)
+        ax.set_title('Twin Cities Areas Meeting Criteria\n' + ('Trails within %d m, parks %d m, buildings %d m' % (s['trail'], s['park'], s['building']) if s else set_dir))
+        ax.legend([Line2D([0], [0], color=c, lw=4) for c in my_colors], my_names, loc='upper right')
+        ax.text(0.005, 0.005, PROVIDER.attribution, transform=ax.transAxes, fontsize=7, color='#444444')
+        chrome = draw(fig)
+        _canvases[set_dir] = {'base': base, 'rows': rows, 'chrome': coverage(chrome, chrome[..., :3].reshape(-1, 3).astype(np.float32)), 'layers': data['layers']}
+        plt.close(fig)
+
+
+def coverage(rgba, color):
+    '''
+    Pixels of a layer (RGBA, uint8) with some alpha, as {'at': flat pixel indices, 'alpha': their opacity, 'color': one RGB
+    color or a color per pixel} - rows cover a small part of the map, only those pixels are composited
+    '''
+    at = np.flatnonzero(rgba[..., 3].ravel())
+    return {'at': at, 'alpha': rgba[..., 3].ravel()[at, None].astype(np.float32) / 255, 'color': color if color.ndim == 1 else color[at]}
+
+
+def over(out, layer):
+    '''
+    Composite a layer (see coverage) over an RGB float image of (pixels, 3), in place
+    '''
+    px = out[layer['at']]
+    px += (layer['color'] - px) * layer['alpha']
+    out[layer['at']] = px
+
+
+def render_map(task):
+    '''
+    Render one selection of a set to a PNG file (in a worker), return the file
+    '''
+    set_dir, (trail_k, park_k, building_k), path = task
+    canvas = _canvases[set_dir]
+    trails, buildings = canvas['layers']['combined_bikeway_buffers'], canvas['layers']['combined_building_buffers']
+    shown = {('combined_bikeway_buffers', i) for i in np.flatnonzero(trails[trail_k].any(axis='columns').values)} if trail_k else set()
+    shown |= {('combined_building_buffers', i) for i in np.flatnonzero(buildings.NONRES_TYP.isin(building_k).values)}
+    shown |= {('combined_park_buffers', i) for i in range(len(canvas['layers']['combined_park_buffers']))} if park_k else set()
+    out = canvas['base'].reshape(-1, 3).astype(np.float32)
+    for row in canvas['rows']:
+        if row['key'] in shown:
+            over(out, row)
+    over(out, canvas['chrome'])
+    Image.fromarray(np.rint(out).astype(np.uint8).reshape(canvas['base'].shape)).save(path)  # no timestamp : same maps, same bytes
+    return path
+
+
+def render_all(data_dir, set_dirs, out_dir, workers, cache_dir, width_px=1000, limit=None):
+    '''
+    Render every selection of each set into out_dir/<set>/ with a process pool, list them in out_dir/maps.csv,
+    return the number of maps
+    '''
+    tasks = []
+    for set_dir in set_dirs:
+        os.makedirs(os.path.join(out_dir, set_dir), exist_ok=True)
+        for selection in itertools.islice(selections(), limit):
+            tasks.append((set_dir, selection, os.path.join(out_dir, set_dir, map_name(*selection))))
+    with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(data_dir, set_dirs, cache_dir, width_px)) as pool:
+        list(pool.map(render_map, tasks, chunksize=max(1, min(16, len(tasks) // (4 * workers)))))
+    with open(os.path.join(out_dir, 'maps.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['file', 'set', 'trails', 'parks', 'buildings'])
+        for set_dir, (trail_k, park_k, building_k), path in tasks:
+            writer.writerow([os.path.relpath(path, out_dir), set_dir, ' '.join(trail_k), park_k, ';'.join(building_k)])
+    return len(tasks)
+
+
+if __name__ == '__main__':
+    main()
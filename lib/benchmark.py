@@ -0,0 +1,288 @@
+#!/usr/bin/env/python3
+
+'''
+Benchmark suite : synthetic trails, parks & buildings at multiples of the Twin Cities volumes, timing every stage
+(read_csv_to_gpd, create_buffers, group_union) and the Dash app (combine_df, update_output) for a few checklist selections.
+
+Each stage runs in its own process so its peak RSS is its own. Results (wall time, peak RSS, output vertices, figure
+bytes) are written as JSON, and can be compared to a baseline run. Runs offline, no basemap or network needed.
+
+Usage: python3 benchmark.py -s 1 10 -o results.json
+    compare to a baseline: python3 benchmark.py -s 1 10 -o results.json --compare baseline.json [--threshold 0.2]
+    optional arguments: -f [parquet|arrow|csv] --work [directory] --seed [int]
+    note: 100x means 1.5M trails, buffering it needs tens of GB of memory
+'''
+
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import geopandas as gpd
+import shapely
+import geostore
+import buffer_sets
+import combine_buffers
+import generate_buffers
+import shared_geometry
+
+
+# Rows per layer at 1x (cleaned Twin Cities layers) & the mix of trail groups / building types in them
+BASE_COUNTS = {'bikeways': 15000, 'parks': 3000, 'buildings': 3500}
+TRAIL_MIX = [((True, False, False), 0.01), ((True, False, True), 0.75), ((False, True, False), 0.155), ((False, False, True), 0.085)]
+BUILDING_MIX = [0.3, 0.05, 0.3, 0.1, 0.1, 0.05, 0.1]  # in the order of combine_buffers.btypes
+# Extent (EPSG:26915) & the two downtowns most features cluster around
+EXTENT = (420000, 4924000, 520000, 5029000)
+CENTERS = [(478000, 4980000), (492000, 4978000)]
+RADII = {'bikeways': 800, 'parks': 1000, 'buildings': 1000}
+STAGES = ['read', 'buffers', 'union', 'app']
+SET_DIR = buffer_sets.set_dir(RADII['bikeways'], RADII['parks'], RADII['buildings'])
+
+
+def main():
+    # Initialize the parser
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline stages and the Dash callback on synthetic data.')
+    parser.add_argument('-s','--scales', required=False, default=[1, 10], nargs='+', type=int,
+        help='Multiples of the Twin Cities volumes to run. [default: 1 10]')
+    parser.add_argument('-o','--out', required=False, default='benchmark_results.json', type=str,
+        help='JSON file to write the results to. [default: benchmark_results.json]')
+    parser.add_argument('--compare', required=False, type=str,
+        help='Baseline results (JSON) to compare to, exits with 1 if a case got slower than the threshold.')
+    parser.add_argument('--threshold', required=False, default=0.2, type=float,
+        help='Relative slowdown counted as a regression when comparing. [default: 0.2]')
+    parser.add_argument('-f','--format', required=False, default=geostore.DEFAULT_FORMAT, choices=list(geostore.FORMATS),
+        help='File format of the synthetic layers. [default: %s]' % geostore.DEFAULT_FORMAT)
+    parser.add_argument('--work', required=False, type=str,
+        help='Directory for the synthetic data (kept), a temporary directory otherwise.')
+    parser.add_argument('--seed', required=False, default=0, type=int,
+        help='Random seed of the synthetic data. [default: 0]')
+    parser.add_argument('--stage', required=False, choices=STAGES, help=argparse.SUPPRESS)  # internal : run one stage
+    args = parser.parse_args()
+
+    # Child process : one stage on an existing scale directory, results as the last line of stdout
+    if args.stage:
+        print(json.dumps(run_stage(args.stage, args.work, args.format)))
+        return
+
+    work = args.work or tempfile.mkdtemp(prefix='walkable_bench_')
+    results = []
+    try:
+        for scale in args.scales:
+            scale_dir = os.path.join(work, 'x%d' % scale)
+            start = time.perf_counter()
+            write_synthetic(scale_dir, scale, args.format, args.seed)
+            print('x%d : synthetic data in %.1fs' % (scale, time.perf_counter() - start))
+            for stage in STAGES:
+                for r in stage_process(stage, scale_dir, args.format):
+                    results.append({'scale': scale, 'stage': stage, **r})
+                    print_result(results[-1])
+    finally:
+        if not args.work:
+            shutil.rmtree(work, ignore_errors=True)
+
+    with open(args.out, 'w') as f:
+        json.dump({'meta': run_meta(args), 'results': results}, f, indent=2)
+    print('results -> %s' % args.out)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(baseline['results'], results, args.threshold):
+            raise SystemExit(1)
+
+
+def synthetic_layers(scale, seed=0):
+    '''
+    Synthetic cleaned layers (EPSG:26915) with the columns of the csv_shapefiles files, scale x the Twin Cities volumes
+    trails are random walks, parks irregular polygons, buildings points, mostly clustered around the downtowns
+    '''
+    rng = np.random.default_rng(seed)
+    crs = geostore.DEFAULT_CRS
+
+    # Trails : random walks of 5-30 vertices, ~100m steps, heading drifting slowly
+    n = BASE_COUNTS['bikeways'] * scale
+    start = locations(rng, n)
+    steps = rng.integers(5, 31, n)
+    heading = np.repeat(rng.uniform(0, 2 * np.pi, n), steps) + rng.normal(0, 0.3, steps.sum()).cumsum()
+    step_len = rng.uniform(50, 150, steps.sum())
+    offsets = np.stack([np.cos(heading) * step_len, np.sin(heading) * step_len], axis=1)
+    line_of = np.repeat(np.arange(n), steps)
+    first = np.concatenate([[0], np.cumsum(steps)[:-1]])
+    offsets[first] = 0
+    coords = np.concatenate([np.cumsum(offsets[f:f + s], axis=0) for f, s in zip(first, steps)]) + start[line_of]
+    groups = rng.choice(len(TRAIL_MIX), n, p=[p for _, p in TRAIL_MIX])
+    flags = np.array([f for f, _ in TRAIL_MIX])[groups]
+    bikeways = gpd.GeoDataFrame({
+        'index': np.arange(n), 'TRAILNAME': ['trail %d' % i for i in range(n)],
+        'SEP_BIKE_TRL': flags[:, 0], 'NONSEP_BIKE_TRL': flags[:, 1], 'WALK_TRL': flags[:, 2],
+    }, geometry=shapely.linestrings(coords, indices=line_of), crs=crs)
+
+    # Parks : buffered points, lognormal sizes (a few large regional parks), coarse circles
+    n = BASE_COUNTS['parks'] * scale
+    parks = gpd.GeoDataFrame({'OBJECTID': np.arange(n), 'PARKNAME': ['park %d' % i for i in range(n)]},
+        geometry=shapely.buffer(shapely.points(locations(rng, n)), np.clip(rng.lognormal(4.5, 0.8, n), 10, 2000), quad_segs=3), crs=crs)
+
+    # Buildings : points, one of the seven building types
+    n = BASE_COUNTS['buildings'] * scale
+    btype = np.array(combine_buffers.btypes)[rng.choice(len(BUILDING_MIX), n, p=BUILDING_MIX)]
+    buildings = gpd.GeoDataFrame({'SDE_ID': np.arange(n), 'NONRES_TYP': btype, 'BLDG_NAME': ['building %d' % i for i in range(n)],
+                                  'BLDG_DESC': btype},
+        geometry=shapely.points(locations(rng, n)), crs=crs)
+    return {'bikeways': bikeways, 'parks': parks, 'buildings': buildings}
+
+
+def locations(rng, n):
+    '''
+    n points : 70% around the downtowns (sd 8km), the rest anywhere in the extent
+    '''
+    pts = rng.uniform(EXTENT[:2], EXTENT[2:], (n, 2))
+    near = rng.random(n) < 0.7
+    centers = np.array(CENTERS)[rng.integers(0, len(CENTERS), near.sum())]
+    pts[near] = np.clip(centers + rng.normal(0, 8000, (near.sum(), 2)), EXTENT[:2], EXTENT[2:])
+    return pts
+
+
+def write_synthetic(scale_dir, scale, fmt, seed=0):
+    '''
+    Synthetic layers of a scale written as the csv_shapefiles directory of a data directory
+    '''
+    os.makedirs(os.path.join(scale_dir, 'csv_shapefiles'), exist_ok=True)
+    for name, gdf in synthetic_layers(scale, seed).items():
+        geostore.write_layer(gdf, geostore.layer_path(os.path.join(scale_dir, 'csv_shapefiles'), name, fmt))
+
+
+def stage_process(stage, scale_dir, fmt):
+    '''
+    Run one stage in a fresh Python process, return its results
+    '''
+    cmd = [sys.executable, os.path.abspath(__file__), '--stage', stage, '--work', scale_dir, '-f', fmt]
+    out = subprocess.run(cmd, check=True, capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def measure(case, func, *args):
+    '''
+    Time func(*args), return (output, result dict) - peak RSS is the high-water mark of this process so far
+    '''
+    start = time.perf_counter()
+    out = func(*args)
+    return out, {'case': case, 'seconds': time.perf_counter() - start, 'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+
+def vertices(geoms):
+    '''
+    Number of vertices of an array of geometries
+    '''
+    return int(shapely.get_num_coordinates(np.asarray(geoms)).sum())
+
+
+def run_stage(stage, scale_dir, fmt):
+    '''
+    One stage on the data of a scale directory (inputs written by the previous stages), list of result dicts
+    '''
+    results = []
+    clean_dir, set_path = os.path.join(scale_dir, 'csv_shapefiles'), os.path.join(scale_dir, SET_DIR)
+    layers = ['bikeways', 'parks', 'buildings']
+
+    if stage == 'read':
+        for name in layers:
+            gdf, r = measure('read_csv_to_gpd ' + name, generate_buffers.read_csv_to_gpd,
+                             geostore.layer_path(clean_dir, name, fmt), generate_buffers.NAME_COLUMNS[name])
+            results.append({**r, 'rows': len(gdf), 'vertices': vertices(gdf.geometry.values)})
+
+    elif stage == 'buffers':
+        os.makedirs(set_path, exist_ok=True)
+        for name in layers:
+            gdf = generate_buffers.read_csv_to_gpd(geostore.layer_path(clean_dir, name, fmt), generate_buffers.NAME_COLUMNS[name])
+            buff, r = measure('create_buffers ' + name, generate_buffers.create_buffers,
+                              gdf[generate_buffers.BUFFER_COLUMNS[name]].copy(), RADII[name])
+            results.append({**r, 'rows': len(buff), 'vertices': vertices(buff.geometry.values)})
+            geostore.write_layer(buff, geostore.layer_path(set_path, name + '_buffers', fmt))
+
+    elif stage == 'union':
+        # group_union over the groups of each layer, one process (workers=1) for comparable timings
+        for name, split, combined in [('bikeways', combine_buffers.split_trails, 'combined_bikeway_buffers'),
+                                      ('parks', lambda g: [g], 'combined_park_buffers'),
+                                      ('buildings', combine_buffers.split_buildings, 'combined_building_buffers')]:
+            groups = split(geostore.read_layer(geostore.layer_path(set_path, name + '_buffers', fmt)))
+            unions, r = measure('group_union ' + name, lambda gs: [combine_buffers.group_union(g) for g in gs], groups)
+            results.append({**r, 'rows': sum(len(g) for g in groups), 'vertices': vertices(unions)})
+            out = {'bikeways': lambda: combine_buffers.combine_trails(groups, unions),
+                   'parks': lambda: combine_buffers.combine_parks(unions[0]),
+                   'buildings': lambda: combine_buffers.combine_buildings(unions)}[name]()
+            geostore.write_layer(out, geostore.layer_path(set_path, combined, fmt))
+        buffer_sets.register_set(scale_dir, RADII['bikeways'], RADII['parks'], RADII['buildings'])
+
+    elif stage == 'app':
+        # the Dash app on this data directory : startup, then cold (uncached) calls per selection
+        os.environ['DATA_DIR'] = scale_dir
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        app, r = measure('app startup', __import__, 'app')
+        results.append(r)
+        selections = {'default': app.common_selections[0], 'no parks': app.common_selections[2], 'everything': app.common_selections[-1]}
+        level = app.default_level
+        for label, (trail_l, park_d, building_l) in selections.items():
+            trail_lod, building_lod, park_lod = app.load_buffer_set(app.default_set)
+            combined, r = measure('combine_df ' + label, app.combine_df,
+                                  [trail_lod[level], building_lod[level], park_lod[level]], trail_l, building_l, park_d)
+            results.append({**r, 'rows': len(combined), 'vertices': shared_geometry.num_coordinates(combined)})
+        for label, (trail_l, park_d, building_l) in selections.items():
+            for zoom in [app.default_zoom, 14] if label == 'default' else [app.default_zoom]:
+                app.build_figure.cache_clear()
+                (fig, *_), r = measure('update_output %s z%d' % (label, zoom), app.update_output,
+                                         trail_l, park_d, building_l, {'mapbox.zoom': zoom})
+                results.append({**r, 'bytes': len(fig.to_json())})
+    return results
+
+
+def print_result(r):
+    '''
+    One result as a line of text
+    '''
+    extra = ''.join(' %s=%d' % (k, r[k]) for k in ['rows', 'vertices', 'bytes'] if k in r)
+    print('x%-4d %-8s %-32s %8.3fs %7.0f MB%s' % (r['scale'], r['stage'], r['case'], r['seconds'], r['peak_rss_mb'], extra))
+
+
+def run_meta(args):
+    '''
+    Where & how the results were obtained
+    '''
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    return {'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': commit, 'python': platform.python_version(),
+            'platform': platform.platform(), 'cpus': os.cpu_count(), 'scales': args.scales, 'format': args.format, 'seed': args.seed}
+
+
+def compare(baseline, results, threshold=0.2):
+    '''
+    Print each case against the baseline (time & peak RSS ratios), return the regressions (slower by more than threshold)
+    note: cases under 10ms in the baseline are too noisy to count as regressions
+    '''
+    base = {(r['scale'], r['stage'], r['case']): r for r in baseline}
+    regressions = []
+    print('%-5s %-32s %9s %9s %7s %9s' % ('scale', 'case', 'base', 'new', 'time', 'peak RSS'))
+    for r in results:
+        b = base.get((r['scale'], r['stage'], r['case']))
+        if b is None:
+            continue
+        ratio = r['seconds'] / max(b['seconds'], 1e-9)
+        slower = ratio > 1 + threshold and b['seconds'] >= 0.01
+        if slower:
+            regressions.append(r)
+        print('x%-4d %-32s %8.3fs %8.3fs %6.2fx %8.2fx%s' % (r['scale'], r['case'], b['seconds'], r['seconds'], ratio,
+            r['peak_rss_mb'] / max(b['peak_rss_mb'], 1e-9), '  <- regression' if slower else ''))
+    print('%d regression(s) over %d%%' % (len(regressions), threshold * 100))
+    return regressions
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env/python3
+
+'''
+Manifest of the buffer radius sets available in the data directory (one buffers_<t>t_<p>p_<b>b directory per set,
+reach_<r>t_<r>p_<r>b for network-distance sets written by network_reach.py).
+
+Usage (list the sets): python3 buffer_sets.py -d [data_directory]
+'''
+
+import argparse
+import fcntl
+import json
+import os
+
+
+MANIFEST = 'buffers_manifest.json'
+
+
+def main():
+    # Initialize the parser
+    parser = argparse.ArgumentParser(description='List the buffer radius sets recorded in the manifest.')
+    parser.add_argument('-d','--data', required=False, default='../data', type=str,
+        help='Data directory holding the manifest and buffer directories. [default: ../data]')
+    args = parser.parse_args()
+    for s in read_manifest(args.data):
+        print('%s : trails %dm, parks %dm, buildings %dm%s' % (s['dir'], s['trail'], s['park'], s['building'], ' (network distance)' if s.get('network') else ''))
+
+
+def set_dir(trail, park, building):
+    '''
+    Directory name of a radius set, e.g. buffers_800t_1000p_1000b
+    '''
+    return 'buffers_%dt_%dp_%db' % (trail, park, building)
+
+
+def read_manifest(data_dir):
+    '''
+    Radius sets recorded in the manifest, sorted by trail then park & building radius
+    '''
+    path = os.path.join(data_dir, MANIFEST)
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        sets = json.load(f)['sets']
+    return sorted(sets, key=lambda s: (s['trail'], s['park'], s['building']))
+
+
+def register_set(data_dir, trail, park, building, name=None, network=False):
+    '''
+    Add a radius set to the manifest (no-op if already recorded), return its directory name
+    note: name defaults to set_dir(trail, park, building), network marks radii measured along the trail network
+    '''
+    name = name or set_dir(trail, park, building)
+    path = os.path.join(data_dir, MANIFEST)
+    with open(path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)  # writers one at a time (job runner, sweeps), none loses another's set
+        sets = [s for s in read_manifest(data_dir) if s['dir'] != name]
+        sets.append({'dir': name, 'trail': trail, 'park': park, 'building': building, **({'network': True} if network else {})})
+        tmp = '%s.%d.tmp' % (path, os.getpid())  # write then rename, readers never see a partial file
+        with open(tmp, 'w') as f:
+            json.dump({'sets': sorted(sets, key=lambda s: (s['trail'], s['park'], s['building']))}, f, indent=2)
+        os.replace(tmp, path)
+    return name
+
+
+if __name__ == '__main__':
+    main()
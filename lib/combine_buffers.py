@@ -2,159 +2,188 @@
 
 '''
 Combining Buffers of like objects (like connecting trails, overlapping park buffers, etc.)
+
+Usage: python3 combine_buffers.py -i [buffer_directory]
+    optional arguments: -f [parquet|arrow|csv] -w [workers] --keep_isolated --vis
 '''
 
 import argparse
+import itertools
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import geopandas as gpd
-from shapely import wkt
-import itertools
+import geostore
+import union_engine
 
-filepath = '../data/buffers_800t_1000p_1000b/bikeways_buffers.csv'  # manually enter file names - experimenting with faster geometries
-parkfp = '../data/buffers_800t_1000p_1000b/parks_buffers.csv'
-buildingfp = '../data/buffers_800t_1000p_1000b/buildings_buffers.csv'
-
-# Helper function : Intersection of GeoSeries
-def group_union(mygdf):
-    # list format of geometries
-    geoms = mygdf['geometry'].tolist()
-    # intersections for every combination, if intersecting
-    intersection_iter = gpd.GeoDataFrame(gpd.GeoSeries([poly[0].union(poly[1]) for poly in itertools.combinations(geoms, 2) if poly[0].intersects(poly[1])]), columns=['geometry'])
-    # (optional) write to file
-    # intersection_iter.to_file("data/intersection_iter.shp")
-    union_iter = intersection_iter.unary_union
-    return union_iter
-
-
-
-##### Bikeways #####
-# Geopandas dataframe
-df = pd.read_csv(filepath, delimiter=",", header=0, dtype=str, lineterminator='\n')
-df.SEP_BIKE_TRL = df.SEP_BIKE_TRL.map({'True': True, 'False': False})
-df.NONSEP_BIKE_TRL = df.NONSEP_BIKE_TRL.map({'True': True, 'False': False})
-df.WALK_TRL = df.WALK_TRL.map({'True': True, 'False': False})
-df['geometry'] = df['geometry'].apply(str) # ensure str before conversion
-df['geometry'] = df['geometry'].apply(wkt.loads) # reading from "Well Known Text" format
-gdf = gpd.GeoDataFrame(df, crs="epsg:26915").set_geometry('geometry') # setting coordinate reference to NAD 83
-
-# Groups - must have like attributes in SEP_BIKE_TRL, NONSEP_BIKE_TRL, WALK_TRL
-## separated trail only (144)
-sep_gdf = gdf.loc[gdf.SEP_BIKE_TRL & ~gdf.WALK_TRL]
-## separated & walking trail (11259)
-combo_gdf = gdf.loc[gdf.SEP_BIKE_TRL & gdf.WALK_TRL]
-## nonseparated trail only (2331)
-non_gdf = gdf.loc[gdf.NONSEP_BIKE_TRL]
-## walk only (1289)
-walk_gdf = gdf.loc[gdf.WALK_TRL & ~gdf.SEP_BIKE_TRL]
-
-# Output to a combined file with these multi-polygons per group
-new_gdf = gdf.iloc[0:4].copy(deep=False)
-new_gdf.id = [144,11259,2331,1289]
-new_gdf.name = ['separated bike','shared trail','nonseparated bike','walking only trail']
-new_gdf.SEP_BIKE_TRL = [True, True, False, False]
-new_gdf.NONSEP_BIKE_TRL = [False, False, True, False]
-new_gdf.WALK_TRL = [False, True, False, True]
-new_gdf.geometry = [group_union(sep_gdf), group_union(combo_gdf), group_union(non_gdf), group_union(walk_gdf)] # takes a long time!!
-## writing out to file
-new_gdf.to_csv('../data/buffers_800t_1000p_1000b/combined_bikeway_buffers.csv', index=False)
-
-
-
-##### Parks #####
-# Geopandas dataframe
-df = pd.read_csv(parkfp, delimiter=",", header=0, dtype=str, lineterminator='\n')
-df['geometry'] = df['geometry'].apply(str) # ensure str before conversion
-df['geometry'] = df['geometry'].apply(wkt.loads) # reading from "Well Known Text" format
-gdf = gpd.GeoDataFrame(df, crs="epsg:26915").set_geometry('geometry') # setting coordinate reference to NAD 83
-
-# Create one combined geometry
-new_gdf = gdf.iloc[0:1].copy(deep=False)
-new_gdf.id = 0
-new_gdf['name'] = 'parks'
-new_gdf['geometry'] = group_union(gdf)
-## writing out to file
-new_gdf.to_csv('../data/buffers_800t_1000p_1000b/combined_park_buffers.csv', index=False)
-
-
-
-##### Buildings #####
-# Geopandas dataframe
-df = pd.read_csv(buildingfp, delimiter=",", header=0, dtype=str, lineterminator='\n')
-df['geometry'] = df['geometry'].apply(str) # ensure str before conversion
-df['geometry'] = df['geometry'].apply(wkt.loads) # reading from "Well Known Text" format
-gdf = gpd.GeoDataFrame(df, crs="epsg:26915").set_geometry('geometry') # setting coordinate reference to NAD 83
 
+# Trail groups - must have like attributes in (SEP_BIKE_TRL, NONSEP_BIKE_TRL, WALK_TRL)
+trail_groups = [('separated bike', True, False, False), ('shared trail', True, False, True),
+                ('nonseparated bike', False, True, False), ('walking only trail', False, False, True)]
 # Seven groups of buildings, combine per group
 btypes = ['Schools', 'Medical Facilities', 'Eating and Drinking Establishments', 'Arts Entertainment and Recreation', 'Religious', 'Grocery', 'Transit']
 
-# Create combined geometries per group
-new_gdf = gdf.iloc[0:len(btypes)].copy(deep=False)
-for i in range(len(btypes)):
-    new_gdf.loc[i,'id'] = i
-    new_gdf.loc[i, 'name'] = btypes[i]
-    new_gdf.loc[i, 'NONRES_TYP'] = btypes[i]
-    new_gdf.loc[i, 'geometry'] = group_union(gdf.loc[gdf.NONRES_TYP == btypes[i]])
-## writing out to file
-new_gdf.to_csv('../data/buffers_800t_1000p_1000b/combined_building_buffers.csv', index=False)
-
-
-
-
-
-
-import plotly.express as px
-import pyproj
-from plotly.offline import plot
-mydf = pd.read_csv('../data/buffers_800t_1000p_1000b/combined_bikeway_buffers.csv',delimiter=",", header=0, dtype=str, lineterminator='\n').drop(['SEP_BIKE_TRL','NONSEP_BIKE_TRL','WALK_TRL'], axis=1)
-mydf1 = pd.read_csv('../data/buffers_800t_1000p_1000b/combined_park_buffers.csv',delimiter=",", header=0, dtype=str, lineterminator='\n')
-mydf2 = pd.read_csv('../data/buffers_800t_1000p_1000b/combined_building_buffers.csv',delimiter=",", header=0, dtype=str, lineterminator='\n').drop('NONRES_TYP', axis=1)
-combined = pd.concat([mydf, mydf1, mydf2])
-combined['geometry'] = combined['geometry'].apply(str)
-combined['geometry'] = combined['geometry'].apply(wkt.loads)
-combined = gpd.GeoDataFrame(combined, crs="epsg:26915").set_geometry('geometry')
-combined = combined.reset_index()
-
-mycopy = combined.copy(deep=False)
-mycopy.to_crs(epsg=4326, inplace=True)
-
-# gpd.GeoSeries(combined['geometry'].apply(str).apply(shapely.wkt.loads)).__geo_interface__
-
-plty = px.choropleth_mapbox(
-    geojson = mycopy['geometry'],
-    locations = mycopy.index,
-    color = ['trail','trail','trail','trail','park','building','building','building','building','building','building','building'],
-    color_discrete_sequence = ['blue','green','yellow'],
-    opacity = 0.3
-).update_layout(
-    mapbox={"style": "carto-positron", "center": {"lon": -93, "lat": 45}, "zoom": 8}
-)
-plot(plty, auto_open=True)
-
-
-
-
-
-from matplotlib.lines import Line2D
-import matplotlib
-import matplotlib.pyplot as plt
-import contextily as cx
-my_colors = ['blue','green','orange']
-my_names = ['trails','parks','buildings']
-
-combined['col_grp'] = ['blue','blue','blue','blue','green','yellow','yellow','yellow','yellow','yellow','yellow','yellow']
-
-my_legend = [Line2D([0], [0], color=my_colors[i], lw=4) for i in range(len(my_colors))]
-
-fig, ax = plt.subplots() # change size here if needed?
-combined.plot(ax=ax, color=combined['col_grp'], aspect=1, alpha=0.2)
-ax.legend(my_legend, my_names)
-cx.add_basemap(ax, crs=combined.crs, source=cx.providers.CartoDB.Positron)
-plt.title('Twin Cities Areas Meeting Criteria')
-
-
-
-
-
-
-
 
+def main():
+    # Initialize the parser
+    parser = argparse.ArgumentParser(description='Combine the buffers of like objects into one geometry per group.')
+    parser.add_argument('-i','--input', required=False, default='../data/buffers_800t_1000p_1000b/', type=str,
+        help='Directory with the *_buffers files, combined_* files are written here. [default: ../data/buffers_800t_1000p_1000b/]')
+    parser.add_argument('-f','--format', required=False, default=geostore.DEFAULT_FORMAT, choices=list(geostore.FORMATS),
+        help='File format of the combined files. [default: %s]' % geostore.DEFAULT_FORMAT)
+    parser.add_argument('-w','--workers', required=False, default=os.cpu_count(), type=int,
+        help='Number of processes unioning groups in parallel. [default: number of CPUs]')
+    parser.add_argument('--keep_isolated', required=False, action='store_true',
+        help='Keep buffers intersecting no other buffer of their group (dropped by default, as originally).')
+    parser.add_argument('--vis', required=False, action='store_true',
+        help='Plot the combined buffers (plotly in the browser, then matplotlib).')
+    args = parser.parse_args()
+
+    # Geopandas dataframes (NAD 83, boolean trail columns), csv, parquet or arrow (see geostore.py)
+    bike_gdf = geostore.read_layer(geostore.find_layer(args.input, 'bikeways_buffers'))
+    park_gdf = geostore.read_layer(geostore.find_layer(args.input, 'parks_buffers'))
+    build_gdf = geostore.read_layer(geostore.find_layer(args.input, 'buildings_buffers'))
+
+    # Union every group (4 trail classes, parks, 7 building types) in parallel
+    start = time.perf_counter()
+    groups = split_trails(bike_gdf) + [park_gdf] + split_buildings(build_gdf)
+    unions = union_groups(groups, args.workers, args.keep_isolated)
+    print('unioned %d groups in %.1fs' % (len(groups), time.perf_counter() - start))
+
+    # Write out to files with these multi-polygons per group
+    geostore.write_layer(combine_trails(groups[:4], unions[:4]), geostore.layer_path(args.input, 'combined_bikeway_buffers', args.format))
+    geostore.write_layer(combine_parks(unions[4]), geostore.layer_path(args.input, 'combined_park_buffers', args.format))
+    geostore.write_layer(combine_buildings(unions[5:]), geostore.layer_path(args.input, 'combined_building_buffers', args.format))
+
+    # Visualize (if requested)
+    if args.vis:
+        visualize_combined(args.input)
+
+
+def group_union(mygdf, keep_isolated=False):
+    '''
+    Union of the intersecting buffers of one group (see union_engine.py)
+    '''
+    return union_engine.union_components(mygdf.geometry.values, keep_isolated=keep_isolated)
+
+
+def union_groups(groups, workers=None, keep_isolated=False):
+    '''
+    Union of each group (list of GeoDataFrames), groups spread across a process pool
+    '''
+    if workers == 1:
+        return [group_union(g, keep_isolated) for g in groups]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(group_union, groups, itertools.repeat(keep_isolated)))
+
+
+def combine_layer(name, gdf, workers=None, keep_isolated=False):
+    '''
+    Combined layer of one *_buffers layer ('bikeways', 'parks' or 'buildings')
+    '''
+    if name == 'bikeways':
+        groups = split_trails(gdf)
+        return combine_trails(groups, union_groups(groups, workers, keep_isolated))
+    if name == 'parks':
+        return combine_parks(union_groups([gdf], workers, keep_isolated)[0])
+    return combine_buildings(union_groups(split_buildings(gdf), workers, keep_isolated))
+
+
+def split_trails(gdf):
+    '''
+    Trail buffers per group, in the order of trail_groups
+    '''
+    return [
+        gdf.loc[gdf.SEP_BIKE_TRL & ~gdf.WALK_TRL],  ## separated trail only (144)
+        gdf.loc[gdf.SEP_BIKE_TRL & gdf.WALK_TRL],  ## separated & walking trail (11259)
+        gdf.loc[gdf.NONSEP_BIKE_TRL],  ## nonseparated trail only (2331)
+        gdf.loc[gdf.WALK_TRL & ~gdf.SEP_BIKE_TRL],  ## walk only (1289)
+    ]
+
+
+def split_buildings(gdf):
+    '''
+    Building buffers per group, in the order of btypes
+    '''
+    return [gdf.loc[gdf.NONRES_TYP == btype] for btype in btypes]
+
+
+def combine_trails(groups, geoms):
+    '''
+    Combined trail layer, one row per trail group (id is the number of trails in the group)
+    '''
+    return gpd.GeoDataFrame({
+        'id': [len(g) for g in groups],
+        'name': [t[0] for t in trail_groups],
+        'SEP_BIKE_TRL': [t[1] for t in trail_groups],
+        'NONSEP_BIKE_TRL': [t[2] for t in trail_groups],
+        'WALK_TRL': [t[3] for t in trail_groups],
+    }, geometry=list(geoms), crs="epsg:26915")
+
+
+def combine_parks(geom):
+    '''
+    Combined park layer, one row
+    '''
+    return gpd.GeoDataFrame({'id': [0], 'name': ['parks']}, geometry=[geom], crs="epsg:26915")
+
+
+def combine_buildings(geoms):
+    '''
+    Combined building layer, one row per building type
+    '''
+    return gpd.GeoDataFrame({'id': list(range(len(btypes))), 'name': btypes, 'NONRES_TYP': btypes},
+                            geometry=list(geoms), crs="epsg:26915")
+
+
+def visualize_combined(buffdir):
+    '''
+    Plot the combined buffers with plotly (opens in browser), then matplotlib with a basemap
+    '''
+    import plotly.express as px
+    import pyproj
+    from plotly.offline import plot
+    mydf = geostore.read_layer(geostore.find_layer(buffdir, 'combined_bikeway_buffers')).drop(['SEP_BIKE_TRL','NONSEP_BIKE_TRL','WALK_TRL'], axis=1)
+    mydf1 = geostore.read_layer(geostore.find_layer(buffdir, 'combined_park_buffers'))
+    mydf2 = geostore.read_layer(geostore.find_layer(buffdir, 'combined_building_buffers')).drop('NONRES_TYP', axis=1)
+    combined = gpd.GeoDataFrame(pd.concat([mydf, mydf1, mydf2]), crs="epsg:26915").set_geometry('geometry')
+    combined = combined.reset_index()
+
+    mycopy = combined.copy(deep=False)
+    mycopy.to_crs(epsg=4326, inplace=True)
+
+    # gpd.GeoSeries(combined['geometry'].apply(str).apply(shapely.wkt.loads)).__geo_interface__
+
+    plty = px.choropleth_mapbox(
+        geojson = mycopy['geometry'],
+        locations = mycopy.index,
+        color = ['trail','trail','trail','trail','park','building','building','building','building','building','building','building'],
+        color_discrete_sequence = ['blue','green','yellow'],
+        opacity = 0.3
+    ).update_layout(
+        mapbox={"style": "carto-positron", "center": {"lon": -93, "lat": 45}, "zoom": 8}
+    )
+    plot(plty, auto_open=True)
+
+    from matplotlib.lines import Line2D
+    import matplotlib
+    import matplotlib.pyplot as plt
+    import contextily as cx
+    my_colors = ['blue','green','orange']
+    my_names = ['trails','parks','buildings']
+
+    combined['col_grp'] = ['blue','blue','blue','blue','green','yellow','yellow','yellow','yellow','yellow','yellow','yellow']
+
+    my_legend = [Line2D([0], [0], color=my_colors[i], lw=4) for i in range(len(my_colors))]
+
+    fig, ax = plt.subplots() # change size here if needed?
+    combined.plot(ax=ax, color=combined['col_grp'], aspect=1, alpha=0.2)
+    ax.legend(my_legend, my_names)
+    cx.add_basemap(ax, crs=combined.crs, source=cx.providers.CartoDB.Positron)
+    plt.title('Twin Cities Areas Meeting Criteria')
+    plt.show()
+
+
+if __name__ == '__main__':
+    main()
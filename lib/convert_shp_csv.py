@@ -6,72 +6,231 @@ Cleaning up shapefiles and exporting to CSVs.
 Shapefiles obtained from MN Geospatial Commons (https://gisdata.mn.gov/),
    see readme in data directory for more information.
 
+Layers are streamed in batches by default : only the columns each layer needs are read, with the status / building
+type filters pushed down to the reader (OGR SQL), each cleaned batch written out before the next is read (see
+geostore.write_batches), so memory stays flat as the shapefiles grow. --all_columns reads whole shapefiles with
+gpd.read_file as originally.
+
 Usage (from lib directory): python3 convert_shp_csv.py
+    optional arguments: -i [shapefile_directory] -o [output_directory] -f [parquet|arrow|csv] -l [layer ...]
+                        --batch_size [rows] --all_columns
+    output format follows the GEOSTORE_FORMAT environment variable (parquet, arrow or csv; see geostore.py)
 '''
 
+import argparse
+import os
+import resource
+import time
+import numpy as np
 import geopandas as gpd
 import pandas as pd
+import pyogrio
+import shapely
+import geostore
+
+
+# Shapefiles per layer, relative to the shapefile directory
+SHAPEFILES = {
+    'bikeways': 'bike_trails_metro_collab_2020/MetroCollaborativeTrailsBikeways.shp',  # 43149 entries, 65 columns, 21.4+ MB
+    'parks': 'parks_metro_collab_2020/MetroCollaborativeParks.shp',  # 3865 entries, 51 columns, 1.5+ MB
+    'buildings': 'non_residential_building_2023/NonresidentialConstruction.shp',  # 10888 entries, 20 columns, 1.7+ MB
+}
+
+# Cleaning rules (see clean_* below), also the parameters hashed by pipeline.py
+## trail classes : (GEN_TYPE values, SUMMER_USE values) of the trails in each class
+TRAIL_CLASSES = {
+    'SEP_BIKE_TRL': (['Off-Street','Unknown'], ['Multi-Use Trail','Separated-Use Trail','Bike/Pedestrian Bridge','Cycle Track','Bike-Only Trail','Bike/Pedestrian Tunnel']),
+    'NONSEP_BIKE_TRL': (['On-Street','Unknown'], ['Multi-Use Trail','Sharrow/Shared Lane','Bikeable Shoulder','Standard Bike Lane','Buffered Bike Lane','Bike Boulevard','Signed Bike Route','Advisory Bike Lane','Shared Bike/Bus Lane','Contraflow Bike Lane']),
+    'WALK_TRL': (['Off-Street','Unknown'], ['Multi-Use Trail','Sidewalk','Pedestrian-Only Trail','Separated-Use Trail','Bike/Pedestrian Bridge']),
+}
+TRAIL_STATUS = ['Open']
+PARK_STATUS = ['Open']
+## building categories kept (after grocery & medical facilities are extracted)
+BUILDING_TYPES = ['Grocery','Schools','Eating and Drinking Establishments','Arts Entertainment and Recreation','Religious','Medical Facilities','Transit']
+MEDICAL_TYPES = ['Medical--Commercial','Hospitals and Nursing Homes']
+GROCERY_DESC = 'Grocery'  # in BLDG_DESC
+GROCERY_NAMES = 'Target'  # in BLDG_NAME, usually has a grocery section
+
+# Streaming reads : columns read per layer (the id column, see ID_COLUMN, is added), rows per batch
+#    note: columns of the pushed down filters must be read too, OGR only evaluates the filter on the fields read
+READ_COLUMNS = {
+    'bikeways': ['TRAILNAME', 'TRLSTATUS', 'GEN_TYPE', 'SUMMER_USE'],
+    'parks': ['PARKNAME', 'PARKSTATUS'],
+    'buildings': ['NONRES_TYP', 'BLDG_NAME', 'BLDG_DESC'],
+}
+BATCH_SIZE = 10000
+# Id column of the cleaned layers, first in both modes : the record number of the feature in its shapefile (0 based),
+#    stable whatever rows are filtered out
+ID_COLUMN = 'index'
+
+
+def main():
+    # Initialize the parser
+    parser = argparse.ArgumentParser(description='Clean the MN Geospatial Commons shapefiles & export them through the geostore.')
+    parser.add_argument('-i','--input', required=False, default='../data/mn_geospatialcommons', type=str,
+        help='Directory with the downloaded shapefiles. [default: ../data/mn_geospatialcommons]')
+    parser.add_argument('-o','--out', required=False, default='../data/csv_shapefiles', type=str,
+        help='Directory to write the cleaned layers. [default: ../data/csv_shapefiles]')
+    parser.add_argument('-f','--format', required=False, default=geostore.DEFAULT_FORMAT, choices=list(geostore.FORMATS),
+        help='File format of the cleaned layers. [default: %s]' % geostore.DEFAULT_FORMAT)
+    parser.add_argument('-l','--layers', required=False, default=list(SHAPEFILES), nargs='+', choices=list(SHAPEFILES),
+        help='Layers to convert. [default: all]')
+    parser.add_argument('--batch_size', required=False, default=BATCH_SIZE, type=int,
+        help='Rows read per batch when streaming. [default: %d]' % BATCH_SIZE)
+    parser.add_argument('--all_columns', required=False, action='store_true',
+        help='Read every column & row of the shapefiles at once, then filter (original behavior).')
+    args = parser.parse_args()
+
+    for name in args.layers:
+        start = time.perf_counter()
+        out = convert_layer(name, os.path.join(args.input, SHAPEFILES[name]), geostore.layer_path(args.out, name, args.format),
+                            streaming=not args.all_columns, batch_size=args.batch_size)
+        print('%s : %.2fs -> %s' % (name, time.perf_counter() - start, out))
+    print('peak RSS %.0f MB' % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+def rules(name):
+    '''
+    Cleaning rules of a layer, as plain lists (JSON serializable)
+    '''
+    return {
+        'bikeways': {'status': TRAIL_STATUS, 'classes': TRAIL_CLASSES},
+        'parks': {'status': PARK_STATUS},
+        'buildings': {'types': BUILDING_TYPES, 'medical': MEDICAL_TYPES, 'grocery': [GROCERY_DESC, GROCERY_NAMES]},
+    }[name] | {'columns': READ_COLUMNS[name], 'filter': layer_filter(name), 'id': ID_COLUMN}
+
+
+def convert_layer(name, shp_path, out_path, streaming=True, batch_size=BATCH_SIZE):
+    '''
+    Read a layer's shapefile, clean it & export through the geostore (same CRS as the shapefile)
+    '''
+    if streaming:
+        return geostore.write_batches(layer_batches(name, shp_path, batch_size), out_path)
+    shp = gpd.read_file(shp_path)
+    # Convert to pandas df
+    ## note: not necessary but helpful to confirm geom is correctly written in CSV output
+    df = {'bikeways': clean_bikeways, 'parks': clean_parks, 'buildings': clean_buildings}[name](pd.DataFrame(shp))
+    gdf = gpd.GeoDataFrame(df, geometry='geometry', crs=shp.crs)
+    geostore.write_layer(gdf, out_path)
+    return out_path
+
 
+def layer_filter(name):
+    '''
+    Attribute filter of a layer pushed down to the reader (OGR SQL), keeps a superset of the rows clean_* keeps
+    '''
+    if name == 'bikeways':
+        return sql_in('TRLSTATUS', TRAIL_STATUS)
+    if name == 'parks':
+        return sql_in('PARKSTATUS', PARK_STATUS)
+    # note: LIKE is case insensitive, the exact (case sensitive) grocery match is redone by classify_buildings
+    return '%s OR BLDG_DESC LIKE %s OR BLDG_NAME LIKE %s' % (sql_in('NONRES_TYP', BUILDING_TYPES + MEDICAL_TYPES),
+        sql_str('%' + GROCERY_DESC + '%'), sql_str('%' + GROCERY_NAMES + '%'))
 
-# Read in shapefiles
-## bikeways
-bike_shp = gpd.read_file("../data/mn_geospatialcommons/bike_trails_metro_collab_2020/MetroCollaborativeTrailsBikeways.shp")
-# bike_shp.info() # 43149 entries, 65 columns, 21.4+ MB
-## parks
-park_shp = gpd.read_file("../data/mn_geospatialcommons/parks_metro_collab_2020/MetroCollaborativeParks.shp")
-# park_shp.info() # 3865 entries, 51 columns, 1.5+ MB
-## buildings
-build_shp = gpd.read_file("../data/mn_geospatialcommons/non_residential_building_2023/NonresidentialConstruction.shp")
-# build_shp.info() # 10888 entries, 20 columns, 1.7+ MB
 
+def sql_str(value):
+    '''
+    Quoted OGR SQL string literal
+    '''
+    return "'%s'" % value.replace("'", "''")
 
-# Convert to pandas df
-## note: not necessary but helpful to confirm geom is correctly written in CSV output
-bike_df = pd.DataFrame(bike_shp)
-park_df = pd.DataFrame(park_shp)
-build_df = pd.DataFrame(build_shp)
+
+def sql_in(column, values):
+    '''
+    OGR SQL "column IN (values)" filter
+    '''
+    return '%s IN (%s)' % (column, ','.join(sql_str(v) for v in values))
+
+
+def layer_batches(name, shp_path, batch_size=BATCH_SIZE):
+    '''
+    Cleaned layer read in batches of rows (generator) : pruned columns, filters pushed down, classification per batch
+    note: the id column is 'index', first, as with --all_columns (see ID_COLUMN)
+    '''
+    batches = 0
+    with pyogrio.open_arrow(shp_path, columns=READ_COLUMNS[name], where=layer_filter(name), batch_size=batch_size,
+                            return_fids=True, use_pyarrow=True) as (meta, reader):
+        for batch in reader:
+            df = batch.to_pandas()
+            geometry = shapely.from_wkb(df.pop(meta['geometry_name'] or 'wkb_geometry').values)
+            df.insert(0, ID_COLUMN, df.pop(meta['fid_column']).astype('int64'))
+            df = gpd.GeoDataFrame(df, geometry=geometry, crs=meta['crs'])
+            if name == 'bikeways':
+                df = classify_trails(df)
+            elif name == 'parks':
+                df = df[~df.geometry.isna()]
+            else:
+                df = classify_buildings(df)
+            batches += 1
+            yield df
+    if not batches:  # nothing read : an empty layer is still written
+        yield gpd.GeoDataFrame(columns=[ID_COLUMN] + READ_COLUMNS[name], geometry=[], crs=meta['crs'])
 
 
 # Cleaning up data (open trails/parks, relevant buildings if desired)
 #    note: some "planned" trails/parks may be completed, but for simplicity only adding
 #          trails which were open in 2020 since date of expected completion not provided.
-#
-# Open and relevant bikeways / trails
-# print(bike_df.TRLSTATUS.value_counts()) # open, proposed, planned, etc.
-# print(bike_df.GEN_TYPE.value_counts()) # off-street, on-street, unknown
-# print(bike_df.SURFACETYP.value_counts()) # asphalt, concrete, snow, etc.
-# print(bike_df.SUMMER_USE.value_counts()) # multi-use, sidewalk, bike lane, bikeable shoulder, etc.
-# print(bike_df.WINTER_USE.value_counts()) # multi-use, sidewalk, bike lane, XC ski, snowshoe, etc.
-## keep open trails
-bike_df = bike_df[bike_df.TRLSTATUS.isin(['Open'])]
-bike_df = bike_df.reset_index(drop=True)
-## create boolean variables for types of bike/walking trails (specify trail types to get best results)
-bike_df['SEP_BIKE_TRL'] = bike_df.GEN_TYPE.isin(['Off-Street','Unknown']) & bike_df.SUMMER_USE.isin(['Multi-Use Trail','Separated-Use Trail','Bike/Pedestrian Bridge','Cycle Track','Bike-Only Trail','Bike/Pedestrian Tunnel'])
-bike_df['NONSEP_BIKE_TRL'] = bike_df.GEN_TYPE.isin(['On-Street','Unknown']) & bike_df.SUMMER_USE.isin(['Multi-Use Trail','Sharrow/Shared Lane','Bikeable Shoulder','Standard Bike Lane','Buffered Bike Lane','Bike Boulevard','Signed Bike Route','Advisory Bike Lane','Shared Bike/Bus Lane','Contraflow Bike Lane'])
-bike_df['WALK_TRL'] = bike_df.GEN_TYPE.isin(['Off-Street','Unknown']) & bike_df.SUMMER_USE.isin(['Multi-Use Trail','Sidewalk','Pedestrian-Only Trail','Separated-Use Trail','Bike/Pedestrian Bridge'])
-idx = bike_df[ (bike_df['SEP_BIKE_TRL'] == False) & (bike_df['NONSEP_BIKE_TRL'] == False) & (bike_df['WALK_TRL'] == False) ].index
-bike_df.drop(idx, inplace=True)
-bike_df = bike_df.reset_index()
-
-## Open & free parks
-# print(park_df.PARKSTATUS.value_counts()) # open, fee, proposed, etc.
-park_df = park_df[park_df.PARKSTATUS.isin(['Open'])]
-park_df.dropna(subset=['geometry'], inplace=True)
-park_df = park_df.reset_index(drop=True)
-
-## Relevant building codes (keeping everything for now)
-# print(build_df.NONRES_TYP.value_counts()) # retail, office, schools, eat & drink, medical, public, government, etc.
-### Extract common grocery stores (add in Target manually, usual has a grocery section)
-gmask = build_df.BLDG_DESC.str.contains('Grocery') | build_df.BLDG_NAME.str.contains('Target')
-build_df.loc[gmask , 'NONRES_TYP'] = 'Grocery'
-### Extract hospitals, combine to medical delineation
-mfmask = build_df.NONRES_TYP.isin(['Medical--Commercial','Hospitals and Nursing Homes'])
-build_df.loc[mfmask , 'NONRES_TYP'] = 'Medical Facilities'
-### Keep only relevant categories
-build_df = build_df[build_df.NONRES_TYP.isin(['Grocery','Schools','Eating and Drinking Establishments','Arts Entertainment and Recreation','Religious','Medical Facilities','Transit'])]
-build_df = build_df.reset_index()
-
-# Export as CSV file
-bike_df.to_csv("../data/csv_shapefiles/bikeways.csv", index=False)
-park_df.to_csv("../data/csv_shapefiles/parks.csv", index=False)
-build_df.to_csv("../data/csv_shapefiles/buildings.csv", index=False)
+def clean_bikeways(bike_df):
+    '''
+    Open and relevant bikeways / trails, with boolean columns per trail class
+    '''
+    # print(bike_df.TRLSTATUS.value_counts()) # open, proposed, planned, etc.
+    # print(bike_df.GEN_TYPE.value_counts()) # off-street, on-street, unknown
+    # print(bike_df.SURFACETYP.value_counts()) # asphalt, concrete, snow, etc.
+    # print(bike_df.SUMMER_USE.value_counts()) # multi-use, sidewalk, bike lane, bikeable shoulder, etc.
+    # print(bike_df.WINTER_USE.value_counts()) # multi-use, sidewalk, bike lane, XC ski, snowshoe, etc.
+    ## keep open trails
+    bike_df = bike_df[bike_df.TRLSTATUS.isin(TRAIL_STATUS)]
+    return classify_trails(bike_df).reset_index(names=ID_COLUMN)  # record number in the shapefile as the id
+
+
+def classify_trails(bike_df):
+    '''
+    Boolean variables for types of bike/walking trails (specify trail types to get best results), trails of no type dropped
+    note: vectorized, each (GEN_TYPE, SUMMER_USE) pair is classified once then broadcast to its rows
+    '''
+    pairs = pd.MultiIndex.from_arrays([bike_df.GEN_TYPE.fillna(''), bike_df.SUMMER_USE.fillna('')])
+    codes, uniques = pairs.factorize()
+    gen, use = uniques.get_level_values(0), uniques.get_level_values(1)
+    classes = np.stack([gen.isin(gen_types) & use.isin(summer_uses) for gen_types, summer_uses in TRAIL_CLASSES.values()], axis=1)[codes]
+    keep = classes.any(axis=1)
+    bike_df = bike_df[keep].copy()
+    for i, col in enumerate(TRAIL_CLASSES):
+        bike_df[col] = classes[keep, i]
+    return bike_df
+
+
+def clean_parks(park_df):
+    '''
+    Open & free parks
+    '''
+    # print(park_df.PARKSTATUS.value_counts()) # open, fee, proposed, etc.
+    park_df = park_df[park_df.PARKSTATUS.isin(PARK_STATUS)]
+    park_df = park_df.dropna(subset=['geometry'])
+    return park_df.reset_index(names=ID_COLUMN)
+
+
+def clean_buildings(build_df):
+    '''
+    Relevant building codes, with grocery stores & medical facilities as their own categories
+    '''
+    # print(build_df.NONRES_TYP.value_counts()) # retail, office, schools, eat & drink, medical, public, government, etc.
+    return classify_buildings(build_df).reset_index(names=ID_COLUMN)
+
+
+def classify_buildings(build_df):
+    '''
+    Grocery stores & medical facilities as their own categories, then only the relevant categories
+    '''
+    ### Extract common grocery stores (add in Target manually, usual has a grocery section)
+    gmask = build_df.BLDG_DESC.str.contains(GROCERY_DESC, na=False) | build_df.BLDG_NAME.str.contains(GROCERY_NAMES, na=False)
+    build_df.loc[gmask , 'NONRES_TYP'] = 'Grocery'
+    ### Extract hospitals, combine to medical delineation
+    mfmask = build_df.NONRES_TYP.isin(MEDICAL_TYPES)
+    build_df.loc[mfmask , 'NONRES_TYP'] = 'Medical Facilities'
+    ### Keep only relevant categories
+    return build_df[build_df.NONRES_TYP.isin(BUILDING_TYPES)]
+
+
+if __name__ == '__main__':
+    main()
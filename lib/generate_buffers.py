@@ -3,40 +3,71 @@
 '''
 Creating Buffers from geometries for buildings (points), trails(linestring, multilinestring), parks (polygon, multipolygon).
 
-Usage: python3 generate_buffers.py -t [trail_buffer_meters] -p [park_buffer_meters] -b [building_buffer_meters]
-    optional arguments for output: -o [output_directory] --no_write_out
+Usage: python3 generate_buffers.py -i [input_directory] -t [trail_buffer_meters] -p [park_buffer_meters] -b [building_buffer_meters]
+    optional arguments for output: -o [output_directory] -f [parquet|arrow|csv] --no_write_out
+    or, several radii in one run: python3 generate_buffers.py -i [input_directory] -o [data_directory] --sweep 400 800 1200 1600
+    optional arguments for buffering: -w [workers] --chunk_size [rows] --quad_segs [segments] --simplify [meters]
     optional flag(s) to visualize: --vis_all --vis_ex_buff
 '''
 
 import argparse
 import sys
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
 import geopandas as gpd
-from shapely import wkt
+import shapely
 from shapely.geometry import Point, LineString, MultiLineString, Polygon, MultiPolygon
 import matplotlib.pyplot as plt
 from matplotlib.lines import Line2D
 import contextily as cx
 from shapely.ops import linemerge
+import geostore
+import buffer_sets
+import combine_buffers
+import union_engine
+
+
+# Columns kept per layer : name column (for visualizations) & columns of the buffer files
+NAME_COLUMNS = {'bikeways': 'TRAILNAME', 'parks': 'PARKNAME', 'buildings': 'BLDG_NAME'}
+BUFFER_COLUMNS = {
+    'bikeways': ['id','name','SEP_BIKE_TRL','NONSEP_BIKE_TRL','WALK_TRL','geometry'],
+    'parks': ['id','name','geometry'],
+    'buildings': ['id','name','NONRES_TYP','BLDG_DESC','geometry'],
+}
 
 
 def main():
     # Initialize the parser
     parser = argparse.ArgumentParser(description='Generate buffers for the csv_shapefiles data.')
     reqparse = parser.add_argument_group("required arguments")
-    reqparse.add_argument('-t','--trail_buff', required=True, default=400, type=int,
-        help='Buffer size (meters) for bike/walking trails. [default: 400]')
-    reqparse.add_argument('-p','--park_buff', required=True, default=800, type=int,
-        help='Buffer size (meters) for parks. [default: 800]')
-    reqparse.add_argument('-b','--building_buff', required=True, default=800, type=int,
-        help='Buffer size (meters) for buildings. [default: 800]')
     reqparse.add_argument('-i','--input', required=True, default="../data/csv_shapefiles/", type=str,
         help='Directory in which to find CSV shapefiles. [default: ../data/csv_shapefiles/]')
+    parser.add_argument('-t','--trail_buff', required=False, default=None, type=int,
+        help='Buffer size (meters) for bike/walking trails, needed with -p & -b unless --sweep is given.')
+    parser.add_argument('-p','--park_buff', required=False, default=None, type=int,
+        help='Buffer size (meters) for parks, needed with -t & -b unless --sweep is given.')
+    parser.add_argument('-b','--building_buff', required=False, default=None, type=int,
+        help='Buffer size (meters) for buildings, needed with -t & -p unless --sweep is given.')
     parser.add_argument('-o','--out', required=False, default='.', type=str,
         help='Directory to write the buffer files, directory must already exist. [default: ../data/]')
+    parser.add_argument('-f','--format', required=False, default=geostore.DEFAULT_FORMAT, choices=list(geostore.FORMATS),
+        help='File format of the buffer files. [default: %s]' % geostore.DEFAULT_FORMAT)
     parser.add_argument('--no_write_out',required=False, action='store_true',
         help='Do not write out buffers to file.')
+    parser.add_argument('-w','--workers', required=False, default=1, type=int,
+        help='Number of processes buffering chunks of each layer in parallel. [default: 1]')
+    parser.add_argument('--chunk_size', required=False, default=2000, type=int,
+        help='Rows per chunk when buffering in parallel. [default: 2000]')
+    parser.add_argument('--quad_segs', required=False, default=16, type=int,
+        help='Segments per quarter circle of each buffer, fewer means fewer vertices. [default: 16]')
+    parser.add_argument('--simplify', required=False, default=0, type=float,
+        help='Tolerance (meters) to simplify buffers after buffering, 0 to keep them as is. [default: 0]')
+    parser.add_argument('--sweep', required=False, nargs='+', type=int,
+        help='Radii (meters) to sweep, each used for trails, parks & buildings : writes buffers_<r>t_<r>p_<r>b directories '
+             'with buffers and combined buffers under --out, recorded in its buffers_manifest.json (-t, -p, -b not needed).')
     parser.add_argument('--vis_all', required=False, action='store_true',
         help='Visualize all the geoms (trails, parks, buildings).')
     parser.add_argument('--vis_ex_buff', required=False, action='store_true',
@@ -49,17 +80,26 @@ def main():
 
     # Obtain arguments from command line
     args = parser.parse_args()
+    if args.sweep is None and None in (args.trail_buff, args.park_buff, args.building_buff):
+        parser.error('-t/--trail_buff, -p/--park_buff and -b/--building_buff are required without --sweep')
 
     # CSV to GeoPandas dataframes
-    bike_gdf = read_csv_to_gpd(os.path.join(args.input, 'bikeways.csv'),'TRAILNAME')
-    park_gdf = read_csv_to_gpd(os.path.join(args.input, 'parks.csv'),'PARKNAME')
-    build_gdf = read_csv_to_gpd(os.path.join(args.input, 'buildings.csv'),'BLDG_NAME')
+    bike_gdf = read_csv_to_gpd(geostore.find_layer(args.input, 'bikeways'), NAME_COLUMNS['bikeways'])
+    park_gdf = read_csv_to_gpd(geostore.find_layer(args.input, 'parks'), NAME_COLUMNS['parks'])
+    build_gdf = read_csv_to_gpd(geostore.find_layer(args.input, 'buildings'), NAME_COLUMNS['buildings'])
+
+    # Radius sweep : buffers & combined buffers for every radius, then done
+    buff_opts = {'quad_segs': args.quad_segs, 'simplify': args.simplify, 'workers': args.workers, 'chunk_size': args.chunk_size}
+    if args.sweep is not None:
+        sweep_buffers([bike_gdf, park_gdf, build_gdf], args.sweep, args.out, args.format, **buff_opts)
+        return
 
     # Create Buffers
     ## note: passing values with [:] so gdfs are unaffected (for visualizations)
-    buff_bike = create_buffers(bike_gdf[['id','name','SEP_BIKE_TRL','NONSEP_BIKE_TRL','WALK_TRL','geometry']].copy(), args.trail_buff)
-    buff_park = create_buffers(park_gdf[['id','name','geometry']].copy(), args.park_buff)
-    buff_build = create_buffers(build_gdf[['id','name','NONRES_TYP','geometry']].copy(), args.building_buff)
+    ## note: timing & output vertex counts printed per layer, to weigh accuracy against render cost
+    buff_bike = timed_buffers('trails', bike_gdf[BUFFER_COLUMNS['bikeways']].copy(), args.trail_buff, **buff_opts)
+    buff_park = timed_buffers('parks', park_gdf[BUFFER_COLUMNS['parks']].copy(), args.park_buff, **buff_opts)
+    buff_build = timed_buffers('buildings', build_gdf[BUFFER_COLUMNS['buildings']].copy(), args.building_buff, **buff_opts)
 
     # Visualizations (if requested)
     if args.vis_all:
@@ -70,14 +110,14 @@ def main():
         geom = bike_gdf.loc[[west_river[0]]]  # was [22573,19019,12609*,15185,15442,15960,26171]
         geom['geometry'] = linemerge(MultiLineString([bike_gdf.geometry[i] for i in west_river]))
         geom2 = park_gdf[park_gdf.name.isin(['Mill Ruins Park'])]  # Mill Ruins Park
-        geom3 = build_gdf[build_gdf.id.isin(['3450'])]  # Guthrie Theater
+        geom3 = build_gdf[build_gdf.id.astype(str).isin(['3450'])]  # Guthrie Theater
         geom_all = pd.concat([geom, geom2, geom3])
         ## Corresponding Buffers
         b = buff_bike.loc[[west_river[0]]]  # West River Road, Stone Arch Bridge
         tmp = gpd.GeoSeries([buff_bike.geometry[i] for i in west_river])
         b['geometry'] = tmp.unary_union  # combine into one geometry
         b2 = buff_park[buff_park.name.isin(['Mill Ruins Park'])]  # Mill Ruins Park
-        b3 = buff_build[buff_build.id.isin(['3450'])]  # Guthrie Theater
+        b3 = buff_build[buff_build.id.astype(str).isin(['3450'])]  # Guthrie Theater
         buff_all = pd.concat([b, b2, b3])
         ## Pass to vis_example
         vis_example(geom_all, buff_all, True, 'Example Geoms & Buffers')
@@ -85,22 +125,19 @@ def main():
     # Write out buffers to new file
     ## note minimal information besides buffer geoms in these files since other info already contained in csv_shapefiles
     if args.no_write_out == False:
-        # Write out to csv
-        buff_bike.to_csv(os.path.join(args.out, 'bikeways_buffers.csv'), index=False)
-        buff_park.to_csv(os.path.join(args.out, 'parks_buffers.csv'), index=False)
-        buff_build.to_csv(os.path.join(args.out, 'buildings_buffers.csv'), index=False)
+        # Write out through the geostore (parquet by default)
+        geostore.write_layer(buff_bike, geostore.layer_path(args.out, 'bikeways_buffers', args.format))
+        geostore.write_layer(buff_park, geostore.layer_path(args.out, 'parks_buffers', args.format))
+        geostore.write_layer(buff_build, geostore.layer_path(args.out, 'buildings_buffers', args.format))
 
 
 def read_csv_to_gpd(filepath, name_col):
     '''
-    Read in the csv file, convert to GeoPandas dataframe
+    Read in the layer file (csv, parquet or arrow - see geostore.py), convert to GeoPandas dataframe
     '''
-    # Reading in and updating geometry to NAD 83 CRS
-    df = pd.read_csv(filepath, delimiter=",", header=0, dtype=str, lineterminator='\n')
-    df['geometry'] = df['geometry'].apply(str) # ensure str before conversion
-    df['geometry'] = df['geometry'].apply(wkt.loads) # reading from "Well Known Text" format
-    gdf = gpd.GeoDataFrame(df, crs="epsg:26915").set_geometry('geometry') # setting coordinate reference to NAD 83
-    
+    # Reading in, geometry in NAD 83 CRS
+    gdf = geostore.read_layer(filepath)
+
     # Make some common names (for visualizations)
     gdf.rename(columns={gdf.columns[0]:'id'}, inplace=True)
     gdf['name'] = gdf[name_col]
@@ -118,14 +155,79 @@ def combine_df(df_list):
     return gpd.pd.concat(df_list[::-1], ignore_index=True)
 
 
-def create_buffers(mygdf, radius):
+def create_buffers(mygdf, radius, quad_segs=16, simplify=0, workers=1, chunk_size=2000):
     '''
     Convert the geometries into buffers of the provided size (radius in meters)
+    optionally split into chunks buffered by a pool of workers processes, and simplified afterwards (tolerance in meters)
     '''
-    mygdf.geometry = gpd.GeoSeries(mygdf.geometry).buffer(radius)
+    geoms = mygdf.geometry.values
+    if workers > 1 and len(geoms) > chunk_size:
+        chunks = [geoms[i:i + chunk_size] for i in range(0, len(geoms), chunk_size)]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            parts = pool.map(buffer_chunk, chunks, [radius] * len(chunks), [quad_segs] * len(chunks), [simplify] * len(chunks))
+            buffers = np.concatenate(list(parts))
+    else:
+        buffers = buffer_chunk(geoms, radius, quad_segs, simplify)
+    mygdf.geometry = gpd.GeoSeries(buffers, index=mygdf.index, crs=mygdf.crs)
     return mygdf
 
 
+def sweep_buffers(gdf_list, radii, out_dir, fmt=geostore.DEFAULT_FORMAT, **kwargs):
+    '''
+    Buffers & combined buffers for several radii in one run, written to one directory per radius set under out_dir
+    note: inputs are parsed once, and each group's spatial index is queried once at the largest radius (see union_engine.candidate_pairs)
+    '''
+    bike_gdf, park_gdf, build_gdf = gdf_list
+    cols = [BUFFER_COLUMNS[name] for name in ['bikeways', 'parks', 'buildings']]
+    groups = combine_buffers.split_trails(bike_gdf) + [park_gdf] + combine_buffers.split_buildings(build_gdf)
+    candidates = [union_engine.candidate_pairs(g.geometry.values, 2 * max(radii)) for g in groups]
+
+    for radius in sorted(radii):
+        # buffers of every layer at this radius
+        buff_bike = timed_buffers('trails', bike_gdf[cols[0]].copy(), radius, **kwargs)
+        buff_park = timed_buffers('parks', park_gdf[cols[1]].copy(), radius, **kwargs)
+        buff_build = timed_buffers('buildings', build_gdf[cols[2]].copy(), radius, **kwargs)
+
+        # combined buffers, intersecting pairs filtered from the shared candidates
+        start = time.perf_counter()
+        buff_groups = combine_buffers.split_trails(buff_bike) + [buff_park] + combine_buffers.split_buildings(buff_build)
+        unions = [union_engine.union_components(g.geometry.values, pairs=union_engine.pairs_within(c, g.geometry.values, radius))
+                  for g, c in zip(buff_groups, candidates)]
+        print('combined %d groups at %dm in %.2fs' % (len(unions), radius, time.perf_counter() - start))
+
+        # write out, record in the manifest
+        set_path = os.path.join(out_dir, buffer_sets.set_dir(radius, radius, radius))
+        os.makedirs(set_path, exist_ok=True)
+        geostore.write_layer(buff_bike, geostore.layer_path(set_path, 'bikeways_buffers', fmt))
+        geostore.write_layer(buff_park, geostore.layer_path(set_path, 'parks_buffers', fmt))
+        geostore.write_layer(buff_build, geostore.layer_path(set_path, 'buildings_buffers', fmt))
+        geostore.write_layer(combine_buffers.combine_trails(buff_groups[:4], unions[:4]), geostore.layer_path(set_path, 'combined_bikeway_buffers', fmt))
+        geostore.write_layer(combine_buffers.combine_parks(unions[4]), geostore.layer_path(set_path, 'combined_park_buffers', fmt))
+        geostore.write_layer(combine_buffers.combine_buildings(unions[5:]), geostore.layer_path(set_path, 'combined_building_buffers', fmt))
+        buffer_sets.register_set(out_dir, radius, radius, radius)
+
+
+def buffer_chunk(geoms, radius, quad_segs=16, simplify=0):
+    '''
+    Buffers of an array of geometries (one chunk of a layer)
+    '''
+    buffers = shapely.buffer(np.asarray(geoms), radius, quad_segs=quad_segs)
+    if simplify > 0:
+        buffers = shapely.simplify(buffers, simplify, preserve_topology=True)
+    return buffers
+
+
+def timed_buffers(label, mygdf, radius, **kwargs):
+    '''
+    create_buffers, printing the time taken and the number of vertices in the output
+    '''
+    start = time.perf_counter()
+    out = create_buffers(mygdf, radius, **kwargs)
+    print('%s : %d buffers of %dm in %.2fs, %d vertices' % (label, len(out), radius, time.perf_counter() - start,
+        shapely.get_num_coordinates(out.geometry.values).sum()))
+    return out
+
+
 def visualize(buff_list, buff_names, colors):
     '''
     Visualization of all the geometries
@@ -0,0 +1,217 @@
+#!/usr/bin/env/python3
+
+'''
+Shared storage layer for geometry tables (csv_shapefiles, *_buffers and combined_* files).
+
+Formats are chosen by file extension:
+    .csv      geometry as "Well Known Text" (original format, slow to parse)
+    .parquet  GeoParquet, geometry as WKB in a compressed columnar file
+    .arrow    WKB-in-Arrow IPC file, memory-mapped when read
+
+Usage (convert existing CSVs): python3 geostore.py -i [csv files or directories] -f [parquet|arrow]
+    optional arguments: --remove_csv
+'''
+
+import argparse
+import json
+import os
+import resource
+import time
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+
+# Known formats (in order of preference when more than one copy of a layer exists)
+FORMATS = {'parquet': '.parquet', 'arrow': '.arrow', 'csv': '.csv'}
+DEFAULT_FORMAT = os.environ.get('GEOSTORE_FORMAT', 'parquet')
+DEFAULT_CRS = 'epsg:26915'  # NAD 83 / UTM 15N, the CRS of every CSV in data/
+# Columns the pipeline writes as numbers or booleans, restored when reading a CSV (every other column stays a string)
+## ids (cleaned layers, buffers & combined buffers) & union tree node spans (see union_tree.py)
+INT_COLUMNS = ['index', 'id', 'lo', 'hi']
+## trail class flags (see convert_shp_csv.py)
+BOOL_COLUMNS = ['SEP_BIKE_TRL', 'NONSEP_BIKE_TRL', 'WALK_TRL']
+
+
+def main():
+    # Initialize the parser
+    parser = argparse.ArgumentParser(description='Convert WKT CSV geometry tables to a binary geostore format.')
+    parser.add_argument('-i','--input', required=True, nargs='+', type=str,
+        help='CSV files, or directories containing CSV files, to convert.')
+    parser.add_argument('-f','--format', required=False, default=DEFAULT_FORMAT, choices=['parquet','arrow'],
+        help='Output format. [default: %s]' % DEFAULT_FORMAT)
+    parser.add_argument('--remove_csv', required=False, action='store_true',
+        help='Remove the CSV file once it has been converted.')
+    args = parser.parse_args()
+
+    # Collect CSV files
+    csv_files = []
+    for path in args.input:
+        if os.path.isdir(path):
+            csv_files += sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith('.csv'))
+        else:
+            csv_files.append(path)
+
+    # Convert, reporting load time & size before/after
+    for csv_path in csv_files:
+        out_path = os.path.splitext(csv_path)[0] + FORMATS[args.format]
+        t_csv, gdf = timed(read_layer, csv_path)
+        write_layer(gdf, out_path)
+        t_new, _ = timed(read_layer, out_path)
+        print('%s -> %s : %.1f MB -> %.1f MB, load %.2fs -> %.2fs' % (csv_path, FORMATS[args.format],
+            os.path.getsize(csv_path) / 1e6, os.path.getsize(out_path) / 1e6, t_csv, t_new))
+        if args.remove_csv:
+            os.remove(csv_path)
+    print('peak RSS: %.0f MB' % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+def timed(func, *args):
+    '''
+    Call func(*args), return (seconds, result)
+    '''
+    start = time.perf_counter()
+    out = func(*args)
+    return time.perf_counter() - start, out
+
+
+def layer_path(directory, name, fmt=None):
+    '''
+    Path of a layer called name (e.g. 'parks_buffers') in directory, in the given format
+    '''
+    return os.path.join(directory, name + FORMATS[fmt or DEFAULT_FORMAT])
+
+
+def find_layer(directory, name):
+    '''
+    Path of an existing copy of the layer, preferring binary formats over CSV
+    '''
+    for ext in FORMATS.values():
+        path = os.path.join(directory, name + ext)
+        if os.path.exists(path):
+            return path
+    raise FileNotFoundError('no layer %r in %s (tried %s)' % (name, directory, ', '.join(FORMATS.values())))
+
+
+def read_layer(path, columns=None):
+    '''
+    Read a geometry table into a GeoDataFrame (geometry column 'geometry')
+    '''
+    ext = os.path.splitext(path)[1]
+    if ext == '.csv':
+        gdf = _read_csv(path)
+    elif ext == '.parquet':
+        gdf = gpd.read_parquet(path, columns=None if columns is None else list(columns) + ['geometry'])
+    elif ext == '.arrow':
+        gdf = _read_arrow(path, columns)
+    else:
+        raise ValueError('unknown geostore format: %s' % path)
+    if columns is not None:
+        gdf = gdf[list(columns) + ['geometry']]
+    return gdf
+
+
+def write_layer(gdf, path):
+    '''
+    Write a GeoDataFrame to path, format given by the extension
+    '''
+    ext = os.path.splitext(path)[1]
+    if ext == '.csv':
+        gdf.to_csv(path, index=False)  # geometry written as WKT
+    elif ext == '.parquet':
+        gdf.to_parquet(path, index=False)
+    elif ext == '.arrow':
+        _write_arrow(gdf, path)
+    else:
+        raise ValueError('unknown geostore format: %s' % path)
+    return path
+
+
+def write_batches(batches, path):
+    '''
+    Write GeoDataFrames (batches of one layer, same columns & CRS) to path as they come, format given by the extension
+    note: only the current batch is held in memory, the column types are those of the first batch
+    '''
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    ext = os.path.splitext(path)[1]
+    if ext not in FORMATS.values():
+        raise ValueError('unknown geostore format: %s' % path)
+    schema = writer = sink = None
+    try:
+        for i, gdf in enumerate(batches):
+            if ext == '.csv':
+                gdf.to_csv(path, index=False, mode='a' if i else 'w', header=not i)  # geometry written as WKT
+                continue
+            table = _wkb_table(gdf, schema)
+            if writer is None:
+                # columns with no value in the first batch are typed as strings (the shapefile attribute type)
+                schema = pa.schema([pa.field(f.name, pa.string()) if pa.types.is_null(f.type) else f for f in table.schema])
+                table = table.cast(schema)
+                if ext == '.parquet':
+                    geo = {'version': '1.0.0', 'primary_column': 'geometry', 'columns': {'geometry': {
+                        'encoding': 'WKB', 'geometry_types': [], 'crs': gdf.crs.to_json_dict() if gdf.crs is not None else None}}}
+                    schema = schema.with_metadata({**(schema.metadata or {}), b'geo': json.dumps(geo).encode()})
+                    writer = pq.ParquetWriter(path, schema)
+                else:
+                    meta = {'geometry': 'geometry', 'crs': gdf.crs.to_string() if gdf.crs is not None else None}
+                    schema = schema.with_metadata({**(schema.metadata or {}), b'geostore': json.dumps(meta).encode()})
+                    sink = pa.OSFile(path, 'wb')
+                    writer = pa.ipc.new_file(sink, schema)
+            writer.write_table(table.replace_schema_metadata(schema.metadata))
+    finally:
+        if writer is not None:
+            writer.close()
+        if sink is not None:
+            sink.close()
+    return path
+
+
+def _wkb_table(gdf, schema=None):
+    '''
+    Arrow table of a GeoDataFrame, geometry as WKB in its column's place (attribute columns typed by schema if given)
+    '''
+    import pyarrow as pa
+    attributes = None if schema is None else pa.schema([f for f in schema if f.name != 'geometry'])
+    table = pa.Table.from_pandas(pd.DataFrame(gdf.drop(columns='geometry')), schema=attributes, preserve_index=False)
+    return table.add_column(list(gdf.columns).index('geometry'), 'geometry', pa.array(shapely.to_wkb(gdf.geometry.values), type=pa.binary()))
+
+
+def _read_csv(path):
+    '''
+    WKT CSV, read as strings (as the pipeline scripts always have), then the columns of INT_COLUMNS & BOOL_COLUMNS typed
+    note: nothing else is inferred, codes like CTU_ID 02395733 or ZIP_CODE keep their text
+    '''
+    df = pd.read_csv(path, delimiter=",", header=0, dtype=str, lineterminator='\n')
+    for col in INT_COLUMNS:
+        if col in df:
+            df[col] = pd.to_numeric(df[col])
+    for col in BOOL_COLUMNS:
+        if col in df:
+            df[col] = df[col].map({'True': True, 'False': False})
+    geometry = gpd.GeoSeries.from_wkt(df.pop('geometry'), crs=DEFAULT_CRS)  # vectorized "Well Known Text" parsing
+    return gpd.GeoDataFrame(df, geometry=geometry)
+
+
+def _write_arrow(gdf, path):
+    import pyarrow as pa
+    table = _wkb_table(gdf)
+    meta = {'geometry': 'geometry', 'crs': gdf.crs.to_string() if gdf.crs is not None else None}
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), b'geostore': json.dumps(meta).encode()})
+    with pa.OSFile(path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+
+
+def _read_arrow(path, columns=None):
+    import pyarrow as pa
+    with pa.memory_map(path, 'r') as source:  # pages shared with the OS cache rather than copied
+        table = pa.ipc.open_file(source).read_all()
+    meta = json.loads(table.schema.metadata[b'geostore'])
+    if columns is not None:
+        table = table.select(list(columns) + [meta['geometry']])
+    geometry = shapely.from_wkb(table.column(meta['geometry']).to_numpy(zero_copy_only=False))
+    df = table.drop([meta['geometry']]).to_pandas()
+    return gpd.GeoDataFrame(df, geometry=gpd.GeoSeries(geometry, crs=meta['crs']))
+
+
+if __name__ == '__main__':
+    main()
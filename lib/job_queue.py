@@ -0,0 +1,270 @@
+#!/usr/bin/env/python3
+
+'''
+Background jobs for recomputations the app cannot do within a request (e.g. a new buffer radius set) : a SQLite
+queue & result store in the data directory, no other service. The app only inserts & reads rows; a runner process
+(started by gunicorn.conf.py, or python3 job_queue.py work) claims queued jobs and runs each one in a child process at
+low priority, at most JOB_CONCURRENCY jobs running at once across every runner. A job identical to one queued, running
+or done (same kind & parameters) is not queued again, its id is returned instead.
+
+Usage: python3 job_queue.py work -d [data_directory]   (run jobs until stopped)
+       python3 job_queue.py submit radius_set '{"trail": 400, "park": 800, "building": 800}' -d [data_directory]
+       python3 job_queue.py list -d [data_directory]
+'''
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import signal
+import sqlite3
+import subprocess
+import sys
+import time
+import buffer_sets
+import pipeline
+
+
+DATABASE = 'jobs.sqlite'
+# Jobs running at once (all runners together), a 0.1 CPU host should keep it at 1
+JOB_CONCURRENCY = int(os.environ.get('JOB_CONCURRENCY', 1))
+# Niceness of the job processes, request threads go first
+JOB_NICE = 10
+# Seconds between two looks at the queue
+POLL_SECONDS = 1.0
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    params TEXT NOT NULL,
+    status TEXT NOT NULL,            -- queued, running, done or failed
+    progress REAL NOT NULL DEFAULT 0,
+    message TEXT NOT NULL DEFAULT '',
+    result TEXT,
+    runner INTEGER,                  -- pid of the runner of a running job
+    submitted REAL NOT NULL,
+    started REAL,
+    finished REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
+'''
+
+
+def main():
+    # Initialize the parser
+    parser = argparse.ArgumentParser(description='Run, submit or list the background jobs of a data directory.')
+    parser.add_argument('command', choices=['work', 'submit', 'list'],
+        help='work : run jobs until stopped, submit : queue a job, list : print the latest jobs.')
+    parser.add_argument('kind', nargs='?', choices=list(KINDS),
+        help='Kind of job to submit.')
+    parser.add_argument('params', nargs='?', default='{}', type=str,
+        help='Parameters of the job to submit, as JSON. [default: {}]')
+    parser.add_argument('-d','--data', required=False, default=pipeline.DATA_DIR, type=str,
+        help='Data directory (queue in %s). [default: the repository data directory]' % DATABASE)
+    parser.add_argument('-c','--concurrency', required=False, default=JOB_CONCURRENCY, type=int,
+        help='Jobs running at once. [default: JOB_CONCURRENCY or 1]')
+    args = parser.parse_args()
+
+    if args.command == 'work':
+        work(args.data, args.concurrency)
+    elif args.command == 'submit':
+        print('job %d' % submit(args.data, args.kind, json.loads(args.params)))
+    else:
+        for job in list_jobs(args.data):
+            print('%4d %-10s %-8s %3d%% %s %s' % (job['id'], job['kind'], job['status'], job['progress'] * 100, json.dumps(job['params']), job['message']))
+
+
+def radius_set_job(data_dir, params, progress):
+    '''
+    Buffers, combined buffers, union trees & overlay of a radius set (from the cleaned layers), recorded in the manifest
+    '''
+    radii = tuple(int(params[k]) for k in ['trail', 'park', 'building'])
+    if not all(0 < r <= 5000 for r in radii):
+        raise ValueError('radii must be between 1 and 5000 meters')
+    nodes = pipeline.build_dag(data_dir, radii, from_cleaned=True)
+    report = pipeline.run_dag(nodes, data_dir, workers=1, progress=lambda done, total: progress(done / total, '%d of %d steps' % (done, total)))
+    failed = [name for name, (status, _) in report.items() if status in ('failed', 'blocked')]
+    if failed:
+        raise RuntimeError('steps failed : %s' % ', '.join(failed))
+    return {'set': buffer_sets.register_set(data_dir, *radii)}
+
+
+# Kinds of jobs : func(data_dir, params, progress) -> result (JSON serializable), progress(fraction, message)
+KINDS = {'radius_set': radius_set_job}
+
+
+def connect(data_dir):
+    '''
+    Connection to the queue of a data directory (created when missing), autocommit, rows as sqlite3.Row
+    '''
+    conn = sqlite3.connect(os.path.join(data_dir, DATABASE), timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')  # readers (the app) never wait for the runner's writes
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def job_key(kind, params):
+    '''
+    Key of identical jobs : hash of the kind & parameters
+    '''
+    return hashlib.sha1(json.dumps([kind, params], sort_keys=True).encode()).hexdigest()
+
+
+def as_dict(row):
+    '''
+    Job row as a dict, params & result decoded
+    '''
+    job = dict(row)
+    job['params'] = json.loads(job['params'])
+    job['result'] = json.loads(job['result']) if job['result'] else None
+    return job
+
+
+def result_exists(data_dir, result):
+    '''
+    Whether what a done job built is still there : its radius set recorded in the manifest, with its directory
+    '''
+    if not result or 'set' not in result:
+        return True
+    return result['set'] in [s['dir'] for s in buffer_sets.read_manifest(data_dir)] and os.path.isdir(os.path.join(data_dir, result['set']))
+
+
+def submit(data_dir, kind, params):
+    '''
+    Queue a job, id of the identical queued, running or done job if there is one (failed jobs & done jobs whose
+    radius set was removed since are queued again)
+    '''
+    if kind not in KINDS:
+        raise ValueError('unknown kind of job %r' % kind)
+    key = job_key(kind, params)
+    conn = connect(data_dir)
+    try:
+        conn.execute('BEGIN IMMEDIATE')  # one writer : two identical submissions cannot both insert
+        row = conn.execute("SELECT id, status, result FROM jobs WHERE key = ? AND status IN ('queued', 'running', 'done') ORDER BY id DESC LIMIT 1", (key,)).fetchone()
+        if row is None or (row['status'] == 'done' and not result_exists(data_dir, json.loads(row['result']))):
+            row = [conn.execute("INSERT INTO jobs (kind, key, params, status, submitted) VALUES (?, ?, ?, 'queued', ?)",
+                                (kind, key, json.dumps(params), time.time())).lastrowid]
+        conn.execute('COMMIT')
+        return row[0]
+    finally:
+        conn.close()
+
+
+def list_jobs(data_dir, ids=None, limit=20):
+    '''
+    Jobs by id (all of them), else the latest ones, newest first
+    '''
+    conn = connect(data_dir)
+    try:
+        if ids is not None:
+            rows = conn.execute('SELECT * FROM jobs WHERE id IN (%s) ORDER BY id DESC' % ','.join('?' * len(ids)), list(ids)).fetchall() if ids else []
+        else:
+            rows = conn.execute('SELECT * FROM jobs ORDER BY id DESC LIMIT ?', (limit,)).fetchall()
+        return [as_dict(r) for r in rows]
+    finally:
+        conn.close()
+
+
+def update(data_dir, job_id, **fields):
+    '''
+    Set fields of a job
+    '''
+    conn = connect(data_dir)
+    try:
+        conn.execute('UPDATE jobs SET %s WHERE id = ?' % ', '.join('%s = ?' % k for k in fields), list(fields.values()) + [job_id])
+    finally:
+        conn.close()
+
+
+def claim(conn, concurrency=JOB_CONCURRENCY):
+    '''
+    Oldest queued job, now running under this runner, or None (nothing queued, or concurrency jobs already running)
+    '''
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        running = conn.execute("SELECT count(*) FROM jobs WHERE status = 'running'").fetchone()[0]
+        row = conn.execute("SELECT * FROM jobs WHERE status = 'queued' ORDER BY id LIMIT 1").fetchone() if running < concurrency else None
+        if row is not None:
+            conn.execute("UPDATE jobs SET status = 'running', runner = ?, started = ?, progress = 0, message = '' WHERE id = ?",
+                         (os.getpid(), time.time(), row['id']))
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    return as_dict(row) if row is not None else None
+
+
+def requeue_orphans(conn):
+    '''
+    Queue again the running jobs whose runner is gone (killed, host restarted)
+    '''
+    for row in conn.execute("SELECT id, runner FROM jobs WHERE status = 'running'").fetchall():
+        try:
+            os.kill(row['runner'], 0)
+        except (ProcessLookupError, TypeError):
+            conn.execute("UPDATE jobs SET status = 'queued', runner = NULL, message = 'requeued' WHERE id = ?", (row['id'],))
+        except PermissionError:
+            pass  # alive, another user's process
+
+
+def run_job(data_dir, job):
+    '''
+    Run one job (in its own process), recording its progress, result or error
+    '''
+    os.nice(JOB_NICE)
+    def progress(fraction, message=''):
+        update(data_dir, job['id'], progress=min(max(fraction, 0.0), 1.0), message=message)
+    try:
+        result = KINDS[job['kind']](data_dir, job['params'], progress)
+    except Exception as e:
+        update(data_dir, job['id'], status='failed', message='%s: %s' % (type(e).__name__, e), finished=time.time())
+        return
+    update(data_dir, job['id'], status='done', progress=1.0, message='', result=json.dumps(result), finished=time.time())
+
+
+def work(data_dir, concurrency=JOB_CONCURRENCY, poll=POLL_SECONDS):
+    '''
+    Claim & run jobs until stopped (SIGTERM or SIGINT), jobs cut short are queued again
+    '''
+    def stop(signum, frame):
+        raise SystemExit(0)
+    signal.signal(signal.SIGTERM, stop)
+    conn = connect(data_dir)
+    requeue_orphans(conn)
+    running = {}  # job id : process
+    try:
+        while True:
+            for job_id, process in list(running.items()):
+                if not process.is_alive():
+                    del running[job_id]
+                    if process.exitcode != 0:  # died without recording anything
+                        update(data_dir, job_id, status='failed', message='job process exited with code %s' % process.exitcode, finished=time.time())
+            while len(running) < concurrency:
+                job = claim(conn, concurrency)
+                if job is None:
+                    break
+                process = multiprocessing.Process(target=run_job, args=(data_dir, job), name='job %d' % job['id'])
+                process.start()
+                running[job['id']] = process
+            time.sleep(poll)
+    finally:
+        for job_id, process in running.items():
+            process.terminate()
+            process.join()
+            update(data_dir, job_id, status='queued', runner=None, message='requeued')
+        conn.close()
+
+
+def start_runner(data_dir, concurrency=JOB_CONCURRENCY):
+    '''
+    Start a runner (python3 job_queue.py work) in its own process, next to the app; the caller terminates it
+    '''
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__), 'work', '-d', data_dir, '-c', str(concurrency)])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env/python3
+
+'''
+Level-of-detail pyramid for the combined buffers : topology-preserving simplified copies of each layer,
+one per zoom band, so the map only receives the vertices visible at the current zoom.
+
+Usage: python3 lod_pyramid.py -i [buffer_directory]
+    optional arguments: -f [parquet|arrow|csv]
+'''
+
+import argparse
+import math
+import shapely
+import geostore
+
+
+# Zoom bands : (level, simplification tolerance in meters), tolerance is half a screen pixel at the
+#    lowest zoom of the band (Web Mercator at the Twin Cities latitude); last level is full resolution
+LAT = 44.95
+MIN_LEVEL, MAX_LEVEL = 8, 14
+ZOOM_BANDS = [(z, 0.5 * 156543.03 * math.cos(math.radians(LAT)) / 2**z) for z in range(MIN_LEVEL, MAX_LEVEL)] + [(MAX_LEVEL, 0.0)]
+LAYERS = ['combined_bikeway_buffers', 'combined_park_buffers', 'combined_building_buffers']
+
+
+def main():
+    # Initialize the parser
+    parser = argparse.ArgumentParser(description='Precompute simplified copies of the combined buffers per zoom band.')
+    parser.add_argument('-i','--input', required=False, default='../data/buffers_800t_1000p_1000b', type=str,
+        help='Directory with the combined_* buffer files. [default: ../data/buffers_800t_1000p_1000b]')
+    parser.add_argument('-f','--format', required=False, default=geostore.DEFAULT_FORMAT, choices=list(geostore.FORMATS),
+        help='File format of the pyramid levels. [default: %s]' % geostore.DEFAULT_FORMAT)
+    args = parser.parse_args()
+
+    # Write one file per layer & level, report vertex counts
+    for name in LAYERS:
+        base = geostore.read_layer(geostore.find_layer(args.input, name))
+        for level, gdf in build_pyramid(base).items():
+            if level == MAX_LEVEL:
+                continue  # full resolution is the base layer itself
+            geostore.write_layer(gdf, geostore.layer_path(args.input, level_name(name, level), args.format))
+            print('%s z%d : %d vertices (full resolution %d)' % (name, level,
+                shapely.get_num_coordinates(gdf.geometry.values).sum(), shapely.get_num_coordinates(base.geometry.values).sum()))
+
+
+def level_name(name, level):
+    '''
+    Layer name of one pyramid level, e.g. combined_park_buffers_z10
+    '''
+    return '%s_z%d' % (name, level)
+
+
+def level_for_zoom(zoom):
+    '''
+    Pyramid level to use for a (fractional) map zoom
+    '''
+    return min(max(int(math.floor(zoom)), MIN_LEVEL), MAX_LEVEL)
+
+
+def simplify_layer(gdf, tolerance):
+    '''
+    Copy of the layer simplified with the given tolerance (meters), keeping valid polygons
+    '''
+    out = gdf.copy()
+    if tolerance > 0:
+        out['geometry'] = gdf.geometry.simplify(tolerance, preserve_topology=True)
+    return out
+
+
+def build_pyramid(gdf):
+    '''
+    All levels of one layer (gdf in a projected CRS, meters), {level: simplified gdf}
+    '''
+    return {level: simplify_layer(gdf, tolerance) for level, tolerance in ZOOM_BANDS}
+
+
+def load_pyramid(directory, name):
+    '''
+    All levels of one layer, read from precomputed files when present, simplified in memory otherwise
+    '''
+    base = geostore.read_layer(geostore.find_layer(directory, name))
+    levels = {}
+    for level, tolerance in ZOOM_BANDS:
+        try:
+            levels[level] = geostore.read_layer(geostore.find_layer(directory, level_name(name, level)))
+        except FileNotFoundError:
+            levels[level] = simplify_layer(base, tolerance)
+    return levels
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,280 @@
+#!/usr/bin/env/python3
+
+'''
+Lightweight request metrics for the Dash server : timing spans, histograms & counters, exposed in the Prometheus text
+format. Each process (gunicorn worker) keeps its own values & writes them to a file of METRICS_DIR every few seconds;
+a scrape merges the files of every worker, so /metrics is right whichever worker answers it.
+
+Optional sampling profiler : PROFILE_SAMPLE_HZ=<samples per second> samples the stacks of the request threads,
+merged like the metrics as collapsed stacks ("frame;frame;frame count", flame graph input).
+
+Usage (from app.py):
+    with metrics.span('combine_df'): ...
+    metrics.inc('walkable_selection_total', element='WALK_TRL')
+    metrics.observe('walkable_response_bytes', len(body), route='/_dash-update-component')
+'''
+
+import atexit
+import bisect
+import glob
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+
+# Histogram buckets (upper bounds), seconds & bytes
+SECONDS_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+BYTES_BUCKETS = [1e3, 1e4, 1e5, 3e5, 1e6, 3e6, 1e7, 3e7, 1e8]
+FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 5))  # seconds between writes of this process' file
+PROFILE_SAMPLE_HZ = float(os.environ.get('PROFILE_SAMPLE_HZ', 0))  # 0 : profiler off
+
+# Metrics known to the exposition : name -> (type, help, buckets)
+_described = {}
+# Values of this process : (name, labels) -> value (counters) or [bucket counts, sum, count] (histograms)
+_counters = {}
+_histograms = {}
+_stacks = Counter()
+_active = set()  # threads serving a request, the ones the profiler samples
+_lock = threading.Lock()
+_last_flush = 0.0
+_token = None  # this process' file name, set on first flush (after gunicorn forks the workers)
+
+
+def metrics_dir():
+    '''
+    Directory shared by the workers : METRICS_DIR, else a temporary directory named after the process group
+    (gunicorn's master & workers share it)
+    '''
+    return os.environ.get('METRICS_DIR') or os.path.join(tempfile.gettempdir(), 'walkable_metrics_%d' % os.getpgrp())
+
+
+def describe(name, kind, help_text, buckets=None):
+    '''
+    Declare a metric ('counter' or 'histogram', buckets for histograms)
+    '''
+    _described[name] = (kind, help_text, buckets)
+
+
+def inc(name, value=1, **labels):
+    '''
+    Add to a counter
+    '''
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+    maybe_flush()
+
+
+def observe(name, value, **labels):
+    '''
+    Add an observation to a histogram
+    '''
+    key = (name, tuple(sorted(labels.items())))
+    buckets = _described[name][2]
+    with _lock:
+        h = _histograms.get(key)
+        if h is None:
+            h = _histograms[key] = [[0] * (len(buckets) + 1), 0.0, 0]
+        h[0][bisect.bisect_left(buckets, value)] += 1  # last slot is +Inf
+        h[1] += value
+        h[2] += 1
+    maybe_flush()
+
+
+@contextmanager
+def span(phase, name='walkable_phase_seconds'):
+    '''
+    Time the block into the phase histogram
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, phase=phase)
+
+
+def request_started():
+    '''
+    Mark the current thread as serving a request (for the profiler)
+    '''
+    _active.add(threading.get_ident())
+
+
+def request_finished():
+    '''
+    Unmark the current thread
+    '''
+    _active.discard(threading.get_ident())
+
+
+def maybe_flush():
+    '''
+    Write this process' values if the last write is older than FLUSH_INTERVAL
+    '''
+    if time.monotonic() - _last_flush >= FLUSH_INTERVAL:
+        flush()
+
+
+def flush():
+    '''
+    Write this process' values (& profile) to its file of the metrics directory (write then rename)
+    '''
+    global _last_flush, _token
+    _last_flush = time.monotonic()
+    if _token is None:
+        _token = '%d_%d' % (os.getpid(), time.time_ns())  # unique even if a pid is reused by a later worker
+    with _lock:  # held through the write, so concurrent flushes of the request threads do not overlap
+        snapshot = {'counters': [[n, l, v] for (n, l), v in _counters.items()],
+                    'histograms': [[n, l, h[0], h[1], h[2]] for (n, l), h in _histograms.items()],
+                    'stacks': dict(_stacks)}
+        directory = metrics_dir()
+        os.makedirs(directory, exist_ok=True)
+        write_snapshot(os.path.join(directory, 'metrics_%s.json' % _token), snapshot)
+
+
+def write_snapshot(path, snapshot):
+    '''
+    Write a snapshot to its file (write then rename, the temporary file named after the thread)
+    '''
+    tmp = '%s.%d.tmp' % (path, threading.get_ident())
+    with open(tmp, 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(tmp, path)
+
+
+def retire(pid):
+    '''
+    Fold the file of an exited worker into metrics_retired.json & remove it, so the totals are kept without one file
+    per worker ever started (called by the gunicorn master, see gunicorn.conf.py)
+    '''
+    directory = metrics_dir()
+    paths = glob.glob(os.path.join(directory, 'metrics_%d_*.json' % pid))
+    if not paths:
+        return
+    retired = os.path.join(directory, 'metrics_retired.json')
+    counters, histograms, stacks = merge([retired] + paths)
+    write_snapshot(retired, {'counters': [[n, l, v] for (n, l), v in counters.items()],
+                             'histograms': [[n, l, h[0], h[1], h[2]] for (n, l), h in histograms.items()],
+                             'stacks': dict(stacks)})
+    for path in paths:
+        os.remove(path)
+
+
+def collect():
+    '''
+    Values merged across every process' file : (counters, histograms, stacks), keyed as in this process
+    note: exited workers' values are kept (see retire), so counters never go backwards
+    '''
+    flush()
+    return merge(glob.glob(os.path.join(metrics_dir(), 'metrics_*.json')))
+
+
+def merge(paths):
+    '''
+    Values of metric files summed : (counters, histograms, stacks), missing or unreadable files skipped
+    '''
+    counters, histograms, stacks = {}, {}, Counter()
+    for path in paths:
+        try:
+            with open(path) as f:
+                snap = json.load(f)
+        except (OSError, ValueError):
+            continue  # removed or being replaced
+        for n, l, v in snap['counters']:
+            key = (n, tuple(map(tuple, l)))
+            counters[key] = counters.get(key, 0) + v
+        for n, l, buckets, total, count in snap['histograms']:
+            key = (n, tuple(map(tuple, l)))
+            h = histograms.setdefault(key, [[0] * len(buckets), 0.0, 0])
+            h[0] = [a + b for a, b in zip(h[0], buckets)]
+            h[1] += total
+            h[2] += count
+        stacks.update(snap.get('stacks', {}))
+    return counters, histograms, stacks
+
+
+def label_text(labels, extra=()):
+    '''
+    {a="x",b="y"} label set of the text format
+    '''
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in pairs)
+
+
+def exposition():
+    '''
+    Every metric, merged across processes, in the Prometheus text format (version 0.0.4)
+    '''
+    counters, histograms, _ = collect()
+    lines = []
+    for name, (kind, help_text, buckets) in _described.items():
+        lines += ['# HELP %s %s' % (name, help_text), '# TYPE %s %s' % (name, kind)]
+        if kind == 'counter':
+            lines += ['%s%s %s' % (name, label_text(l), repr(float(v))) for (n, l), v in sorted(counters.items()) if n == name]
+            continue
+        for (n, l), (counts, total, count) in sorted(histograms.items()):
+            if n != name:
+                continue
+            cumulative = 0
+            for bound, c in zip(buckets + ['+Inf'], counts):
+                cumulative += c
+                lines.append('%s_bucket%s %d' % (name, label_text(l, [('le', bound if bound == '+Inf' else repr(float(bound)))]), cumulative))
+            lines += ['%s_sum%s %s' % (name, label_text(l), repr(total)), '%s_count%s %d' % (name, label_text(l), count)]
+    return '\n'.join(lines) + '\n'
+
+
+def profile_text():
+    '''
+    Sampled stacks merged across processes, collapsed (one "frame;frame;frame count" line per stack)
+    '''
+    return ''.join('%s %d\n' % (s, c) for s, c in collect()[2].most_common())
+
+
+def start_profiler(hz=PROFILE_SAMPLE_HZ):
+    '''
+    Sample the stacks of the threads serving a request hz times a second (daemon thread), no-op if hz is 0
+    note: call it in each worker (e.g. on its first request), threads do not survive a fork
+    '''
+    if hz <= 0 or getattr(start_profiler, 'pid', None) == os.getpid():
+        return
+    def sample():
+        while True:
+            time.sleep(1 / hz)
+            frames = sys._current_frames()
+            for ident in list(_active):
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append('%s (%s:%d)' % (frame.f_code.co_name, os.path.basename(frame.f_code.co_filename), frame.f_code.co_firstlineno))
+                    frame = frame.f_back
+                with _lock:
+                    _stacks[';'.join(reversed(stack))] += 1
+    start_profiler.pid = os.getpid()
+    threading.Thread(target=sample, name='metrics-profiler', daemon=True).start()
+
+
+def _after_fork():
+    '''
+    In a forked worker : start from empty values & a file of its own (the parent's values are in the parent's file)
+    '''
+    global _token, _last_flush, _lock
+    _lock = threading.Lock()
+    _token, _last_flush = None, 0.0
+    _counters.clear()
+    _histograms.clear()
+    _stacks.clear()
+    _active.clear()
+
+
+# parent's values written before every fork (gunicorn --preload), then reset in the child
+os.register_at_fork(before=lambda: (_counters or _histograms) and flush(), after_in_child=_after_fork)
+atexit.register(lambda: (_counters or _histograms or _stacks) and flush())
@@ -0,0 +1,177 @@
+#!/usr/bin/env/python3
+
+'''
+Network-distance reach areas over the bikeway linework : walkable areas measured along trails and bike routes
+instead of as Euclidean buffers (a trail across the river with no bridge is no longer "800 m away").
+
+The reach areas are already one row per trail group, one for parks & one per building type, which is what
+combine_buffers.py would make of them (--keep_isolated), so they are written as the combined_* files of a radius set
+(reach_<r>t_<r>p_<r>b) and recorded in the manifest : the app's walking distance slider lists them.
+
+Usage: python3 network_reach.py -i [input_directory] -o [data_directory] -r 400 800 1200 1600
+    optional arguments: --snap [meters] --width [meters] -f [parquet|arrow|csv]
+'''
+
+import argparse
+import os
+import time
+import numpy as np
+import shapely
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import dijkstra
+import geostore
+import buffer_sets
+import combine_buffers
+
+
+GRID = 0.5  # meters, vertices closer than this become one graph node
+
+
+def main():
+    # Initialize the parser
+    parser = argparse.ArgumentParser(description='Reach areas along the bikeway network for trails, parks and buildings.')
+    parser.add_argument('-i','--input', required=False, default='../data/csv_shapefiles/', type=str,
+        help='Directory with the bikeways, parks and buildings files. [default: ../data/csv_shapefiles/]')
+    parser.add_argument('-o','--out', required=False, default='../data', type=str,
+        help='Data directory, one reach_<r>t_<r>p_<r>b directory is written & recorded in its manifest per radius. [default: ../data]')
+    parser.add_argument('-r','--radii', required=True, nargs='+', type=int,
+        help='Network distances (meters) to compute, all from a single shortest path pass per category.')
+    parser.add_argument('--snap', required=False, default=100, type=float,
+        help='Largest distance (meters) between a park or building and the network node it is snapped to. [default: 100]')
+    parser.add_argument('--width', required=False, default=50, type=float,
+        help='Half width (meters) of the reach area around reached network segments. [default: 50]')
+    parser.add_argument('-f','--format', required=False, default=geostore.DEFAULT_FORMAT, choices=list(geostore.FORMATS),
+        help='File format of the reach files. [default: %s]' % geostore.DEFAULT_FORMAT)
+    args = parser.parse_args()
+
+    # Inputs (NAD 83)
+    bike_gdf = geostore.read_layer(geostore.find_layer(args.input, 'bikeways'))
+    park_gdf = geostore.read_layer(geostore.find_layer(args.input, 'parks'))
+    build_gdf = geostore.read_layer(geostore.find_layer(args.input, 'buildings'))
+
+    # Graph
+    start = time.perf_counter()
+    graph, nodes, line_nodes = build_graph(bike_gdf.geometry.values)
+    print('graph : %d nodes, %d edges in %.2fs' % (graph.shape[0], graph.nnz, time.perf_counter() - start))
+
+    # Sources per category : nodes of each trail group, nodes near parks, nodes nearest to each building type
+    categories = [line_sources(line_nodes, np.flatnonzero(bike_gdf.index.isin(g.index))) for g in combine_buffers.split_trails(bike_gdf)]
+    categories.append(snap_sources(nodes, park_gdf.geometry.values, args.snap))
+    categories += [snap_sources(nodes, g.geometry.values, args.snap) for g in combine_buffers.split_buildings(build_gdf)]
+
+    # One shortest path pass per category (up to the largest radius), reach areas for every radius
+    start = time.perf_counter()
+    dists = [reach_distances(graph, src, offsets, max(args.radii)) for src, offsets in categories]
+    print('shortest paths for %d categories in %.2fs' % (len(dists), time.perf_counter() - start))
+    for radius in sorted(args.radii):
+        start = time.perf_counter()
+        areas = [reach_area(graph, nodes, d, radius, args.width) for d in dists]
+        name = 'reach_%dt_%dp_%db' % (radius, radius, radius)
+        out_dir = os.path.join(args.out, name)
+        os.makedirs(out_dir, exist_ok=True)
+        geostore.write_layer(combine_buffers.combine_trails(combine_buffers.split_trails(bike_gdf), areas[:4]),
+                             geostore.layer_path(out_dir, 'combined_bikeway_buffers', args.format))
+        geostore.write_layer(combine_buffers.combine_parks(areas[4]), geostore.layer_path(out_dir, 'combined_park_buffers', args.format))
+        geostore.write_layer(combine_buffers.combine_buildings(areas[5:]), geostore.layer_path(out_dir, 'combined_building_buffers', args.format))
+        buffer_sets.register_set(args.out, radius, radius, radius, name=name, network=True)
+        print('reach areas at %dm in %.2fs -> %s' % (radius, time.perf_counter() - start, out_dir))
+
+
+def build_graph(lines):
+    '''
+    Array-backed graph of the linework : nodes are line vertices (merged on a GRID), edges are segments weighted by length
+    returns (symmetric CSR adjacency, node coordinates (n, 2), node index of every vertex per input line [(line, node)])
+    '''
+    parts, part_line = shapely.get_parts(lines, return_index=True)  # multilinestrings -> linestrings
+    coords, vert_part = shapely.get_coordinates(parts, return_index=True)
+    keys = np.round(coords / GRID).astype(np.int64)
+    _, first, node_of = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+    node_of = node_of.ravel()
+    nodes = coords[first]
+
+    # Segments between consecutive vertices of the same part, without loops or duplicates (shortest kept)
+    same = vert_part[:-1] == vert_part[1:]
+    u, v = node_of[:-1][same], node_of[1:][same]
+    w = np.hypot(*(coords[1:][same] - coords[:-1][same]).T)
+    u, v = np.minimum(u, v), np.maximum(u, v)
+    keep = u != v
+    u, v, w = u[keep], v[keep], w[keep]
+    order = np.lexsort((w, v, u))
+    u, v, w = u[order], v[order], w[order]
+    first_edge = np.ones(len(u), dtype=bool)
+    first_edge[1:] = (u[1:] != u[:-1]) | (v[1:] != v[:-1])
+    u, v, w = u[first_edge], v[first_edge], w[first_edge]
+
+    n = len(nodes)
+    graph = coo_matrix((np.concatenate([w, w]), (np.concatenate([u, v]), np.concatenate([v, u]))), shape=(n, n)).tocsr()
+    line_nodes = (part_line[vert_part], node_of)
+    return graph, nodes, line_nodes
+
+
+def line_sources(line_nodes, lines):
+    '''
+    Source nodes (no offset) : every node on the given input lines
+    '''
+    vert_line, node_of = line_nodes
+    src = np.unique(node_of[np.isin(vert_line, lines)])
+    return src, np.zeros(len(src))
+
+
+def snap_sources(nodes, geoms, max_snap):
+    '''
+    Source nodes & offsets (meters) for amenities : points snap to their nearest node, polygons to every node
+    inside or within max_snap of them; amenities further than max_snap from the network are left out
+    '''
+    tree = shapely.STRtree(shapely.points(nodes))
+    geoms = geoms[~shapely.is_missing(geoms) & ~shapely.is_empty(geoms)]
+    points = shapely.get_type_id(geoms) == 0
+    near_g, near_n = tree.query_nearest(geoms[points], max_distance=max_snap, all_matches=False)
+    poly_g, poly_n = tree.query(geoms[~points], predicate='dwithin', distance=max_snap)
+    src = np.concatenate([near_n, poly_n])
+    offsets = np.concatenate([shapely.distance(geoms[points][near_g], tree.geometries[near_n]),
+                              shapely.distance(geoms[~points][poly_g], tree.geometries[poly_n])])
+    return src, offsets
+
+
+def reach_distances(graph, sources, offsets, limit):
+    '''
+    Network distance from the nearest source to every node (inf beyond limit), one multi-source pass
+    note: a virtual node linked to every source (edge = the source's snap offset) carries the offsets
+    '''
+    n = graph.shape[0]
+    if len(sources) == 0:
+        return np.full(n, np.inf)
+    src, inv = np.unique(sources, return_inverse=True)
+    off = np.full(len(src), np.inf)
+    np.minimum.at(off, inv.ravel(), offsets)  # closest amenity per source node
+    g = graph.tocoo()
+    extra = coo_matrix((np.maximum(off, 1e-9), (np.full(len(src), n), src)), shape=(n + 1, n + 1))
+    full = (coo_matrix((g.data, (g.row, g.col)), shape=(n + 1, n + 1)) + extra).tocsr()
+    return dijkstra(full, directed=True, indices=n, limit=limit)[:n]
+
+
+def reach_area(graph, nodes, dist, radius, width):
+    '''
+    Polygon covering the network within radius of the sources (partial segments included), widened by width
+    '''
+    g = graph.tocoo()
+    up = g.row < g.col  # each undirected edge once
+    u, v, w = g.row[up], g.col[up], g.data[up]
+    left_u, left_v = np.clip(radius - dist[u], 0, None), np.clip(radius - dist[v], 0, None)
+    full = left_u + left_v >= w
+    segs = []
+    # fully reached edges
+    segs.append(np.stack([nodes[u[full]], nodes[v[full]]], axis=1))
+    # partially reached edges, walked in from either end
+    for a, b, left in ((u, v, left_u), (v, u, left_v)):
+        part = ~full & (left > 0)
+        t = (left[part] / w[part])[:, None]
+        segs.append(np.stack([nodes[a[part]], nodes[a[part]] + (nodes[b[part]] - nodes[a[part]]) * t], axis=1))
+    segs = np.concatenate(segs)
+    if len(segs) == 0:
+        return shapely.Polygon()
+    return shapely.buffer(shapely.multilinestrings(shapely.linestrings(segs)), width, quad_segs=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+#!/usr/bin/env/python3
+
+'''
+Planar overlay of the combined buffers : the boundaries of all combined rows (trail groups, parks, building types) are
+noded together & polygonized into faces no boundary crosses, each face tagged with the bitmask of the rows covering it
+(bits as in point_query.build_index). Faces are stored once as a topology - rings of shared arcs, the arcs simplified
+per zoom band - so the region within reach of every selected category is a filter on the face masks and a dissolve
+that drops the arcs two selected faces share, with no polygon boolean operation per request.
+
+Usage: python3 overlay.py -i [buffer_directory]   (writes overlay_faces.npz next to the combined buffers)
+'''
+
+import argparse
+import json
+import os
+import time
+from collections import defaultdict
+import numpy as np
+import geopandas as gpd
+import pyproj
+import shapely
+import geostore
+import lod_pyramid
+import point_query
+import score_grid
+import shared_geometry
+import topojson_wire
+
+
+# Grid the face vertices are snapped to when cutting arcs (meters), well below any buffer detail
+SNAP = 0.001
+
+
+def main():
+    # Initialize the parser
+    parser = argparse.ArgumentParser(description='Precompute the planar overlay (faces & layer bitmasks) of the combined buffers.')
+    parser.add_argument('-i','--input', required=False, default='../data/buffers_800t_1000p_1000b', type=str,
+        help='Directory with the combined_* buffer files, the overlay is written here. [default: ../data/buffers_800t_1000p_1000b]')
+    args = parser.parse_args()
+
+    # Layers in their projected CRS (meters)
+    layers = [geostore.read_layer(geostore.find_layer(args.input, name))
+              for name in ['combined_bikeway_buffers', 'combined_park_buffers', 'combined_building_buffers']]
+    start = time.perf_counter()
+    overlay = build_overlay(*layers)
+    seconds = time.perf_counter() - start
+    path = save_overlay(overlay, overlay_path(args.input))
+    print('%d faces, %d distinct masks, %d arcs in %.2fs -> %s (%.1f MB)' % (len(overlay['mask']), len(np.unique(overlay['mask'])),
+        len(overlay['arc_nodes']), seconds, path, os.path.getsize(path) / 1e6))
+
+    # Region within reach of everything, per level
+    masks = score_grid.selection_masks(overlay, point_query.TRAIL_CLASSES, True, list(overlay['labels']['building_bits']))
+    faces = select_faces(overlay, masks)
+    for level in overlay['levels']:
+        start = time.perf_counter()
+        polygons = dissolve(overlay, faces, level)
+        print('z%d : %d of %d faces within reach of everything -> %d polygons, %d vertices in %.3fs' % (level, len(faces), len(overlay['mask']),
+            len(polygons), sum(len(ring) for polygon in polygons for ring in polygon), time.perf_counter() - start))
+
+
+def overlay_path(directory):
+    '''
+    File of a precomputed overlay
+    '''
+    return os.path.join(directory, 'overlay_faces.npz')
+
+
+def build_overlay(trail, park, building):
+    '''
+    Faces of the combined layers (GeoDataFrames in a projected CRS, meters) with their bitmasks, as a topology
+    {'mask', 'bounds' (lon/lat), 'face_rings', 'ring_arcs', 'arcs', 'arc_nodes', 'coords' & 'offsets' {level: ...}, 'labels'}
+    note: faces covered by no row are dropped, kept faces are oriented (exteriors counter-clockwise, holes clockwise)
+    '''
+    geoms = np.concatenate([trail.geometry.values, park.geometry.values, building.geometry.values])
+    lines = shapely.union_all(shapely.boundary(geoms))  # noded : boundaries only meet at vertices
+    faces = shapely.get_parts(shapely.polygonize(shapely.get_parts(lines)))
+
+    # a face lies wholly inside or outside each row, one interior point tells which
+    x, y = shapely.get_coordinates(shapely.point_on_surface(faces)).T
+    mask = np.zeros(len(faces), dtype=np.uint16)
+    for bit, geom in enumerate(geoms):
+        shapely.prepare(geom)
+        mask |= shapely.contains_xy(geom, x, y).astype(np.uint16) << np.uint16(bit)
+    keep = mask > 0
+    faces, mask = shapely.orient_polygons(faces[keep]), mask[keep]
+
+    # shared edges as arcs, cut where faces meet (exact vertices, snapped to SNAP only to compare them)
+    packed = shared_geometry.PackedGeometry.from_geoms(faces)
+    transform = {'scale': [SNAP, SNAP], 'translate': np.asarray(packed.coords).min(axis=0).tolist()}
+    topology = topojson_wire.encode([(packed, i) for i in range(len(faces))], transform=transform)
+    face_rings = [ring for geometry in topology['objects']['shapes']['geometries'] for polygon in geometry['arcs'] for ring in polygon]
+    ring_counts = [sum(len(polygon) for polygon in geometry['arcs']) for geometry in topology['objects']['shapes']['geometries']]
+    quantized = [np.cumsum(np.asarray(arc, dtype=np.int64), axis=0) for arc in topology['arcs']]
+
+    # arc ends as node ids, to chain arcs into rings
+    ends = np.array([[(a[0, 0] << 32) | a[0, 1], (a[-1, 0] << 32) | a[-1, 1]] for a in quantized], dtype=np.int64).reshape(-1, 2)
+    _, nodes = np.unique(ends, return_inverse=True)
+
+    # arc coordinates per zoom band, each arc simplified on its own (ends kept, so neighbouring faces still match)
+    to_lonlat = pyproj.Transformer.from_crs(trail.crs, 4326, always_xy=True)
+    sizes = [len(a) for a in quantized]
+    arcs = shapely.linestrings(np.concatenate(quantized) * SNAP + transform['translate'], indices=np.repeat(np.arange(len(sizes)), sizes)) \
+        if quantized else np.array([])
+    coords, offsets = {}, {}
+    for level, tolerance in lod_pyramid.ZOOM_BANDS:
+        simplified = shapely.simplify(arcs, tolerance, preserve_topology=False) if tolerance > 0 else arcs
+        xy, arc_i = shapely.get_coordinates(simplified, return_index=True)
+        coords[level] = np.column_stack(to_lonlat.transform(xy[:, 0], xy[:, 1]))
+        offsets[level] = np.concatenate([[0], np.cumsum(np.bincount(arc_i, minlength=len(quantized)))]).astype(np.int64)
+
+    return with_index({
+        'mask': mask,
+        'bounds': gpd.GeoSeries(faces, crs=trail.crs).to_crs(epsg=4326).bounds.values,
+        'face_rings': np.concatenate([[0], np.cumsum(ring_counts)]).astype(np.int64),
+        'ring_arcs': np.concatenate([[0], np.cumsum([len(ring) for ring in face_rings])]).astype(np.int64),
+        'arcs': np.array([a for ring in face_rings for a in ring], dtype=np.int64),
+        'arc_nodes': nodes.reshape(-1, 2).astype(np.int64),
+        'coords': coords, 'offsets': offsets, 'levels': [level for level, _ in lod_pyramid.ZOOM_BANDS],
+        'labels': point_query.bit_labels(trail, park, building),
+    })
+
+
+def with_index(overlay):
+    '''
+    Overlay with an STRtree over the bounding boxes of its faces
+    '''
+    overlay['tree'] = shapely.STRtree(shapely.box(*overlay['bounds'].T))
+    return overlay
+
+
+def save_overlay(overlay, path):
+    '''
+    Write an overlay to a compressed .npz file
+    '''
+    levels = {}
+    for level in overlay['levels']:
+        levels['coords_z%d' % level], levels['offsets_z%d' % level] = overlay['coords'][level], overlay['offsets'][level]
+    meta = {'levels': overlay['levels'], 'labels': overlay['labels']}
+    np.savez_compressed(path, meta=json.dumps(meta), **{k: overlay[k] for k in ['mask', 'bounds', 'face_rings', 'ring_arcs', 'arcs', 'arc_nodes']}, **levels)
+    return path
+
+
+def load_overlay(path):
+    '''
+    Read an overlay written by save_overlay
+    '''
+    with np.load(path) as f:
+        meta = json.loads(str(f['meta']))
+        overlay = {k: f[k] for k in ['mask', 'bounds', 'face_rings', 'ring_arcs', 'arcs', 'arc_nodes']}
+        overlay['coords'] = {level: f['coords_z%d' % level] for level in meta['levels']}
+        overlay['offsets'] = {level: f['offsets_z%d' % level] for level in meta['levels']}
+    return with_index({**overlay, **meta})
+
+
+def select_faces(overlay, masks, area=None):
+    '''
+    Faces covered by every one of the masks (see score_grid.selection_masks; none for no masks), only those meeting
+    an area (min lon, min lat, max lon, max lat) when given
+    '''
+    if not masks:
+        return np.zeros(0, dtype=np.int64)
+    keep = np.ones(len(overlay['mask']), dtype=bool)
+    for m in masks:
+        keep &= (overlay['mask'] & m) != 0
+    if area is not None:
+        near = np.zeros(len(keep), dtype=bool)
+        near[overlay['tree'].query(shapely.box(*area))] = True
+        keep &= near
+    return np.flatnonzero(keep)
+
+
+def ranges(lo, hi):
+    '''
+    Concatenated aranges lo[k]..hi[k]
+    '''
+    sizes = hi - lo
+    return np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes - lo, sizes)
+
+
+def dissolve(overlay, faces, level=lod_pyramid.MAX_LEVEL):
+    '''
+    Union of faces as polygons (lists of lon/lat ring arrays, exterior first) at a zoom band : the arcs used once
+    among the faces are the boundary, chained end to end into rings
+    '''
+    rings = ranges(overlay['face_rings'][faces], overlay['face_rings'][faces + 1])
+    uses = overlay['arcs'][ranges(overlay['ring_arcs'][rings], overlay['ring_arcs'][rings + 1])]
+    arc = np.where(uses < 0, ~uses, uses)
+    once = np.bincount(arc, minlength=len(overlay['arc_nodes']))[arc] == 1
+    uses, arc = uses[once], arc[once]
+    start = np.where(uses < 0, overlay['arc_nodes'][arc, 1], overlay['arc_nodes'][arc, 0]).tolist()
+    end = np.where(uses < 0, overlay['arc_nodes'][arc, 0], overlay['arc_nodes'][arc, 1]).tolist()
+
+    # chain arcs : follow the boundary from node to node back to the ring's first node
+    outgoing = defaultdict(list)
+    for k, node in enumerate(start):
+        outgoing[node].append(k)
+    coords, offsets = overlay['coords'][level], overlay['offsets'][level]
+    used = np.zeros(len(uses), dtype=bool)
+    shells, holes = [], []
+    for first in range(len(uses)):
+        if used[first]:
+            continue
+        chain, node = [first], end[first]
+        used[first] = True
+        while node != start[first]:
+            nxt = next((k for k in outgoing[node] if not used[k]), None)
+            if nxt is None:
+                break  # open chain (broken topology), dropped
+            used[nxt] = True
+            chain.append(nxt)
+            node = end[nxt]
+        if node != start[first]:
+            continue
+        parts = [coords[offsets[arc[k]]:offsets[arc[k] + 1]][::-1 if uses[k] < 0 else 1] for k in chain]
+        ring = np.concatenate([parts[0]] + [p[1:] for p in parts[1:]])
+        area = np.sum(ring[:-1, 0] * ring[1:, 1] - ring[1:, 0] * ring[:-1, 1]) / 2
+        if len(ring) < 4 or area == 0:
+            continue  # collapsed by the simplification
+        (shells if area > 0 else holes).append((abs(area), ring))
+
+    # holes go to the smallest shell around them
+    shells.sort(key=lambda s: s[0])
+    polygons = [[ring] for _, ring in shells]
+    shell_bounds = np.array([[*ring.min(axis=0), *ring.max(axis=0)] for _, ring in shells]).reshape(-1, 4)
+    for _, ring in holes:
+        lo, hi = ring.min(axis=0), ring.max(axis=0)
+        around = np.flatnonzero((shell_bounds[:, 0] <= lo[0]) & (shell_bounds[:, 1] <= lo[1]) & (shell_bounds[:, 2] >= hi[0]) & (shell_bounds[:, 3] >= hi[1]))
+        x, y = (ring[0] + ring[1]) / 2
+        owner = next((s for s in around if len(around) == 1 or shapely.contains_xy(shapely.Polygon(shells[s][1]), x, y)), None)
+        if owner is not None:
+            polygons[owner].append(ring)
+    return polygons
+
+
+if __name__ == '__main__':
+    main()
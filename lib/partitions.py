@@ -0,0 +1,254 @@
+#!/usr/bin/env/python3
+
+'''
+Region-partitioned layout of a radius set, so the app loads only the part of the map it draws : every pyramid level
+of the combined buffers (see lod_pyramid.py) is reprojected to lon/lat & cut into the cells of a square degree grid
+(the tile grid of viewport.py at zoom GRID_ZOOM), one .npz of flat arrays per level & cell. A small index
+(partitions/index.json) holds what the app needs without any geometry : the rows' attributes, the attribute filter
+values, the data bounds, named regions & the bounds and size of every cell. The app reads the cells meeting the area it
+sends and keeps them in a cache evicting the least recently used past a memory cap.
+
+Usage: python3 partitions.py -i [buffer_directory]   (writes partitions/ in the buffer directory)
+    optional arguments: -g [grid zoom] -r [name min_lon min_lat max_lon max_lat] (repeat for each region)
+'''
+
+import argparse
+import json
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import shapely
+import geostore
+import lod_pyramid
+import shared_geometry
+import union_tree
+import viewport
+
+
+# Grid of the partitions : cells of 360 / 2**GRID_ZOOM degrees (about 55 x 78 km in Minnesota at zoom 9)
+GRID_ZOOM = 9
+INDEX = 'index.json'
+# Attribute filter values stored in the index (see union_tree.py), {layer: columns}
+FILTER_COLUMNS = {'buildings': ['name', 'BLDG_DESC'], 'parks': ['name']}
+
+
+def main():
+    # Initialize the parser
+    parser = argparse.ArgumentParser(description='Cut the combined buffers of a radius set into region partitions with an index.')
+    parser.add_argument('-i','--input', required=False, default='../data/buffers_800t_1000p_1000b', type=str,
+        help='Directory with the combined_* buffer files, the partitions are written to its partitions/ directory. [default: ../data/buffers_800t_1000p_1000b]')
+    parser.add_argument('-g','--grid', required=False, default=GRID_ZOOM, type=int,
+        help='Zoom of the partition grid, cells of 360 / 2**grid degrees. [default: %d]' % GRID_ZOOM)
+    parser.add_argument('-r','--region', required=False, default=[], nargs=5, action='append', metavar=('NAME', 'MIN_LON', 'MIN_LAT', 'MAX_LON', 'MAX_LAT'),
+        help='Named region of the app\'s region selector (repeat for several), the first one is shown at start. [default: the data bounds]')
+    args = parser.parse_args()
+
+    regions = [(name, [float(v) for v in bounds]) for name, *bounds in args.region]
+    start = time.perf_counter()
+    index = build_partitions(args.input, args.grid, regions)
+    print('%d cells, %d levels in %.1fs -> %s' % (len(index['cells']), len(index['levels']), time.perf_counter() - start, partition_dir(args.input)))
+    for level in index['levels']:
+        sizes = [cell['bytes'][str(level)] for cell in index['cells']]
+        print('    z%d : %.1f MB, largest cell %.1f MB' % (level, sum(sizes) / 1e6, max(sizes) / 1e6))
+    print('index : %.1f KB' % (os.path.getsize(os.path.join(partition_dir(args.input), INDEX)) / 1e3))
+
+
+def partition_dir(directory):
+    '''
+    Directory of the partitions of a radius set
+    '''
+    return os.path.join(directory, 'partitions')
+
+
+def cell_path(directory, level, key):
+    '''
+    File of one level & cell, e.g. partitions/z10/372_194.npz
+    '''
+    return os.path.join(partition_dir(directory), 'z%d' % level, key + '.npz')
+
+
+def cell_bounds(x, y, step):
+    '''
+    (min lon, min lat, max lon, max lat) of grid cell x, y (counted from lon -180, lat -90)
+    '''
+    return (x * step - 180, y * step - 90, (x + 1) * step - 180, (y + 1) * step - 90)
+
+
+def clip_geoms(geoms, bounds):
+    '''
+    MultiPolygons of geometries clipped to bounds (empty where nothing is left), edges touching the bounds dropped
+    '''
+    parts, at = shapely.get_parts(shapely.clip_by_rect(geoms, *bounds), return_index=True)
+    keep = (shapely.get_type_id(parts) == 3) & ~shapely.is_empty(parts)
+    multi = np.array([shapely.MultiPolygon()] * len(geoms))
+    if keep.any():
+        rows = np.unique(at[keep])
+        multi[rows] = shapely.multipolygons(parts[keep], indices=np.searchsorted(rows, at[keep]))
+    return multi
+
+
+def build_partitions(directory, grid=GRID_ZOOM, regions=()):
+    '''
+    Write the partitions & index of a radius set, regions as [(name, bounds)] (default : the data bounds), return the index
+    note: the index is written last, a set without it is read whole by the app
+    '''
+    step = 360.0 / 2**grid
+    pyramids, rows = {}, {}
+    for name in lod_pyramid.LAYERS:
+        levels = lod_pyramid.load_pyramid(directory, name)
+        pyramids[name] = {level: gdf.to_crs(epsg=4326).geometry.values for level, gdf in levels.items()}
+        rows[name] = json.loads(levels[lod_pyramid.MAX_LEVEL].drop(columns='geometry').to_json(orient='records'))
+    full = np.concatenate([pyramid[lod_pyramid.MAX_LEVEL] for pyramid in pyramids.values()])
+    bounds = shapely.total_bounds(full).tolist()
+
+    # cells of the grid over the data, kept when some geometry falls in them
+    cells = []
+    tree = shapely.STRtree(full)
+    for x in range(math.floor((bounds[0] + 180) / step), math.floor((bounds[2] + 180) / step) + 1):
+        for y in range(math.floor((bounds[1] + 90) / step), math.floor((bounds[3] + 90) / step) + 1):
+            box = cell_bounds(x, y, step)
+            if len(tree.query(shapely.box(*box), predicate='intersects')):
+                cells.append({'key': '%d_%d' % (x, y), 'bounds': list(box), 'bytes': {}})
+
+    for level, _ in lod_pyramid.ZOOM_BANDS:
+        os.makedirs(os.path.dirname(cell_path(directory, level, 'x')), exist_ok=True)
+        for cell in cells:
+            arrays = {}
+            for name, pyramid in pyramids.items():
+                clipped = clip_geoms(pyramid[level], cell['bounds'])
+                present = np.flatnonzero(~shapely.is_empty(clipped))
+                packed = shared_geometry.PackedGeometry.from_geoms(clipped[present]) if len(present) else \
+                    shared_geometry.PackedGeometry(np.zeros((0, 2)), *[np.zeros(1, dtype=np.int64)] * 3)
+                arrays.update({'%s_rows' % name: present.astype(np.int64), '%s_coords' % name: np.asarray(packed.coords),
+                               '%s_rings' % name: packed.rings, '%s_polys' % name: packed.polys, '%s_geoms' % name: packed.geoms})
+            np.savez(cell_path(directory, level, cell['key']), **arrays)
+            cell['bytes'][str(level)] = sum(a.nbytes for a in arrays.values())
+
+    # regions of the app's selector, with the map view showing each
+    regions = list(regions) or [('All data', bounds)]
+    views = [viewport.fit_view(b) for _, b in regions]
+    index = {
+        'grid': grid, 'step': step, 'levels': [level for level, _ in lod_pyramid.ZOOM_BANDS], 'bounds': bounds,
+        'rows': rows, 'filters': filter_values(directory),
+        'regions': [{'name': name, 'bounds': list(b), 'center': center, 'zoom': zoom} for (name, b), (center, zoom) in zip(regions, views)],
+        'cells': cells,
+    }
+    path = os.path.join(partition_dir(directory), INDEX)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(path + '.tmp', path)
+    return index
+
+
+def filter_values(directory):
+    '''
+    Values of the attribute filter columns of the uncombined buffers (union tree leaves when present), {layer: {column: values}}
+    '''
+    values = {}
+    for name, columns in FILTER_COLUMNS.items():
+        try:
+            gdf = geostore.read_layer(geostore.find_layer(directory, union_tree.tree_names(name)[0]))
+        except FileNotFoundError:
+            try:
+                gdf = geostore.read_layer(geostore.find_layer(directory, name + '_buffers'))
+            except FileNotFoundError:
+                continue
+        values[name] = {c: sorted(gdf[c].dropna().astype(str).unique().tolist()) for c in columns if c in gdf}
+    return values
+
+
+def load_index(directory):
+    '''
+    Partition index of a radius set, None when it is not partitioned
+    '''
+    path = os.path.join(partition_dir(directory), INDEX)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def cells_in(index, area):
+    '''
+    Keys of the cells meeting an area (None : all of them)
+    '''
+    if area is None:
+        return [cell['key'] for cell in index['cells']]
+    return [cell['key'] for cell in index['cells'] if cell['bounds'][0] < area[2] and cell['bounds'][2] > area[0]
+            and cell['bounds'][1] < area[3] and cell['bounds'][3] > area[1]]
+
+
+def read_cell(directory, level, key):
+    '''
+    One level & cell : {layer: (PackedGeometry, rows of the layer it holds)}, with its size in bytes
+    '''
+    with np.load(cell_path(directory, level, key)) as f:
+        cell = {name: (shared_geometry.PackedGeometry(f[name + '_coords'], f[name + '_rings'], f[name + '_polys'], f[name + '_geoms']), f[name + '_rows'])
+                for name in lod_pyramid.LAYERS}
+    return cell, sum(shapes.nbytes + rows.nbytes for shapes, rows in cell.values())
+
+
+class PartitionCache:
+    '''
+    Cells loaded on first use, the least recently used evicted once their arrays pass max_bytes (shared by threads)
+    '''
+    def __init__(self, max_bytes):
+        self.max_bytes, self.nbytes = max_bytes, 0
+        self.cells = OrderedDict()  # key : (value, bytes)
+        self.hits = self.misses = self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, load):
+        '''
+        Value of a key, load() -> (value, bytes) when missing
+        '''
+        with self.lock:
+            if key in self.cells:
+                self.cells.move_to_end(key)
+                self.hits += 1
+                return self.cells[key][0]
+        value, nbytes = load()
+        with self.lock:
+            self.misses += 1
+            if key not in self.cells:
+                self.cells[key] = (value, nbytes)
+                self.nbytes += nbytes
+            while self.nbytes > self.max_bytes and len(self.cells) > 1:
+                _, (_, evicted) = self.cells.popitem(last=False)
+                self.nbytes -= evicted
+                self.evictions += 1
+        return value
+
+    def info(self):
+        '''
+        Counts & size : {'hits', 'misses', 'evictions', 'cells', 'bytes'}
+        '''
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'cells': len(self.cells), 'bytes': self.nbytes}
+
+
+def read_area(directory, index, level, area, cache):
+    '''
+    Rows of each layer at a level with the geometry of the cells meeting an area, {layer: DataFrame of the index's rows
+    with shapes & shape_i} (rows with no geometry there are empty); cells read through a PartitionCache
+    '''
+    cells = [cache.get((os.path.abspath(directory), level, key), lambda key=key: read_cell(directory, level, key)) for key in cells_in(index, area)]
+    frames = {}
+    for name in lod_pyramid.LAYERS:
+        parts = [[] for _ in index['rows'][name]]
+        for cell in cells:
+            shapes, rows = cell[name]
+            for i, row in enumerate(rows.tolist()):
+                parts[row].append((shapes, i))
+        df = pd.DataFrame(index['rows'][name])
+        df['shapes'] = [shared_geometry.PackedGeometry.from_rows(parts)] * len(df)
+        df['shape_i'] = np.arange(len(df))
+        frames[name] = df
+    return frames
+
+
+if __name__ == '__main__':
+    main()
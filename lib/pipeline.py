@@ -0,0 +1,291 @@
+#!/usr/bin/env/python3
+
+'''
+Incremental preprocessing pipeline : convert_shp_csv -> generate_buffers -> combine_buffers, one DAG node per stage & layer
+(bikeways, parks, buildings), union trees of the park & building buffers (union_tree.py), then the planar overlay of
+the three combined layers (overlay.py) & their region partitions (partitions.py). A node is keyed by the content hashes of its input files and its parameters
+(radii, trail classes, btypes, ...) and skipped when its key & outputs are unchanged, independent layers run in parallel.
+
+Usage (from any directory): python3 lib/pipeline.py -t 800 -p 1000 -b 1000
+    optional arguments: -d [data_directory] -f [parquet|arrow|csv] -w [workers] --quad_segs [segments] --simplify [meters]
+                        --keep_isolated --from_cleaned --force --dry_run
+'''
+
+import argparse
+import hashlib
+import json
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import geostore
+import buffer_sets
+import convert_shp_csv
+import generate_buffers
+import combine_buffers
+import lod_pyramid
+import overlay
+import partitions
+import union_tree
+
+
+LAYERS = ['bikeways', 'parks', 'buildings']
+COMBINED = {'bikeways': 'combined_bikeway_buffers', 'parks': 'combined_park_buffers', 'buildings': 'combined_building_buffers'}
+SHAPEFILE_PARTS = ['.shp', '.shx', '.dbf', '.prj', '.cpg']  # files of a shapefile hashed as its content
+STATE = 'pipeline_state.json'
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+
+# One unit of work : func(node) reads node.inputs & writes node.outputs, deps are names of upstream nodes
+Node = namedtuple('Node', ['name', 'func', 'inputs', 'outputs', 'params', 'deps'])
+
+
+def main():
+    # Initialize the parser
+    parser = argparse.ArgumentParser(description='Rebuild the cleaned layers, buffers & combined buffers, skipping what is up to date.')
+    parser.add_argument('-t','--trail_buff', required=False, default=800, type=int,
+        help='Buffer size (meters) for bike/walking trails. [default: 800]')
+    parser.add_argument('-p','--park_buff', required=False, default=1000, type=int,
+        help='Buffer size (meters) for parks. [default: 1000]')
+    parser.add_argument('-b','--building_buff', required=False, default=1000, type=int,
+        help='Buffer size (meters) for buildings. [default: 1000]')
+    parser.add_argument('-d','--data', required=False, default=DATA_DIR, type=str,
+        help='Data directory (mn_geospatialcommons in, csv_shapefiles & buffers_<t>t_<p>p_<b>b out). [default: the repository data directory]')
+    parser.add_argument('-f','--format', required=False, default=geostore.DEFAULT_FORMAT, choices=list(geostore.FORMATS),
+        help='File format of the outputs. [default: %s]' % geostore.DEFAULT_FORMAT)
+    parser.add_argument('-w','--workers', required=False, default=os.cpu_count(), type=int,
+        help='Number of nodes run in parallel. [default: number of CPUs]')
+    parser.add_argument('--quad_segs', required=False, default=16, type=int,
+        help='Segments per quarter circle of each buffer. [default: 16]')
+    parser.add_argument('--simplify', required=False, default=0, type=float,
+        help='Tolerance (meters) to simplify buffers after buffering, 0 to keep them as is. [default: 0]')
+    parser.add_argument('--keep_isolated', required=False, action='store_true',
+        help='Keep buffers intersecting no other buffer of their group when combining.')
+    parser.add_argument('--from_cleaned', required=False, action='store_true',
+        help='Start from the cleaned layers of csv_shapefiles (no shapefiles needed).')
+    parser.add_argument('--force', required=False, action='store_true',
+        help='Run every node, even if up to date.')
+    parser.add_argument('--dry_run', required=False, action='store_true',
+        help='Only print which nodes would run.')
+    args = parser.parse_args()
+
+    radii = (args.trail_buff, args.park_buff, args.building_buff)
+    nodes = build_dag(args.data, radii, args.format, args.quad_segs, args.simplify, args.keep_isolated, args.from_cleaned)
+    start = time.perf_counter()
+    report = run_dag(nodes, args.data, args.workers, args.force, args.dry_run)
+
+    # Report, time per node
+    for name, (status, seconds) in report.items():
+        print('%-20s %-9s %7.2fs' % (name, status, seconds))
+    print('%d nodes run, %d up to date in %.2fs' % (sum(s == 'ran' for s, _ in report.values()),
+        sum(s == 'skipped' for s, _ in report.values()), time.perf_counter() - start))
+
+    # Radius set ready for the app
+    if any(s == 'failed' for s, _ in report.values()):
+        raise SystemExit(1)
+    if not args.dry_run:
+        buffer_sets.register_set(args.data, *radii)
+
+
+def build_dag(data_dir, radii, fmt=geostore.DEFAULT_FORMAT, quad_segs=16, simplify=0, keep_isolated=False, from_cleaned=False):
+    '''
+    Nodes of the pipeline for one radius set (trail, park, building), listed in dependency order
+    note: with from_cleaned the cleaned layers of csv_shapefiles are used as they are (any format), no convert nodes
+    '''
+    set_path = os.path.join(data_dir, buffer_sets.set_dir(*radii))
+    nodes = []
+    for name, radius in zip(LAYERS, radii):
+        shp = os.path.join(data_dir, 'mn_geospatialcommons', convert_shp_csv.SHAPEFILES[name])
+        clean = geostore.find_layer(os.path.join(data_dir, 'csv_shapefiles'), name) if from_cleaned else \
+            geostore.layer_path(os.path.join(data_dir, 'csv_shapefiles'), name, fmt)
+        buffers = geostore.layer_path(set_path, name + '_buffers', fmt)
+        combined = geostore.layer_path(set_path, COMBINED[name], fmt)
+        groups = combine_buffers.trail_groups if name == 'bikeways' else combine_buffers.btypes if name == 'buildings' else []
+        if not from_cleaned:
+            nodes.append(Node('convert:' + name, run_convert, [os.path.splitext(shp)[0] + ext for ext in SHAPEFILE_PARTS], [clean],
+                              {'layer': name, 'rules': convert_shp_csv.rules(name)}, []))
+        nodes += [
+            Node('buffer:' + name, run_buffers, [clean], [buffers],
+                 {'layer': name, 'radius': radius, 'quad_segs': quad_segs, 'simplify': simplify}, [] if from_cleaned else ['convert:' + name]),
+            Node('combine:' + name, run_combine, [buffers], [combined],
+                 {'layer': name, 'groups': groups, 'keep_isolated': keep_isolated}, ['buffer:' + name]),
+        ]
+        if name in union_tree.FILTER_LAYERS:
+            nodes.append(Node('tree:' + name, run_tree, [buffers], [geostore.layer_path(set_path, layer, fmt) for layer in union_tree.tree_names(name)],
+                              {'layer': name, 'groups': union_tree.GROUP_COLUMNS[name], 'leaf_size': union_tree.LEAF_SIZE}, ['buffer:' + name]))
+    nodes.append(Node('overlay', run_overlay, [geostore.layer_path(set_path, COMBINED[name], fmt) for name in LAYERS],
+                      [overlay.overlay_path(set_path)], {'snap': overlay.SNAP, 'levels': lod_pyramid.ZOOM_BANDS}, ['combine:' + name for name in LAYERS]))
+    nodes.append(Node('partition', run_partition, [geostore.layer_path(set_path, COMBINED[name], fmt) for name in LAYERS],
+                      [os.path.join(partitions.partition_dir(set_path), partitions.INDEX)], {'grid': partitions.GRID_ZOOM, 'levels': lod_pyramid.ZOOM_BANDS},
+                      ['combine:' + name for name in LAYERS]))
+    return nodes
+
+
+def run_dag(nodes, data_dir, workers=1, force=False, dry_run=False, progress=None):
+    '''
+    Run the nodes that are out of date, each as soon as its dependencies are done, up to workers at once
+    returns {node name: (ran|skipped|failed|blocked|would run, seconds)} in node order
+    note: progress(settled, total) is called as nodes settle (ran, skipped, failed or blocked)
+    note: keys are computed once the dependencies have run, so a node whose inputs came out identical is still skipped
+    '''
+    state = load_state(data_dir)
+    report = {}
+    pending = list(nodes)
+    running = {}
+    with ProcessPoolExecutor(max_workers=max(workers, 1)) as pool:
+        while pending or running:
+            # start (or skip) every node whose dependencies are settled
+            for node in [n for n in pending if all(d in report for d in n.deps)]:
+                pending.remove(node)
+                deps = [report[d][0] for d in node.deps]
+                if any(s in ('failed', 'blocked') for s in deps):
+                    report[node.name] = ('blocked', 0.0)
+                elif dry_run:
+                    stale = force or 'would run' in deps or not up_to_date(node, node_key(node, state, data_dir), state)
+                    report[node.name] = ('would run' if stale else 'skipped', 0.0)
+                else:
+                    key = node_key(node, state, data_dir)
+                    if not force and up_to_date(node, key, state):
+                        report[node.name] = ('skipped', 0.0)
+                    else:
+                        running[pool.submit(timed_run, node)] = (node, key)
+            if progress:
+                progress(len(report), len(nodes))
+            if not running:
+                continue
+
+            # record finished nodes, state saved after each so an interrupted run keeps its progress
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                node, key = running.pop(future)
+                try:
+                    seconds = future.result()
+                except Exception as e:
+                    print('%s failed : %r' % (node.name, e))
+                    report[node.name] = ('failed', 0.0)
+                    continue
+                state['nodes'][node.name] = {'key': key, 'outputs': [os.path.relpath(p, data_dir) for p in node.outputs], 'seconds': seconds}
+                save_state(state, data_dir)
+                report[node.name] = ('ran', seconds)
+    return {n.name: report[n.name] for n in nodes}
+
+
+def node_key(node, state, data_dir):
+    '''
+    Hash of a node's name, parameters & input file contents
+    '''
+    h = hashlib.sha256(node.name.encode())
+    h.update(json.dumps(node.params, sort_keys=True).encode())
+    for path in node.inputs:
+        h.update(file_hash(path, state, data_dir).encode() if os.path.exists(path) else b'missing')
+    return h.hexdigest()
+
+
+def up_to_date(node, key, state):
+    '''
+    Whether a node last ran with this key & its outputs are still there
+    '''
+    return state['nodes'].get(node.name, {}).get('key') == key and all(os.path.exists(p) for p in node.outputs)
+
+
+def file_hash(path, state, data_dir):
+    '''
+    sha256 of a file's content, remembered in the state by (size, mtime) so unchanged files are not read again
+    '''
+    st = os.stat(path)
+    name = os.path.relpath(path, data_dir)
+    cached = state['files'].get(name)
+    if cached and cached[:2] == [st.st_size, st.st_mtime_ns]:
+        return cached[2]
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    state['files'][name] = [st.st_size, st.st_mtime_ns, h.hexdigest()]
+    return h.hexdigest()
+
+
+def load_state(data_dir):
+    '''
+    Keys of the nodes last run & hashes of the files seen, from the state file of the data directory
+    '''
+    path = os.path.join(data_dir, STATE)
+    if not os.path.exists(path):
+        return {'nodes': {}, 'files': {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_state(state, data_dir):
+    '''
+    Write the state file (write then rename, as buffer_sets.register_set)
+    '''
+    path = os.path.join(data_dir, STATE)
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def timed_run(node):
+    '''
+    Run a node (in a worker process), return the time taken
+    '''
+    start = time.perf_counter()
+    for path in node.outputs:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    node.func(node)
+    return time.perf_counter() - start
+
+
+def run_convert(node):
+    '''
+    Stage 1 : clean the layer's shapefile (see convert_shp_csv.py)
+    '''
+    convert_shp_csv.convert_layer(node.params['layer'], node.inputs[0], node.outputs[0])
+
+
+def run_buffers(node):
+    '''
+    Stage 2 : buffers of the cleaned layer (see generate_buffers.py)
+    '''
+    name = node.params['layer']
+    gdf = generate_buffers.read_csv_to_gpd(node.inputs[0], generate_buffers.NAME_COLUMNS[name])
+    buff = generate_buffers.create_buffers(gdf[generate_buffers.BUFFER_COLUMNS[name]].copy(), node.params['radius'],
+                                           quad_segs=node.params['quad_segs'], simplify=node.params['simplify'])
+    geostore.write_layer(buff, node.outputs[0])
+
+
+def run_combine(node):
+    '''
+    Stage 3 : combined buffers of the layer (see combine_buffers.py), groups unioned in this worker
+    '''
+    gdf = geostore.read_layer(node.inputs[0])
+    geostore.write_layer(combine_buffers.combine_layer(node.params['layer'], gdf, workers=1, keep_isolated=node.params['keep_isolated']),
+                         node.outputs[0])
+
+
+def run_tree(node):
+    '''
+    Union tree of the layer's buffers, for the app's attribute filters (see union_tree.py)
+    '''
+    tree = union_tree.build_tree(geostore.read_layer(node.inputs[0]), node.params['groups'], node.params['leaf_size'])
+    for gdf, path in zip([tree['leaves'], tree['nodes']], node.outputs):
+        geostore.write_layer(gdf, path)
+
+
+def run_overlay(node):
+    '''
+    Stage 4 : faces & layer bitmasks of the combined buffers of the set (see overlay.py)
+    '''
+    overlay.save_overlay(overlay.build_overlay(*[geostore.read_layer(path) for path in node.inputs]), node.outputs[0])
+
+
+def run_partition(node):
+    '''
+    Stage 4 : region partitions & index of the combined buffers of the set (see partitions.py)
+    '''
+    partitions.build_partitions(os.path.dirname(node.inputs[0]), node.params['grid'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env/python3
+
+'''
+Batched point queries, "what is walkable from here?" : for each point (lon/lat, EPSG:4326) the trail classes,
+parks and building types (NONRES_TYP) whose combined buffers cover it.
+
+Usage: python3 point_query.py -i [buffer_directory] -- [lon,lat ...]  ("--" since longitudes here are negative)
+    or from a CSV of points: python3 point_query.py -i [buffer_directory] --csv [points.csv] (columns lon, lat)
+'''
+
+import argparse
+import json
+import time
+import numpy as np
+import pandas as pd
+import shapely
+import geostore
+
+
+TRAIL_CLASSES = ['SEP_BIKE_TRL', 'NONSEP_BIKE_TRL', 'WALK_TRL']
+
+
+def main():
+    # Initialize the parser
+    parser = argparse.ArgumentParser(description='Which trails, parks and building types are walkable from each point.')
+    parser.add_argument('-i','--input', required=False, default='../data/buffers_800t_1000p_1000b', type=str,
+        help='Directory with the combined_* buffer files. [default: ../data/buffers_800t_1000p_1000b]')
+    parser.add_argument('--csv', required=False, type=str,
+        help='CSV file of points with lon & lat columns (results are printed as JSON lines).')
+    parser.add_argument('points', nargs='*', type=str,
+        help='Points as lon,lat (EPSG:4326).')
+    args = parser.parse_args()
+
+    # Index of the combined layers, in lon/lat
+    layers = [geostore.read_layer(geostore.find_layer(args.input, name)).to_crs(epsg=4326)
+              for name in ['combined_bikeway_buffers', 'combined_park_buffers', 'combined_building_buffers']]
+    index = build_index(*layers)
+
+    # Points, query & print
+    if args.csv:
+        pts = pd.read_csv(args.csv)
+        lon, lat = pts['lon'].values, pts['lat'].values
+    else:
+        lon, lat = np.array([[float(v) for v in p.split(',')] for p in args.points]).reshape(-1, 2).T
+    start = time.perf_counter()
+    results = query_points(index, lon, lat)
+    elapsed = time.perf_counter() - start
+    for r in results:
+        print(json.dumps(r))
+    print('%d points in %.3fs (%.0f points/s)' % (len(results), elapsed, len(results) / max(elapsed, 1e-9)))
+
+
+def build_index(trail, park, building):
+    '''
+    Spatial index over the polygon parts of the combined layers (EPSG:4326), built once
+    one bit per combined row : trail groups first, then parks, then building types
+    '''
+    geoms = np.concatenate([trail.geometry.values, park.geometry.values, building.geometry.values])
+    parts, part_row = shapely.get_parts(geoms, return_index=True)  # smaller envelopes, faster point-in-polygon
+    shapely.prepare(parts)
+    return {
+        'tree': shapely.STRtree(parts),
+        'part_bit': part_row.astype(np.uint16),
+        **bit_labels(trail, park, building),
+    }
+
+
+def bit_labels(trail, park, building):
+    '''
+    What each bit means : {'trail_bits': {class: [bits]}, 'park_bits': [bits], 'building_bits': {NONRES_TYP: bit}}
+    '''
+    rows = [('trail', r) for r in trail.itertuples()] + [('park', r) for r in park.itertuples()] + [('building', r) for r in building.itertuples()]
+    return {
+        'trail_bits': {c: [i for i, (kind, r) in enumerate(rows) if kind == 'trail' and getattr(r, c)] for c in TRAIL_CLASSES},
+        'park_bits': [i for i, (kind, r) in enumerate(rows) if kind == 'park'],
+        'building_bits': {r.NONRES_TYP: i for i, (kind, r) in enumerate(rows) if kind == 'building'},
+    }
+
+
+def query_mask(index, lon, lat):
+    '''
+    Bitmask per point of the combined rows covering it (see build_index), vectorized
+    '''
+    x, y = np.asarray(lon, dtype=float), np.asarray(lat, dtype=float)
+    mask = np.zeros(len(x), dtype=np.uint16)
+    # candidates from the envelopes, then point-in-polygon against each prepared part for all its candidates at once
+    point_i, part_i = index['tree'].query(shapely.points(x, y))
+    order = np.argsort(part_i, kind='stable')
+    point_i, part_i = point_i[order], part_i[order]
+    bounds = np.flatnonzero(np.diff(part_i, prepend=-1, append=-1))
+    parts = index['tree'].geometries
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        pts = point_i[start:stop]
+        inside = pts[shapely.contains_xy(parts[part_i[start]], x[pts], y[pts])]
+        mask[inside] |= np.uint16(1 << index['part_bit'][part_i[start]])
+    return mask
+
+
+def query_points(index, lon, lat):
+    '''
+    For each point : {'lon', 'lat', 'trails': [trail classes], 'parks': bool, 'buildings': [NONRES_TYP]}
+    '''
+    mask = query_mask(index, lon, lat)
+    trail_masks = {c: sum(1 << b for b in bits) for c, bits in index['trail_bits'].items()}
+    park_mask = sum(1 << b for b in index['park_bits'])
+    results = []
+    for x, y, m in zip(lon, lat, mask.tolist()):
+        results.append({
+            'lon': float(x), 'lat': float(y),
+            'trails': [c for c, cm in trail_masks.items() if m & cm],
+            'parks': bool(m & park_mask),
+            'buildings': [t for t, b in index['building_bits'].items() if m >> b & 1],
+        })
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env/python3
+
+'''
+Walkability score surface : a square or hex grid over the extent of the combined buffers, each cell holding a
+bitmask of the combined rows (trail groups, parks, building types) covering its centroid. Any checklist
+selection is then a few bitwise operations over a NumPy array, drawn as one lightweight layer.
+
+Usage: python3 score_grid.py -i [buffer_directory]
+    optional arguments: -r [cell size meters] -k [square|hex]
+'''
+
+import argparse
+import base64
+import io
+import json
+import math
+import os
+import resource
+import time
+import numpy as np
+import pyproj
+from PIL import Image
+import geostore
+import point_query
+
+
+# Score colors (RGBA), index = number of selected categories covering the cell (0 is transparent)
+SCORE_COLORS = [(0, 0, 0, 0), (255, 255, 178, 150), (254, 204, 92, 170), (253, 141, 60, 190), (240, 59, 32, 210), (189, 0, 38, 230)]
+to_mercator = pyproj.Transformer.from_crs(4326, 3857, always_xy=True)
+to_lonlat = pyproj.Transformer.from_crs(3857, 4326, always_xy=True)
+
+
+def main():
+    # Initialize the parser
+    parser = argparse.ArgumentParser(description='Precompute the walkability score grid for a set of combined buffers.')
+    parser.add_argument('-i','--input', required=False, default='../data/buffers_800t_1000p_1000b', type=str,
+        help='Directory with the combined_* buffer files, the grid is written here. [default: ../data/buffers_800t_1000p_1000b]')
+    parser.add_argument('-r','--res', required=False, default=250, type=float,
+        help='Cell size (meters on the ground). [default: 250]')
+    parser.add_argument('-k','--kind', required=False, default='square', choices=['square', 'hex'],
+        help='Grid cell shape. [default: square]')
+    args = parser.parse_args()
+
+    # Layers & index, in lon/lat
+    layers = [geostore.read_layer(geostore.find_layer(args.input, name)).to_crs(epsg=4326)
+              for name in ['combined_bikeway_buffers', 'combined_park_buffers', 'combined_building_buffers']]
+    start = time.perf_counter()
+    grid = build_grid(point_query.build_index(*layers), layers, args.res, args.kind)
+    path = save_grid(grid, grid_path(args.input, args.res, args.kind))
+    print('%s grid, %d cells of %gm in %.2fs : %.1f MB in memory, peak RSS %.0f MB -> %s' % (args.kind, grid['bits'].size, args.res,
+        time.perf_counter() - start, grid['bits'].nbytes / 1e6, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, path))
+
+
+def grid_path(directory, res, kind):
+    '''
+    File of a precomputed grid, e.g. score_grid_250m_square.npz
+    '''
+    return os.path.join(directory, 'score_grid_%gm_%s.npz' % (res, kind))
+
+
+def build_grid(index, layers, res=250, kind='square'):
+    '''
+    Bitmask per cell (see point_query.build_index for the bits) over the extent of the layers (EPSG:4326)
+    cells are laid out in Web Mercator, so a square grid maps exactly onto a map image
+    '''
+    bounds = np.array([l.total_bounds for l in layers])
+    minx, miny = to_mercator.transform(bounds[:, 0].min(), bounds[:, 1].min())
+    maxx, maxy = to_mercator.transform(bounds[:, 2].max(), bounds[:, 3].max())
+    lat_mid = (bounds[:, 1].min() + bounds[:, 3].max()) / 2
+    step = res / math.cos(math.radians(lat_mid))  # Web Mercator units per ground meter at this latitude
+
+    if kind == 'square':
+        xs = np.arange(minx + step / 2, maxx, step)
+        ys = np.arange(maxy - step / 2, miny, -step)  # top row first, as in an image
+        x, y = [a.ravel() for a in np.meshgrid(xs, ys)]
+        shape = (len(ys), len(xs))
+    else:
+        row_step = step * math.sqrt(3) / 2  # pointy-top hexagons, odd rows shifted half a cell
+        ys = np.arange(maxy - row_step / 2, miny, -row_step)
+        xs = np.arange(minx + step / 2, maxx, step)
+        x = (xs[None, :] + (np.arange(len(ys)) % 2 * step / 2)[:, None]).ravel()
+        y = np.repeat(ys, len(xs))
+        shape = (len(x),)
+
+    lon, lat = to_lonlat.transform(x, y)
+    bits = point_query.query_mask(index, lon, lat).reshape(shape)
+    return {
+        'kind': kind, 'res': res, 'bits': bits,
+        'extent': (minx, miny, maxx, maxy) if kind == 'hex' else (xs[0] - step / 2, ys[-1] - step / 2, xs[-1] + step / 2, ys[0] + step / 2),
+        'lon': lon if kind == 'hex' else None, 'lat': lat if kind == 'hex' else None,
+        'labels': {'trail_bits': index['trail_bits'], 'park_bits': index['park_bits'], 'building_bits': index['building_bits']},
+    }
+
+
+def save_grid(grid, path):
+    '''
+    Write a grid to a compressed .npz file
+    '''
+    extra = {'lon': grid['lon'], 'lat': grid['lat']} if grid['kind'] == 'hex' else {}
+    meta = {'kind': grid['kind'], 'res': grid['res'], 'extent': list(grid['extent']), 'labels': grid['labels']}
+    np.savez_compressed(path, bits=grid['bits'], meta=json.dumps(meta), **extra)
+    return path
+
+
+def load_grid(path):
+    '''
+    Read a grid written by save_grid
+    '''
+    with np.load(path) as f:
+        meta = json.loads(str(f['meta']))
+        return {**meta, 'bits': f['bits'], 'lon': f['lon'] if 'lon' in f else None, 'lat': f['lat'] if 'lat' in f else None}
+
+
+def selection_masks(grid, trail_k, park_k, building_k):
+    '''
+    One bitmask per selected category : any selected trail class, parks, each selected building type
+    '''
+    labels = grid['labels']
+    masks = []
+    trail_bits = {b for c in trail_k for b in labels['trail_bits'].get(c, [])}
+    if trail_bits:
+        masks.append(sum(1 << b for b in trail_bits))
+    if park_k and labels['park_bits']:
+        masks.append(sum(1 << b for b in labels['park_bits']))
+    masks += [1 << labels['building_bits'][t] for t in building_k if t in labels['building_bits']]
+    return masks
+
+
+def selection_score(grid, trail_k, park_k, building_k):
+    '''
+    Number of selected categories within reach, per cell
+    '''
+    score = np.zeros(grid['bits'].shape, dtype=np.uint8)
+    for mask in selection_masks(grid, trail_k, park_k, building_k):
+        score += (grid['bits'] & mask) != 0
+    return score
+
+
+def score_image(grid, score, max_score):
+    '''
+    Square grid score as a PNG data URI, and its corners (lon, lat) for a mapbox image layer
+    '''
+    ramp = np.array(SCORE_COLORS, dtype=np.uint8)
+    levels = np.ceil(score * (len(ramp) - 1) / max(max_score, 1)).astype(int)  # spread scores over the ramp
+    buf = io.BytesIO()
+    Image.fromarray(ramp[levels]).save(buf, format='PNG', optimize=True)
+    minx, miny, maxx, maxy = grid['extent']
+    (lon0, lon1), (lat0, lat1) = to_lonlat.transform([minx, maxx], [miny, maxy])
+    corners = [[lon0, lat1], [lon1, lat1], [lon1, lat0], [lon0, lat0]]
+    return 'data:image/png;base64,' + base64.b64encode(buf.getvalue()).decode(), corners
+
+
+if __name__ == '__main__':
+    main()
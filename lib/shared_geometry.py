@@ -0,0 +1,192 @@
+#!/usr/bin/env/python3
+
+'''
+Geometry shared across gunicorn workers : each pyramid level of a layer is kept as flat arrays (one coordinate array,
+ring / polygon / geometry offsets) in memory-mapped .npy files of SHARED_GEOMETRY_DIR (/dev/shm when available), not
+as shapely objects. Every process maps the same pages, loaded once - by the master with preload_app (gunicorn.conf.py),
+else by the first worker, the others reuse the files (keyed by the size & mtime of the source files).
+
+Usage (from app.py):
+    levels = shared_geometry.load_levels(buffer_dir, name, build)   # {level: DataFrame}, build() -> {level: GeoDataFrame}
+    shapes, i = row['shapes'], row['shape_i']; shapes.geojson(i)   # GeoJSON geometry, straight from the arrays
+'''
+
+import fcntl
+import glob
+import hashlib
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+
+def shared_dir():
+    '''
+    Directory of the memory-mapped files : SHARED_GEOMETRY_DIR, else /dev/shm (memory), else the temporary directory
+    '''
+    base = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.environ.get('SHARED_GEOMETRY_DIR') or os.path.join(base, 'walkable_geometry')
+
+
+class PackedGeometry:
+    '''
+    (Multi)polygons of one layer & level as flat arrays : coords (n, 2), rings -> coords, polys -> rings, geoms -> polys
+    '''
+    def __init__(self, coords, rings, polys, geoms):
+        self.coords, self.rings, self.polys, self.geoms = coords, rings, polys, geoms
+
+    @classmethod
+    def from_geoms(cls, geoms):
+        '''
+        Pack shapely (Multi)Polygons (a Polygon is a MultiPolygon of one part)
+        '''
+        kind, coords, offsets = shapely.to_ragged_array(geoms)
+        if kind == shapely.GeometryType.POLYGON:
+            offsets = offsets + (np.arange(len(geoms) + 1),)
+        return cls(coords, *[np.asarray(o, dtype=np.int64) for o in offsets])
+
+    @classmethod
+    def from_rows(cls, rows):
+        '''
+        Pack geometries each made of the parts of several geometries of other PackedGeometries, rows as [[(shapes, i), ...], ...]
+        '''
+        coords, rings, polys, sizes = [], [], [], []
+        n_coords = n_rings = 0
+        for parts in rows:
+            size = 0
+            for shapes, i in parts:
+                p0, p1 = shapes.geoms[i], shapes.geoms[i + 1]
+                r0, r1 = shapes.polys[p0], shapes.polys[p1]
+                c0, c1 = shapes.rings[r0], shapes.rings[r1]
+                coords.append(np.asarray(shapes.coords[c0:c1]))
+                rings.append(shapes.rings[r0:r1] - c0 + n_coords)
+                polys.append(shapes.polys[p0:p1] - r0 + n_rings)
+                n_coords, n_rings, size = n_coords + c1 - c0, n_rings + r1 - r0, size + p1 - p0
+            sizes.append(size)
+        return cls(np.concatenate(coords) if coords else np.zeros((0, 2)),
+                   np.concatenate(rings + [[n_coords]]).astype(np.int64), np.concatenate(polys + [[n_rings]]).astype(np.int64),
+                   np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64))
+
+    @property
+    def nbytes(self):
+        '''
+        Bytes of the arrays
+        '''
+        return sum(np.asarray(a).nbytes for a in [self.coords, self.rings, self.polys, self.geoms])
+
+    def __len__(self):
+        return len(self.geoms) - 1
+
+    def num_coordinates(self, i):
+        '''
+        Vertices of geometry i
+        '''
+        return int(self.rings[self.polys[self.geoms[i + 1]]] - self.rings[self.polys[self.geoms[i]]])
+
+    def geojson(self, i):
+        '''
+        GeoJSON MultiPolygon of geometry i, coordinates sliced from the arrays
+        '''
+        polygons = []
+        for p in range(self.geoms[i], self.geoms[i + 1]):
+            rings = [self.coords[self.rings[r]:self.rings[r + 1]].tolist() for r in range(self.polys[p], self.polys[p + 1])]
+            if rings:
+                polygons.append(rings)
+        return {'type': 'MultiPolygon', 'coordinates': polygons}
+
+    def to_shapely(self):
+        '''
+        shapely MultiPolygons (copies the coordinates into GEOS)
+        '''
+        return shapely.from_ragged_array(shapely.GeometryType.MULTIPOLYGON, np.asarray(self.coords), (self.rings, self.polys, self.geoms))
+
+
+def layer_key(directory, name):
+    '''
+    Key of a layer's source files (every file of the directory starting with the layer name) : size & mtime of each
+    '''
+    h = hashlib.sha1(os.path.abspath(directory).encode())
+    for path in sorted(glob.glob(os.path.join(directory, name + '*'))):
+        st = os.stat(path)
+        h.update(('%s:%d:%d' % (os.path.basename(path), st.st_size, st.st_mtime_ns)).encode())
+    return h.hexdigest()[:16]
+
+
+def save_levels(prefix, levels):
+    '''
+    Write {level: GeoDataFrame} as prefix_z<level>.npy (coordinates), prefix_z<level>_offsets.npz & prefix_attrs.pkl
+    note: each file is written then renamed, the attributes last (a complete set of files)
+    '''
+    attrs = {}
+    for level, gdf in levels.items():
+        packed = PackedGeometry.from_geoms(gdf.geometry.values)
+        for path, write in [('%s_z%d.npy' % (prefix, level), lambda f: np.save(f, packed.coords)),
+                            ('%s_z%d_offsets.npz' % (prefix, level), lambda f: np.savez(f, rings=packed.rings, polys=packed.polys, geoms=packed.geoms))]:
+            with open(path + '.tmp', 'wb') as f:
+                write(f)
+            os.replace(path + '.tmp', path)
+        attrs[level] = pd.DataFrame(gdf.drop(columns=gdf.geometry.name))
+    pd.to_pickle(attrs, prefix + '_attrs.pkl.tmp')
+    os.replace(prefix + '_attrs.pkl.tmp', prefix + '_attrs.pkl')
+
+
+def read_levels(prefix):
+    '''
+    {level: DataFrame} of the attributes, with the geometry as columns shapes (PackedGeometry, memory-mapped) & shape_i
+    '''
+    levels = {}
+    for level, df in pd.read_pickle(prefix + '_attrs.pkl').items():
+        offsets = np.load('%s_z%d_offsets.npz' % (prefix, level))
+        path = '%s_z%d.npy' % (prefix, level)
+        coords = np.load(path, mmap_mode='r' if os.path.getsize(path) > 128 else None)  # an empty array cannot be mapped
+        shapes = PackedGeometry(coords, offsets['rings'], offsets['polys'], offsets['geoms'])
+        df['shapes'] = [shapes] * len(df)
+        df['shape_i'] = np.arange(len(df))
+        levels[level] = df
+    return levels
+
+
+def load_levels(directory, name, build):
+    '''
+    Levels of a layer from the shared files, built first (build() -> {level: GeoDataFrame in EPSG:4326}) when missing
+    '''
+    layer = os.path.join(shared_dir(), '%s_%s' % (os.path.basename(os.path.normpath(directory)), name))
+    prefix = '%s_%s' % (layer, layer_key(directory, name))
+    if not os.path.exists(prefix + '_attrs.pkl'):
+        os.makedirs(shared_dir(), exist_ok=True)
+        with open(layer + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)  # workers starting together : one builds, the others wait & read
+            if not os.path.exists(prefix + '_attrs.pkl'):
+                for path in glob.glob(layer + '_*'):
+                    os.remove(path)  # files of older source files
+                save_levels(prefix, build())
+    return read_levels(prefix)
+
+
+def num_coordinates(df):
+    '''
+    Total vertices of the geometries of a frame (rows with shapes & shape_i)
+    '''
+    return sum(shapes.num_coordinates(i) for shapes, i in zip(df['shapes'], df['shape_i']))
+
+
+def feature_collection(df):
+    '''
+    GeoJSON FeatureCollection of a frame's rows, feature ids from the frame's index
+    '''
+    return {'type': 'FeatureCollection', 'features': [{'type': 'Feature', 'id': idx, 'properties': {}, 'geometry': shapes.geojson(i)}
+                                                      for idx, shapes, i in zip(df.index.tolist(), df['shapes'], df['shape_i'])]}
+
+
+def to_geodataframe(df, crs='EPSG:4326'):
+    '''
+    GeoDataFrame of a frame's rows, for code that needs shapely geometries (point index, score grid)
+    '''
+    converted = {}
+    for shapes in df['shapes']:
+        if id(shapes) not in converted:
+            converted[id(shapes)] = shapes.to_shapely()
+    geoms = [converted[id(shapes)][i] for shapes, i in zip(df['shapes'], df['shape_i'])]
+    return gpd.GeoDataFrame(df.drop(columns=['shapes', 'shape_i']), geometry=geoms, crs=crs)
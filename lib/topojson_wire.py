@@ -0,0 +1,153 @@
+#!/usr/bin/env/python3
+
+'''
+Compact wire format for the map geometry : TopoJSON-style encoding of the buffer (multi)polygons. Coordinates are
+quantized to a grid of about PRECISION meters and delta-encoded, rings are cut into arcs at the points where
+neighbouring geometries meet, and an arc shared by several geometries (or traces) is stored once.
+Decoded in the browser by assets/topojson.js.
+
+Usage: python3 topojson_wire.py -i [buffer_directory]   (bytes of each layer & zoom level, GeoJSON vs TopoJSON)
+    optional arguments: -p [precision in meters] -l [levels]
+'''
+
+import argparse
+import gzip
+import json
+import math
+import time
+import numpy as np
+import lod_pyramid
+import shared_geometry
+
+
+# Default grid size in meters, about a pixel at zoom 17
+PRECISION = 1.0
+# Meters per degree of latitude
+METERS_PER_DEGREE = 111320.0
+
+
+def main():
+    # Initialize the parser
+    parser = argparse.ArgumentParser(description='Compare GeoJSON & quantized TopoJSON sizes of the combined buffers.')
+    parser.add_argument('-i','--input', required=False, default='../data/buffers_800t_1000p_1000b', type=str,
+        help='Directory with the combined_* buffer files. [default: ../data/buffers_800t_1000p_1000b]')
+    parser.add_argument('-p','--precision', required=False, default=PRECISION, type=float,
+        help='Quantization grid size in meters. [default: %s]' % PRECISION)
+    parser.add_argument('-l','--levels', required=False, default=[lod_pyramid.MIN_LEVEL, lod_pyramid.MAX_LEVEL], type=int, nargs='+',
+        help='Pyramid levels to encode. [default: %d %d]' % (lod_pyramid.MIN_LEVEL, lod_pyramid.MAX_LEVEL))
+    args = parser.parse_args()
+
+    # All three layers of a level in one topology, as the app sends them
+    layers = [shared_geometry.load_levels(args.input, name, lambda name=name: {level: gdf.to_crs(epsg=4326) for level, gdf in
+              lod_pyramid.load_pyramid(args.input, name).items()}) for name in lod_pyramid.LAYERS]
+    for level in args.levels:
+        rows = [(shapes, i) for levels in layers for shapes, i in zip(levels[level]['shapes'], levels[level]['shape_i'])]
+        geojson = json.dumps({'type': 'FeatureCollection', 'features': [{'type': 'Feature', 'id': k, 'properties': {}, 'geometry': shapes.geojson(i)}
+                                                                        for k, (shapes, i) in enumerate(rows)]}).encode()
+        start = time.perf_counter()
+        topology = encode(rows, precision=args.precision)
+        seconds = time.perf_counter() - start
+        topojson = json.dumps(topology, separators=(',', ':')).encode()
+        print('z%d : GeoJSON %d bytes (gzip %d), TopoJSON %d bytes (gzip %d), %d arcs, encoded in %.2fs' % (level,
+              len(geojson), len(gzip.compress(geojson)), len(topojson), len(gzip.compress(topojson)), len(topology['arcs']), seconds))
+
+
+def quantization(coords, precision=PRECISION):
+    '''
+    Transform of the quantization grid ({'scale', 'translate'}) : about precision meters per unit at the data's latitude
+    '''
+    lo, hi = coords.min(axis=0), coords.max(axis=0)
+    lat = math.radians((lo[1] + hi[1]) / 2)
+    scale = [precision / (METERS_PER_DEGREE * math.cos(lat)), precision / METERS_PER_DEGREE]
+    return {'scale': scale, 'translate': lo.tolist()}
+
+
+def quantized_rings(shapes, i, transform):
+    '''
+    Polygons of geometry i as lists of quantized rings (int64 (n, 2), closing point dropped, repeated points removed,
+    rings of less than 3 points dropped)
+    '''
+    polygons = []
+    for p in range(shapes.geoms[i], shapes.geoms[i + 1]):
+        rings = []
+        for r in range(shapes.polys[p], shapes.polys[p + 1]):
+            q = np.rint((np.asarray(shapes.coords[shapes.rings[r]:shapes.rings[r + 1]]) - transform['translate']) / transform['scale']).astype(np.int64)
+            q = q[np.any(q != np.roll(q, 1, axis=0), axis=1)]  # consecutive duplicates, & the closing point
+            if len(q) >= 3:
+                rings.append(q)
+        if rings:
+            polygons.append(rings)
+    return polygons
+
+
+def junctions(rings):
+    '''
+    Point keys (x << 32 | y) where rings meet : a point reached from different neighbours in different places
+    '''
+    keys, lo, hi = [], [], []
+    for q in rings:
+        k = (q[:, 0] << 32) | q[:, 1]
+        prev, nxt = np.roll(k, 1), np.roll(k, -1)
+        keys.append(k)
+        lo.append(np.minimum(prev, nxt))
+        hi.append(np.maximum(prev, nxt))
+    if not keys:
+        return set()
+    keys, lo, hi = np.concatenate(keys), np.concatenate(lo), np.concatenate(hi)
+    # distinct (point, neighbour pair) combinations, a point with more than one is a junction
+    combos = np.unique(np.stack([keys, lo, hi], axis=1), axis=0)
+    points, counts = np.unique(combos[:, 0], return_counts=True)
+    return set(points[counts > 1].tolist())
+
+
+def encode(rows, ids=None, precision=PRECISION, transform=None):
+    '''
+    TopoJSON topology of geometries given as (PackedGeometry, index) rows, one object 'shapes' with geometry ids
+    ids (row numbers by default); arcs are delta-encoded in quantized units
+    '''
+    ids = list(range(len(rows))) if ids is None else list(ids)
+    if transform is None:
+        coords = [np.asarray(shapes.coords[shapes.rings[shapes.polys[shapes.geoms[i]]]:shapes.rings[shapes.polys[shapes.geoms[i + 1]]]]) for shapes, i in rows]
+        coords = [c for c in coords if len(c)]
+        transform = quantization(np.concatenate(coords), precision) if coords else {'scale': [1, 1], 'translate': [0, 0]}
+    geometries = [quantized_rings(shapes, i, transform) for shapes, i in rows]
+    cuts = junctions([ring for polygons in geometries for rings in polygons for ring in rings])
+
+    arcs, index = [], {}
+    def arc_id(points):
+        # index of an arc, ~index when stored in the other direction, added when new
+        fwd, rev = points.tobytes(), points[::-1].tobytes()
+        if fwd in index:
+            return index[fwd]
+        if rev in index:
+            return ~index[rev]
+        index[fwd] = len(arcs)
+        arcs.append(points)
+        return len(arcs) - 1
+
+    def ring_arcs(q):
+        keys = (q[:, 0] << 32) | q[:, 1]
+        at = [j for j, k in enumerate(keys.tolist()) if k in cuts]
+        if not at:
+            # closed ring : start at its smallest point, in the direction of its smaller second point (same ring, same arc)
+            start = int(np.argmin(keys))
+            q = np.roll(q, -start, axis=0)
+            if ((q[-1, 0] << 32) | q[-1, 1]) < ((q[1, 0] << 32) | q[1, 1]):
+                return [~arc_id(np.vstack([q, q[:1]])[::-1])]
+            return [arc_id(np.vstack([q, q[:1]]))]
+        q = np.roll(q, -at[0], axis=0)
+        at = [j - at[0] for j in at] + [len(q)]
+        closed = np.vstack([q, q[:1]])
+        return [arc_id(closed[a:b + 1]) for a, b in zip(at[:-1], at[1:])]
+
+    objects = []
+    for gid, polygons in zip(ids, geometries):
+        objects.append({'type': 'MultiPolygon', 'id': gid, 'arcs': [[ring_arcs(q) for q in rings] for rings in polygons]})
+
+    # delta encoding : first point absolute, then steps
+    encoded = [np.vstack([a[:1], np.diff(a, axis=0)]).tolist() for a in arcs]
+    return {'type': 'Topology', 'transform': transform, 'objects': {'shapes': {'type': 'GeometryCollection', 'geometries': objects}}, 'arcs': encoded}
+
+
+if __name__ == '__main__':
+    main()
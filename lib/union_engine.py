@@ -0,0 +1,82 @@
+#!/usr/bin/env/python3
+
+'''
+Union engine for buffers : candidate intersections from an STRtree, connected components of intersecting
+buffers, then one cascaded union per component (replaces the pairwise loop once used by combine_buffers.py).
+'''
+
+import numpy as np
+import shapely
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+
+def intersecting_pairs(geoms):
+    '''
+    Index pairs (i, j), i < j, of intersecting geometries
+    '''
+    tree = shapely.STRtree(geoms)
+    left, right = tree.query(geoms, predicate='intersects')
+    keep = left < right
+    return left[keep], right[keep]
+
+
+def component_labels(n, left, right):
+    '''
+    Connected component label for each of n geometries, given the intersecting pairs
+    '''
+    graph = coo_matrix((np.ones(len(left), dtype=bool), (left, right)), shape=(n, n))
+    return connected_components(graph, directed=False)[1]
+
+
+def union_components(geoms, pairs=None, keep_isolated=False):
+    '''
+    Union of the geometries, computed per connected component then merged
+    note: with keep_isolated=False a geometry intersecting no other one is left out, as in the original
+          pairwise group_union (union of every intersecting pair)
+    '''
+    geoms = np.asarray(geoms)
+    if len(geoms) == 0:
+        return shapely.Polygon()
+    left, right = intersecting_pairs(geoms) if pairs is None else pairs
+    labels = component_labels(len(geoms), left, right)
+
+    # Geometries to keep, sorted by component so each component is one contiguous slice
+    keep = np.ones(len(geoms), dtype=bool)
+    if not keep_isolated:
+        keep[:] = False
+        keep[left] = True
+        keep[right] = True
+    idx = np.flatnonzero(keep)
+    idx = idx[np.argsort(labels[idx], kind='stable')]
+    if len(idx) == 0:
+        return shapely.Polygon()
+    starts = np.flatnonzero(np.diff(labels[idx], prepend=-1))
+
+    # Cascaded union per component, components are disjoint so the final merge is cheap
+    parts = [shapely.union_all(geoms[chunk]) for chunk in np.split(idx, starts[1:])]
+    return shapely.union_all(parts)
+
+
+def candidate_pairs(geoms, max_distance):
+    '''
+    Index pairs (i, j), i < j, of geometries within max_distance of each other, with their distances
+    note: buffers of radius r can only intersect if their source geometries are within 2r, so one query at the
+          largest radius serves every smaller radius (see pairs_within)
+    '''
+    tree = shapely.STRtree(geoms)
+    left, right = tree.query(geoms, predicate='dwithin', distance=max_distance)
+    keep = left < right
+    left, right = left[keep], right[keep]
+    return left, right, shapely.distance(geoms[left], geoms[right])
+
+
+def pairs_within(candidates, buffers, radius):
+    '''
+    Intersecting pairs of the buffers (of the given radius), taken from candidate_pairs of the source geometries
+    '''
+    left, right, dist = candidates
+    near = dist <= 2 * radius
+    left, right = left[near], right[near]
+    hit = shapely.intersects(buffers[left], buffers[right])
+    return left[hit], right[hit]
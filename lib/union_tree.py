@@ -0,0 +1,195 @@
+#!/usr/bin/env/python3
+
+'''
+Hierarchical union tree over the uncombined *_buffers features, so the union of any subset (a few grocery chains,
+BLDG_DESC values, single parks) is cheap : features are grouped by the layer's combined groups (trail classes,
+building types) and ordered along a Hilbert curve of their centroids within a group (neighbours in the order are
+neighbours on the map), and a balanced binary tree over that order stores the union of each node's features. A subset is assembled from the largest nodes it covers whole plus its remaining features - about
+2 log(n) nodes per run of consecutive selected features - in one cascaded union.
+
+Usage: python3 union_tree.py -i [buffer_directory]   (writes <layer>_buffers_tree & <layer>_buffers_tree_nodes)
+    optional arguments: -l [bikeways|parks|buildings ...] -f [parquet|arrow|csv] -s [leaf size]
+'''
+
+import argparse
+import time
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+import geostore
+
+
+# Features per leaf node : nodes below this size are not stored, their selected features are unioned as they are
+LEAF_SIZE = 16
+# Bits per axis of the Hilbert curve
+HILBERT_BITS = 16
+LAYERS = ['bikeways', 'parks', 'buildings']
+# Layers the app filters by attribute (trees built by default)
+FILTER_LAYERS = ['parks', 'buildings']
+# Columns grouping the features ahead of the Hilbert order, as combine_buffers.py groups them
+GROUP_COLUMNS = {'bikeways': ['SEP_BIKE_TRL', 'NONSEP_BIKE_TRL', 'WALK_TRL'], 'parks': [], 'buildings': ['NONRES_TYP']}
+
+
+def main():
+    # Initialize the parser
+    parser = argparse.ArgumentParser(description='Precompute the union tree of the uncombined buffers of each layer.')
+    parser.add_argument('-i','--input', required=False, default='../data/buffers_800t_1000p_1000b', type=str,
+        help='Directory with the *_buffers files, the trees are written here. [default: ../data/buffers_800t_1000p_1000b]')
+    parser.add_argument('-l','--layers', required=False, default=FILTER_LAYERS, nargs='+', choices=LAYERS,
+        help='Layers to index. [default: %s]' % ' '.join(FILTER_LAYERS))
+    parser.add_argument('-f','--format', required=False, default=geostore.DEFAULT_FORMAT, choices=list(geostore.FORMATS),
+        help='File format of the trees. [default: %s]' % geostore.DEFAULT_FORMAT)
+    parser.add_argument('-s','--leaf_size', required=False, default=LEAF_SIZE, type=int,
+        help='Features per leaf node. [default: %d]' % LEAF_SIZE)
+    args = parser.parse_args()
+
+    for name in args.layers:
+        try:
+            gdf = geostore.read_layer(geostore.find_layer(args.input, name + '_buffers'))
+        except FileNotFoundError:
+            print('%s : no %s_buffers file, skipped' % (name, name))
+            continue
+        start = time.perf_counter()
+        tree = build_tree(gdf, GROUP_COLUMNS[name], args.leaf_size)
+        seconds = time.perf_counter() - start
+        save_tree(tree, args.input, name, args.format)
+        print('%s : %d features, %d nodes in %.1fs' % (name, len(tree['leaves']), len(tree['nodes']), seconds))
+
+        # every feature, all but the last group, the first group & the most common name, against unioning them directly
+        leaves = tree['leaves']
+        groups = leaves[GROUP_COLUMNS[name]].apply(tuple, axis='columns') if GROUP_COLUMNS[name] else pd.Series(0, index=leaves.index)
+        cases = [('all', np.ones(len(leaves), dtype=bool)), ('all but one group', (groups != groups.iloc[-1]).values),
+                 ('one group', (groups == groups.iloc[0]).values), ('one name', (leaves['name'] == leaves['name'].mode()[0]).values)]
+        for label, selected in cases:
+            start = time.perf_counter()
+            fast = subset_union(tree, selected)
+            tree_seconds = time.perf_counter() - start
+            start = time.perf_counter()
+            slow = shapely.union_all(leaves.geometry.values[selected])
+            print('    %-17s %5d features, %4d pieces : %.3fs from the tree, %.3fs unioned directly (area difference %.1f m2)' % (label,
+                selected.sum(), len(subset_pieces(tree, selected)), tree_seconds, time.perf_counter() - start, abs(fast.area - slow.area)))
+
+
+def hilbert_keys(x, y, bits=HILBERT_BITS):
+    '''
+    Position along a Hilbert curve of points scaled to their bounding box (vectorized)
+    '''
+    side = 2**bits
+    span = max(np.ptp(x), np.ptp(y), 1e-9)
+    xi = np.minimum(((x - x.min()) / span * side).astype(np.int64), side - 1)
+    yi = np.minimum(((y - y.min()) / span * side).astype(np.int64), side - 1)
+    d = np.zeros(len(xi), dtype=np.int64)
+    s = side // 2
+    while s > 0:
+        rx, ry = (xi & s) > 0, (yi & s) > 0
+        d += s * s * ((3 * rx) ^ ry)
+        # rotate the quadrant
+        flip = ~ry & rx
+        xi, yi = np.where(flip, s - 1 - xi, xi), np.where(flip, s - 1 - yi, yi)
+        xi, yi = np.where(~ry, yi, xi), np.where(~ry, xi, yi)
+        s //= 2
+    return d
+
+
+def build_tree(gdf, group_columns=(), leaf_size=LEAF_SIZE):
+    '''
+    Union tree of a layer : {'leaves': features by group then in Hilbert order, 'nodes': GeoDataFrame of lo, hi & the union of
+    features lo..hi-1, 'leaf_size'}; nodes span leaf_size, 2 leaf_size, 4 leaf_size ... features, aligned on their span
+    '''
+    x, y = shapely.get_coordinates(shapely.centroid(gdf.geometry.values)).T
+    keys = [hilbert_keys(x, y)] + [pd.factorize(gdf[c], sort=True)[0] for c in reversed(list(group_columns))]
+    leaves = gdf.iloc[np.lexsort(keys)].reset_index(drop=True)
+    geoms, n = leaves.geometry.values, len(leaves)
+
+    # bottom-up, each node the union of its two children (already unioned, so a cheap merge)
+    level = {(lo, min(lo + leaf_size, n)): shapely.union_all(geoms[lo:lo + leaf_size]) for lo in range(0, n, leaf_size)}
+    unions = dict(level)
+    span = leaf_size
+    while span < n:
+        span *= 2
+        parents = {}
+        for lo in range(0, n, span):
+            left, right = (lo, min(lo + span // 2, n)), (lo + span // 2, min(lo + span, n))
+            if right[0] >= n:
+                parents[left] = level[left]  # last node of the level, alone : it is its own parent (stored once)
+            else:
+                parents[lo, right[1]] = unions[lo, right[1]] = shapely.union_all([level[left], level[right]])
+        level = parents
+    nodes = gpd.GeoDataFrame({'lo': [lo for lo, _ in unions], 'hi': [hi for _, hi in unions]}, geometry=list(unions.values()), crs=gdf.crs)
+    return with_index({'leaves': leaves, 'nodes': nodes, 'leaf_size': leaf_size})
+
+
+def with_index(tree):
+    '''
+    Tree with a lookup of its nodes by (lo, hi)
+    '''
+    tree['index'] = {(lo, hi): i for i, (lo, hi) in enumerate(zip(tree['nodes']['lo'].tolist(), tree['nodes']['hi'].tolist()))}
+    return tree
+
+
+def tree_names(name):
+    '''
+    Layer names of a tree's features & nodes, e.g. buildings_buffers_tree & buildings_buffers_tree_nodes
+    '''
+    return name + '_buffers_tree', name + '_buffers_tree_nodes'
+
+
+def save_tree(tree, directory, name, fmt=None):
+    '''
+    Write a tree as two layers (see tree_names), nodes in build order (the first one spans leaf_size features)
+    '''
+    for gdf, layer in zip([tree['leaves'], tree['nodes']], tree_names(name)):
+        geostore.write_layer(gdf, geostore.layer_path(directory, layer, fmt))
+
+
+def load_tree(directory, name):
+    '''
+    Read a tree written by save_tree
+    '''
+    leaves, nodes = [geostore.read_layer(geostore.find_layer(directory, layer)) for layer in tree_names(name)]
+    leaf_size = int(nodes['hi'].iloc[0] - nodes['lo'].iloc[0]) if len(nodes) else LEAF_SIZE
+    return with_index({'leaves': leaves, 'nodes': nodes, 'leaf_size': leaf_size})
+
+
+def subset_pieces(tree, selected):
+    '''
+    Geometries whose union is the union of the selected features (boolean array in tree order) : stored nodes the
+    selection covers whole, then single features
+    '''
+    n, leaf_size = len(tree['leaves']), tree['leaf_size']
+    counts = np.concatenate([[0], np.cumsum(selected)])
+    nodes, geoms = tree['nodes'].geometry.values, tree['leaves'].geometry.values
+    pieces = []
+    def visit(lo, span):
+        hi = min(lo + span, n)
+        count = counts[hi] - counts[lo]
+        if count == 0:
+            return
+        if count == hi - lo and (lo, hi) in tree['index']:
+            pieces.append(nodes[tree['index'][lo, hi]])
+        elif span <= leaf_size:
+            pieces.extend(geoms[lo:hi][selected[lo:hi]])
+        else:
+            visit(lo, span // 2)
+            if lo + span // 2 < n:
+                visit(lo + span // 2, span // 2)
+    root = leaf_size
+    while root < n:
+        root *= 2
+    visit(0, root)
+    return pieces
+
+
+def subset_union(tree, selected):
+    '''
+    Union of the selected features (boolean array in tree order), an empty polygon for none
+    '''
+    pieces = subset_pieces(tree, np.asarray(selected, dtype=bool))
+    if len(pieces) == 1:
+        return pieces[0]
+    return shapely.union_all(pieces) if pieces else shapely.Polygon()
+
+
+if __name__ == '__main__':
+    main()
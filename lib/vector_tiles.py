@@ -0,0 +1,150 @@
+#!/usr/bin/env/python3
+
+'''
+Mapbox vector tiles (MVT) cut from the combined buffers, with a content-addressed tile cache on disk.
+Each tile holds one MVT layer per group (trail class, 'parks', building type), so the map can show any
+selection from the same cached tiles.
+
+Usage (pre-seed the cache): python3 vector_tiles.py -i [buffer_directory] -c [cache_directory]
+    optional arguments: --min_zoom 8 --max_zoom 14
+'''
+
+import argparse
+import hashlib
+import os
+import time
+import numpy as np
+import shapely
+from shapely.geometry import MultiPolygon
+import mapbox_vector_tile
+import lod_pyramid
+
+
+# Layers served at /tiles/<layer>/<z>/<x>/<y>.mvt, and the combined buffer file behind each
+TILE_LAYERS = {'bikeway': 'combined_bikeway_buffers', 'park': 'combined_park_buffers', 'building': 'combined_building_buffers'}
+EXTENT = 4096  # tile coordinate range
+BUFFER = 64  # extra tile units drawn around each tile (avoids seams between tiles)
+WEB_MERCATOR_HALF = 20037508.342789244  # half the width of the world in EPSG:3857 meters
+
+
+def main():
+    # Initialize the parser
+    parser = argparse.ArgumentParser(description='Pre-seed the vector tile cache for the combined buffers.')
+    parser.add_argument('-i','--input', required=False, default='../data/buffers_800t_1000p_1000b', type=str,
+        help='Directory with the combined_* buffer files. [default: ../data/buffers_800t_1000p_1000b]')
+    parser.add_argument('-c','--cache', required=False, default='../data/tile_cache', type=str,
+        help='Tile cache directory. [default: ../data/tile_cache]')
+    parser.add_argument('--min_zoom', required=False, default=8, type=int,
+        help='Lowest zoom level to seed. [default: 8]')
+    parser.add_argument('--max_zoom', required=False, default=14, type=int,
+        help='Highest zoom level to seed. [default: 14]')
+    args = parser.parse_args()
+
+    # Seed every tile covering each layer, per zoom level
+    layers = load_tile_layers(args.input)
+    for z in range(args.min_zoom, args.max_zoom + 1):
+        start, count = time.perf_counter(), 0
+        for layer in layers:
+            for x, y in covering_tiles(layers[layer]['bounds'], z):
+                get_tile(layers, args.cache, layer, z, x, y)
+                count += 1
+        print('z%d : %d tiles in %.1fs' % (z, count, time.perf_counter() - start))
+
+
+def load_tile_layers(directory):
+    '''
+    Read each layer's level-of-detail pyramid in Web Mercator, with a spatial index over polygon parts
+    {layer: {'levels': {level: (parts, part_feature, tree)}, 'names': [...], 'bounds': (...), 'fingerprint': str}}
+    '''
+    layers = {}
+    for layer, name in TILE_LAYERS.items():
+        pyramid = lod_pyramid.load_pyramid(directory, name)
+        base = pyramid[lod_pyramid.MAX_LEVEL]
+        levels = {}
+        fingerprint = hashlib.sha256('\n'.join(str(n) for n in base['name']).encode())
+        for level, gdf in sorted(pyramid.items()):
+            geoms = gdf.geometry.to_crs(epsg=3857).values
+            parts, part_feature = shapely.get_parts(geoms, return_index=True)  # split multipolygons for the index
+            levels[level] = (parts, part_feature, shapely.STRtree(parts))
+            fingerprint.update(b''.join(shapely.to_wkb(gdf.geometry.values)))  # every level a tile is cut from
+        layers[layer] = {
+            'levels': levels,
+            'names': [str(n) for n in base['name']],
+            'bounds': tuple(base.geometry.to_crs(epsg=3857).total_bounds),
+            'fingerprint': fingerprint.hexdigest(),
+        }
+    return layers
+
+
+def tile_bounds(z, x, y):
+    '''
+    Web Mercator bounds (minx, miny, maxx, maxy) of tile z/x/y
+    '''
+    size = 2 * WEB_MERCATOR_HALF / 2**z
+    minx = -WEB_MERCATOR_HALF + x * size
+    maxy = WEB_MERCATOR_HALF - y * size
+    return (minx, maxy - size, minx + size, maxy)
+
+
+def covering_tiles(bounds, z):
+    '''
+    All tiles (x, y) at zoom z intersecting the Web Mercator bounds
+    '''
+    size = 2 * WEB_MERCATOR_HALF / 2**z
+    x0, x1 = int((bounds[0] + WEB_MERCATOR_HALF) // size), int((bounds[2] + WEB_MERCATOR_HALF) // size)
+    y0, y1 = int((WEB_MERCATOR_HALF - bounds[3]) // size), int((WEB_MERCATOR_HALF - bounds[1]) // size)
+    return [(x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+
+
+def render_tile(layer_data, z, x, y):
+    '''
+    Encode tile z/x/y of one layer as MVT bytes, one MVT layer per feature (group) name
+    '''
+    parts, part_feature, tree = layer_data['levels'][lod_pyramid.level_for_zoom(z)]
+    bounds = tile_bounds(z, x, y)
+    pad = (bounds[2] - bounds[0]) * BUFFER / EXTENT
+    clip_box = (bounds[0] - pad, bounds[1] - pad, bounds[2] + pad, bounds[3] + pad)
+
+    # Clip candidate parts to the (buffered) tile, keep polygonal pieces per feature
+    hits = tree.query(shapely.box(*clip_box), predicate='intersects')
+    clipped = shapely.clip_by_rect(parts[hits], *clip_box)
+    pieces, piece_idx = shapely.get_parts(clipped, return_index=True)
+    polygonal = shapely.get_type_id(pieces) == 3
+    pieces, owner = pieces[polygonal], part_feature[hits][piece_idx[polygonal]]
+
+    mvt_layers = []
+    for feature in np.unique(owner):
+        mvt_layers.append({'name': layer_data['names'][feature],
+                           'features': [{'geometry': MultiPolygon(list(pieces[owner == feature])), 'properties': {}}]})
+    if not mvt_layers:
+        return b''
+    return mapbox_vector_tile.encode(mvt_layers, default_options={'quantize_bounds': bounds, 'extents': EXTENT})
+
+
+def tile_key(layer_data, z, x, y):
+    '''
+    Content address of a tile : hash of the layer's data and the tile coordinates
+    '''
+    return hashlib.sha256(('%s/%d/%d/%d/%d' % (layer_data['fingerprint'], EXTENT, z, x, y)).encode()).hexdigest()
+
+
+def get_tile(layers, cache_dir, layer, z, x, y):
+    '''
+    Tile bytes & content address, read from the disk cache or rendered and stored
+    '''
+    key = tile_key(layers[layer], z, x, y)
+    path = os.path.join(cache_dir, key[:2], key + '.mvt')
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            return f.read(), key
+    data = render_tile(layers[layer], z, x, y)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = '%s.%d.tmp' % (path, os.getpid())  # write then rename, safe with several workers
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+    return data, key
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+#!/usr/bin/env/python3
+
+'''
+Viewport clipping for the map callback : bounds of the map view from the graph's relayoutData, widened by a margin &
+snapped to the tile grid of the zoom level (the area fetched), and the layers clipped to it. Polygon parts are indexed
+by their bounding boxes (STRtree, once per layer & level) : parts inside the area are sent as they are, only the parts
+crossing its edge are clipped.
+
+Usage (from app.py):
+    view = viewport.view_bounds(relayout)            # (min lon, min lat, max lon, max lat) or None
+    area = viewport.fetch_bounds(view, level, extent)   # view + margin, snapped, None when it covers the extent
+    clipped = viewport.clip_frame(combined, area)    # rows with clipped shapes
+'''
+
+import math
+import numpy as np
+import shapely
+import shared_geometry
+
+
+# Margin around the view, as a fraction of its width & height on each side (panning within it needs no new figure)
+MARGIN = 0.5
+# Graph size assumed when relayoutData has no corner coordinates (pixels), on the large side
+GRAPH_SIZE = (1200, 800)
+
+
+def view_bounds(relayout):
+    '''
+    (min lon, min lat, max lon, max lat) of the map view from relayoutData, from the corners plotly reports
+    (mapbox._derived) or else from the center & zoom; None without either
+    '''
+    if not relayout:
+        return None
+    corners = (relayout.get('mapbox._derived') or {}).get('coordinates')
+    if corners:
+        lon, lat = zip(*corners)
+        return (min(lon), min(lat), max(lon), max(lat))
+    center, zoom = relayout.get('mapbox.center'), relayout.get('mapbox.zoom')
+    if center is None or zoom is None:
+        return None
+    # Web Mercator : 256 px tiles, 360 degrees of longitude at zoom 0
+    half_w = 360.0 * GRAPH_SIZE[0] / (256 * 2**zoom) / 2
+    half_h = half_w * GRAPH_SIZE[1] / GRAPH_SIZE[0] * math.cos(math.radians(center['lat']))
+    return (center['lon'] - half_w, center['lat'] - half_h, center['lon'] + half_w, center['lat'] + half_h)
+
+
+def fit_view(bounds):
+    '''
+    Map center ({'lon', 'lat'}) & zoom showing bounds (min lon, min lat, max lon, max lat) whole, the inverse of view_bounds
+    '''
+    center = {'lon': (bounds[0] + bounds[2]) / 2, 'lat': (bounds[1] + bounds[3]) / 2}
+    w = max(bounds[2] - bounds[0], 1e-9)
+    h = max(bounds[3] - bounds[1], 1e-9) / math.cos(math.radians(center['lat']))
+    zoom = min(math.log2(360.0 * GRAPH_SIZE[0] / (256 * w)), math.log2(360.0 * GRAPH_SIZE[1] / (256 * h)))
+    return center, max(0, math.floor(zoom * 2) / 2)
+
+
+def fetch_bounds(view, level, extent, margin=MARGIN):
+    '''
+    Area to send for a view : the view plus a margin on each side, snapped outwards to the tile grid of the level
+    (nearby views share an area, & a cached figure); None when it covers the whole data extent
+    '''
+    if view is None:
+        return None
+    w, h = view[2] - view[0], view[3] - view[1]
+    step = 360.0 / 2**level
+    area = (math.floor((view[0] - margin * w) / step) * step, math.floor((view[1] - margin * h) / step) * step,
+            math.ceil((view[2] + margin * w) / step) * step, math.ceil((view[3] + margin * h) / step) * step)
+    return None if covers(area, extent) else area
+
+
+def covers(area, view):
+    '''
+    Whether an area (None : everything) contains a view
+    '''
+    if area is None:
+        return True
+    if view is None:
+        return False
+    return area[0] <= view[0] and area[1] <= view[1] and area[2] >= view[2] and area[3] >= view[3]
+
+
+def part_index(shapes):
+    '''
+    Bounding boxes & STRtree of the polygon parts of a PackedGeometry, with the row of each part
+    (built once, kept on the object)
+    '''
+    if getattr(shapes, 'parts', None) is None:
+        part_row = np.repeat(np.arange(len(shapes)), np.diff(shapes.geoms))
+        part = np.flatnonzero(np.diff(shapes.polys) > 0)  # parts with rings
+        starts = shapes.rings[shapes.polys[part]]
+        coords = np.asarray(shapes.coords)
+        # from a part's exterior ring to the next part's : its holes are inside the exterior, so these are its bounds
+        lo = np.column_stack([np.minimum.reduceat(coords[:, k], starts) for k in range(2)]) if len(part) else np.zeros((0, 2))
+        hi = np.column_stack([np.maximum.reduceat(coords[:, k], starts) for k in range(2)]) if len(part) else np.zeros((0, 2))
+        bounds = np.hstack([lo, hi])
+        shapes.parts = {'part': part, 'row': part_row[part], 'bounds': bounds, 'tree': shapely.STRtree(shapely.box(*bounds.T))}
+    return shapes.parts
+
+
+def frame_bounds(df):
+    '''
+    (min lon, min lat, max lon, max lat) of the geometries of frames' rows (shapes & shape_i columns)
+    '''
+    bounds = np.vstack([part_index(shapes)['bounds'] for shapes in {id(s): s for s in df['shapes']}.values()])
+    return tuple(bounds[:, :2].min(axis=0).tolist() + bounds[:, 2:].max(axis=0).tolist())
+
+
+def part_rings(shapes, p):
+    '''
+    Rings of part p (exterior first), as coordinate arrays
+    '''
+    return [np.asarray(shapes.coords[shapes.rings[r]:shapes.rings[r + 1]]) for r in range(shapes.polys[p], shapes.polys[p + 1])]
+
+
+def clip_rows(shapes, rows, area):
+    '''
+    Geometries of rows of a PackedGeometry clipped to an area, {row: [polygon as list of rings]}
+    '''
+    index = part_index(shapes)
+    hits = index['tree'].query(shapely.box(*area))
+    hits = hits[np.isin(index['row'][hits], rows)]
+    b = index['bounds'][hits]
+    inside = (b[:, 0] >= area[0]) & (b[:, 1] >= area[1]) & (b[:, 2] <= area[2]) & (b[:, 3] <= area[3])
+    out = {row: [] for row in rows}
+    # parts inside the area as they are, parts across its edge clipped (clip_by_rect keeps holes)
+    for p, row, whole in zip(index['part'][hits], index['row'][hits], inside):
+        rings = part_rings(shapes, p)
+        if whole:
+            out[row].append(rings)
+            continue
+        clipped = shapely.clip_by_rect(shapely.Polygon(rings[0], rings[1:]), *area)
+        for poly in shapely.get_parts(clipped):
+            if shapely.get_type_id(poly) == 3 and not poly.is_empty:  # polygons only (edges touching the area are dropped)
+                out[row].append([np.asarray(poly.exterior.coords)] + [np.asarray(r.coords) for r in poly.interiors])
+    return out
+
+
+def clip_frame(df, area):
+    '''
+    Rows of a frame (shapes & shape_i columns) with their geometry clipped to an area (None : unchanged), as a new
+    frame with a PackedGeometry of the clipped geometries
+    '''
+    if area is None:
+        return df
+    polygons = [None] * len(df)
+    for shapes in {id(s): s for s in df['shapes']}.values():
+        at = np.flatnonzero([s is shapes for s in df['shapes']])
+        clipped = clip_rows(shapes, df['shape_i'].values[at], area)
+        for a in at:
+            polygons[a] = clipped[df['shape_i'].values[a]]
+    out = df.copy()
+    packed = pack_polygons(polygons)
+    out['shapes'] = [packed] * len(df)
+    out['shape_i'] = np.arange(len(df))
+    return out
+
+
+def pack_polygons(geometries):
+    '''
+    PackedGeometry of geometries given as lists of polygons (lists of ring coordinate arrays)
+    '''
+    rings = [ring for polygons in geometries for polygon in polygons for ring in polygon]
+    ring_sizes = [len(ring) for ring in rings]
+    poly_sizes = [len(polygon) for polygons in geometries for polygon in polygons]
+    geom_sizes = [len(polygons) for polygons in geometries]
+    coords = np.concatenate(rings) if rings else np.zeros((0, 2))
+    offsets = [np.concatenate([[0], np.cumsum(sizes, dtype=np.int64)]).astype(np.int64) for sizes in [ring_sizes, poly_sizes, geom_sizes]]
+    return shared_geometry.PackedGeometry(coords, *offsets)